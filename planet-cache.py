@@ -16,10 +16,20 @@ import dbhash
 import ConfigParser
 
 import planet
+import planet.bulk
+import planet.benchmark
 
 
 def usage():
     print "Usage: planet-cache [options] CACHEFILE [ITEMID]..."
+    print "       planet-cache --migrate CACHEDIR"
+    print "       planet-cache --upgrade CACHEDIR"
+    print "       planet-cache --benchmark CACHEDIR"
+    print "       planet-cache --archive-benchmark CACHEDIR DAYS"
+    print "       planet-cache --items-benchmark CACHEDIR"
+    print "       planet-cache --sanitize-benchmark FEED|CACHEDIR..."
+    print "       planet-cache --stats|--vacuum|--export|--import CACHEDIR"
+    print "       planet-cache --archive CACHEDIR DAYS"
     print
     print "Examine and modify information in the Planet cache."
     print
@@ -33,6 +43,31 @@ def usage():
     print " -H, --hide        Mark the item(s) as hidden"
     print " -U, --unhide      Mark the item(s) as not hidden"
     print
+    print "Cache Directory Commands:"
+    print " -M, --migrate     Import the channel caches into an SQLite cache,"
+    print "                   for cache_backend = sqlite"
+    print " -G, --upgrade     Rewrite the channel caches in the compact format"
+    print " -B, --benchmark   Time a replay of the channels with each"
+    print "                   cache_backend, and size them in each dbhash"
+    print "                   format"
+    print " -T, --archive-benchmark"
+    print "                   Time a scan of the channels before and after"
+    print "                   archiving the items older than DAYS"
+    print " -N, --items-benchmark"
+    print "                   Time loading and listing the newest items of"
+    print "                   the channels with their dates in each format"
+    print " -Z, --sanitize-benchmark"
+    print "                   Time each sanitizer over the HTML of the"
+    print "                   feeds (files or URLs) or cache directories"
+    print " -S, --stats       List the items, bytes and oldest and newest"
+    print "                   item of each channel, and its archived items"
+    print "                   and their bytes, largest first"
+    print " -V, --vacuum      Reclaim the space of deleted records"
+    print " -E, --export      Write the channel caches out as JSON lines"
+    print " -X, --import      Read channel caches in from JSON lines"
+    print " -A, --archive     Move the items older than DAYS into the"
+    print "                   channels' archives"
+    print
     print "Other Options:"
     print " -h, --help        Display this help message and exit"
     sys.exit(0)
@@ -99,12 +134,58 @@ if __name__ == "__main__":
                 usage_error("Only one command option may be supplied")
             command = "unhide"
             want_ids = 1
+        elif arg == "-M" or arg == "--migrate":
+            if command is not None:
+                usage_error("Only one command option may be supplied")
+            command = "migrate"
+        elif arg == "-G" or arg == "--upgrade":
+            if command is not None:
+                usage_error("Only one command option may be supplied")
+            command = "upgrade"
+        elif arg == "-B" or arg == "--benchmark":
+            if command is not None:
+                usage_error("Only one command option may be supplied")
+            command = "benchmark"
+        elif arg == "-T" or arg == "--archive-benchmark":
+            if command is not None:
+                usage_error("Only one command option may be supplied")
+            command = "archive-benchmark"
+        elif arg == "-N" or arg == "--items-benchmark":
+            if command is not None:
+                usage_error("Only one command option may be supplied")
+            command = "items-benchmark"
+        elif arg == "-Z" or arg == "--sanitize-benchmark":
+            if command is not None:
+                usage_error("Only one command option may be supplied")
+            command = "sanitize-benchmark"
+        elif arg == "-S" or arg == "--stats":
+            if command is not None:
+                usage_error("Only one command option may be supplied")
+            command = "stats"
+        elif arg == "-V" or arg == "--vacuum":
+            if command is not None:
+                usage_error("Only one command option may be supplied")
+            command = "vacuum"
+        elif arg == "-E" or arg == "--export":
+            if command is not None:
+                usage_error("Only one command option may be supplied")
+            command = "export"
+        elif arg == "-X" or arg == "--import":
+            if command is not None:
+                usage_error("Only one command option may be supplied")
+            command = "import"
+        elif arg == "-A" or arg == "--archive":
+            if command is not None:
+                usage_error("Only one command option may be supplied")
+            command = "archive"
         elif arg.startswith("-"):
             usage_error("Unknown option:", arg)
         else:
             if cache_file is None:
                 cache_file = arg
-            elif want_ids:
+            elif want_ids or (command in ("archive", "archive-benchmark")
+                              and not ids) \
+                     or command == "sanitize-benchmark":
                 ids.append(arg)
             else:
                 usage_error("Unexpected extra argument:", arg)
@@ -113,11 +194,205 @@ if __name__ == "__main__":
         usage_error("Missing expected cache filename")
     elif want_ids and not len(ids):
         usage_error("Missing expected entry ids")
+    elif command in ("archive", "archive-benchmark") and not len(ids):
+        usage_error("Missing expected age in days")
+
+    if command == "migrate":
+        if not os.path.isdir(cache_file):
+            usage_error("Not a cache directory:", cache_file)
+        database = os.path.join(cache_file, planet.SQLITE_CACHE_FILENAME)
+        count = planet.cache.migrate(cache_file, database)
+        print "Imported %d channels into %s." % (count, database)
+        sys.exit(0)
+
+    elif command == "upgrade":
+        if not os.path.isdir(cache_file):
+            usage_error("Not a cache directory:", cache_file)
+        old_size = new_size = 0
+        for name, old, new in planet.cache.upgrade(cache_file):
+            print "%s: %d -> %d bytes" % (name, old, new)
+            old_size += old
+            new_size += new
+        if old_size:
+            print "Rewrote the caches in %d bytes, %d%% less than %d." \
+                  % (new_size, 100 - new_size * 100 / old_size, old_size)
+        else:
+            print "No caches to rewrite."
+        sys.exit(0)
+
+    elif command == "benchmark":
+        if not os.path.isdir(cache_file):
+            usage_error("Not a cache directory:", cache_file)
+        channels = planet.benchmark.read_channels(cache_file)
+        if channels:
+            print "Replaying %d channels, %d items:" % (len(channels),
+                sum([ len(items) for name, fields, items in channels ]))
+        else:
+            channels = planet.benchmark.make_channels()
+            print "No channels in the cache, replaying %d made up ones:" \
+                  % len(channels)
+        print "%-8s %9s %9s %9s %12s" % ("backend", "load", "update",
+                                         "render", "bytes")
+        for name, results in planet.benchmark.run(cache_file, channels):
+            print "%-8s %8.3fs %8.3fs %8.3fs %12d" % (name, results["load"],
+                results["update"], results["render"], results["size"])
+        count, old_size, new_size = planet.benchmark.upgrading(cache_file,
+                                                               channels)
+        if old_size:
+            print "The dbhash caches take %d bytes in the compact format," \
+                  " %d%% less than %d in the original one." \
+                  % (new_size, 100 - new_size * 100 / old_size, old_size)
+        sys.exit(0)
+
+    elif command == "archive-benchmark":
+        if not os.path.isdir(cache_file):
+            usage_error("Not a cache directory:", cache_file)
+        try:
+            days = float(ids[0])
+        except ValueError:
+            usage_error("Not an age in days:", ids[0])
+        if planet.cache.zlib is None:
+            print >>sys.stderr, "The zlib module is needed to archive"
+            sys.exit(1)
+        channels = planet.benchmark.read_channels(cache_file)
+        if channels:
+            print "Archiving %d channels, %d items:" % (len(channels),
+                sum([ len(items) for name, fields, items in channels ]))
+        else:
+            channels = planet.benchmark.make_channels()
+            print "No channels in the cache, archiving %d made up ones:" \
+                  % len(channels)
+        print "%-8s %7s %12s %12s %9s" % ("", "items", "bytes",
+                                          "archived", "scan")
+        before, after = planet.benchmark.archiving(cache_file, days, channels)
+        for name, results in (("before", before), ("after", after)):
+            print "%-8s %7d %12d %12d %8.3fs" % (name, results["items"],
+                results["size"], results["archive_size"], results["scan"])
+        sys.exit(0)
+
+    elif command == "items-benchmark":
+        if not os.path.isdir(cache_file):
+            usage_error("Not a cache directory:", cache_file)
+        channels = planet.benchmark.read_channels(cache_file)
+        if channels:
+            print "Listing %d channels, %d items:" % (len(channels),
+                sum([ len(items) for name, fields, items in channels ]))
+        else:
+            channels = planet.benchmark.make_channels(
+                planet.benchmark.LISTING_CHANNELS,
+                planet.benchmark.LISTING_ITEMS,
+                planet.benchmark.LISTING_CONTENT_BYTES)
+            print "No channels in the cache, listing %d made up ones:" \
+                  % len(channels)
+        print "%-8s %7s %9s %9s %9s" % ("dates", "items", "load", "items()",
+                                        "mktime")
+        for format, count, load, seconds, mktime in \
+                planet.benchmark.listing(cache_file, channels):
+            print "%-8s %7d %8.3fs %8.3fs %8.3fs" % (format, count, load,
+                                                     seconds, mktime)
+        sys.exit(0)
+
+    elif command == "sanitize-benchmark":
+        corpus = planet.benchmark.read_html([ cache_file ] + ids)
+        if not corpus:
+            print >>sys.stderr, "No HTML found to sanitize"
+            sys.exit(1)
+        print "Sanitizing %d pieces of HTML %d times:" % (len(corpus),
+            planet.benchmark.SANITIZE_ROUNDS)
+        print "%-8s %9s %12s %12s" % ("engine", "time", "bytes/s",
+                                      "differences")
+        for name, seconds, rate, differences in \
+                planet.benchmark.sanitize_engines(corpus):
+            print "%-8s %8.3fs %12d %12d" % (name, seconds, rate,
+                                             differences)
+        sys.exit(0)
+
+    elif command in ("stats", "vacuum", "export", "import", "archive"):
+        if not os.path.isdir(cache_file):
+            usage_error("Not a cache directory:", cache_file)
+        if command in ("export", "import") and planet.bulk.json is None:
+            print >>sys.stderr, "The json module is needed to " + command
+            sys.exit(1)
+        if command == "archive" and planet.cache.zlib is None:
+            print >>sys.stderr, "The zlib module is needed to " + command
+            sys.exit(1)
+
+        if command == "import":
+            channels, items = planet.bulk.import_records(cache_file,
+                                                         sys.stdin)
+            print >>sys.stderr, "Imported %d channels, %d items." \
+                  % (channels, items)
+            sys.exit(0)
+
+        paths = planet.bulk.channel_files(cache_file)
+        if command == "stats":
+            channels = list(planet.bulk.map_channels(planet.bulk.stats,
+                                                     paths))
+            channels.sort(lambda a, b: cmp(b["bytes"], a["bytes"]))
+            print "%12s %7s  %-10s  %-10s %8s %12s  %s" % ("bytes", "items",
+                "oldest", "newest", "archived", "bytes", "channel")
+            for channel in channels:
+                dates = []
+                for date in (channel["oldest"], channel["newest"]):
+                    if date is None:
+                        dates.append("-")
+                    else:
+                        dates.append(time.strftime("%Y-%m-%d",
+                                                   time.gmtime(date)))
+                print "%12d %7d  %-10s  %-10s %8d %12d  %s" % (
+                    channel["bytes"], channel["items"], dates[0], dates[1],
+                    channel["archived"], channel["archive_bytes"],
+                    channel["url"] or channel["name"])
+            print "%12d %7d  %-10s  %-10s %8d %12d  in %d channels" % (
+                sum([ channel["bytes"] for channel in channels ]),
+                sum([ channel["items"] for channel in channels ]), "", "",
+                sum([ channel["archived"] for channel in channels ]),
+                sum([ channel["archive_bytes"] for channel in channels ]),
+                len(channels))
+
+        elif command == "vacuum":
+            old_size = new_size = 0
+            for name, old, new in planet.bulk.map_channels(
+                    planet.bulk.vacuum, paths):
+                print "%s: %d -> %d bytes" % (name, old, new)
+                old_size += old
+                new_size += new
+            if old_size:
+                print "Vacuumed the caches to %d bytes, %d%% less than %d." \
+                      % (new_size, 100 - new_size * 100 / old_size, old_size)
+            else:
+                print "No caches to vacuum."
+
+        elif command == "archive":
+            try:
+                days = float(ids[0])
+            except ValueError:
+                usage_error("Not an age in days:", ids[0])
+            count = old_size = new_size = 0
+            for name, archived, old, new in planet.bulk.map_channels(
+                    planet.bulk.archive, paths, args=(days,)):
+                if archived:
+                    print "%s: %d items, %d -> %d bytes" % (name, archived,
+                                                            old, new)
+                count += archived
+                old_size += old
+                new_size += new
+            if count:
+                print "Archived %d items, the caches are %d bytes, " \
+                      "%d%% less than %d." % (count, new_size,
+                      100 - new_size * 100 / old_size, old_size)
+            else:
+                print "No items to archive."
+
+        elif command == "export":
+            for lines in planet.bulk.map_channels(planet.bulk.export, paths):
+                sys.stdout.write(lines)
+        sys.exit(0)
 
     # Open the cache file directly to get the URL it represents
     try:
-        db = dbhash.open(cache_file)
-        url = db["url"]
+        db = planet.cache.open_dbhash(cache_file, "r")
+        url = db.read(None)["url"][1]
         db.close()
     except dbhash.bsddb._db.DBError, e:
         print >>sys.stderr, cache_file + ":", e.args[1]
@@ -129,6 +404,9 @@ if __name__ == "__main__":
     # Now do it the right way :-)
     my_planet = planet.Planet(ConfigParser.ConfigParser())
     my_planet.cache_directory = os.path.dirname(cache_file)
+    if command not in ("hide", "unhide"):
+        # archived items are shown too, but can't be changed
+        my_planet.archive = 1
     channel = planet.Channel(my_planet, url)
 
     for item_id in ids:
@@ -154,6 +432,8 @@ if __name__ == "__main__":
                 print "         " + fit_str(item.title, 70)
             if hasattr(item, "hidden"):
                 print "         (hidden)"
+            if channel._cache.archived(item.cache_id()):
+                print "         (archived)"
 
     elif command == "keys":
         keys = {}
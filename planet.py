@@ -51,6 +51,8 @@ def config_get(config, section, option, default=None, raw=0, vars=None):
 def main():
     config_file = CONFIG_FILE
     offline = 0
+    render = 0
+    archive = 0
     verbose = 0
 
     for arg in sys.argv[1:]:
@@ -60,6 +62,8 @@ def main():
             print "Options:"
             print " -v, --verbose       DEBUG level logging during update"
             print " -o, --offline       Update the Planet from the cache only"
+            print " -r, --render        Generate the Planet from the cache export only"
+            print " -a, --archive       Generate the Planet with the archived items too"
             print " -h, --help          Display this help message and exit"
             print
             sys.exit(0)
@@ -67,6 +71,10 @@ def main():
             verbose = 1
         elif arg == "-o" or arg == "--offline":
             offline = 1
+        elif arg == "-r" or arg == "--render":
+            render = 1
+        elif arg == "-a" or arg == "--archive":
+            archive = 1
         elif arg.startswith("-"):
             print >>sys.stderr, "Unknown option:", arg
             sys.exit(1)
@@ -91,6 +99,10 @@ def main():
     else:
         log_level  = config_get(config, "Planet", "log_level", LOG_LEVEL)
     feed_timeout   = config_get(config, "Planet", "feed_timeout", FEED_TIMEOUT)
+    loose_parser   = config_get(config, "Planet", "loose_parser",
+                                planet.feedparser.LOOSE_PARSER)
+    sanitizer      = config_get(config, "Planet", "sanitizer",
+                                planet.sanitize.ENGINE)
     template_files = config_get(config, "Planet", "template_files",
                                 TEMPLATE_FILES).split(" ")
 
@@ -141,7 +153,7 @@ def main():
             log.warning("Feed timeout set to invalid value '%s', skipping", feed_timeout)
             feed_timeout = None
 
-    if feed_timeout and not offline:
+    if feed_timeout and not offline and not render and not archive:
         try:
             from planet import timeoutsocket
             timeoutsocket.setDefaultSocketTimeout(feed_timeout)
@@ -155,9 +167,20 @@ def main():
             else:
                 log.error("Unable to set timeout to %d seconds", feed_timeout)
 
+    if loose_parser not in ("tolerant", "sgmllib"):
+        log.warning("Unknown loose_parser '%s', using tolerant", loose_parser)
+        loose_parser = "tolerant"
+    planet.feedparser.LOOSE_PARSER = loose_parser
+
+    if sanitizer not in ("fast", "sgmllib"):
+        log.warning("Unknown sanitizer '%s', using fast", sanitizer)
+        sanitizer = "fast"
+    planet.sanitize.ENGINE = sanitizer
+
     # run the planet
     my_planet = planet.Planet(config)
-    my_planet.run(planet_name, planet_link, template_files, offline)
+    my_planet.run(planet_name, planet_link, template_files, offline, render,
+                  archive)
 
     my_planet.generate_all_files(template_files, planet_name,
         planet_link, planet_feed, owner_name, owner_email)
@@ -33,8 +33,14 @@ import os
 import hashlib
 import time
 import dbhash
+import marshal
 import re
 
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
 try: 
     from xml.sax.saxutils import escape
 except:
@@ -50,9 +56,58 @@ USER_AGENT = VERSION + " " + feedparser.USER_AGENT
 # Default cache directory
 CACHE_DIRECTORY = "cache"
 
+# Default way of storing the cache: "dbhash" or "gdbm" for a file per
+# channel, "sqlite" for a single database, named below, in the cache
+# directory, or "memory" to keep it for the run only
+CACHE_BACKEND = "dbhash"
+SQLITE_CACHE_FILENAME = "cache.db"
+
 # Default number of items to display from a new feed
 NEW_FEED_ITEMS = 10
 
+# Default age in days and number of items beyond which cached items are
+# expired, 0 to keep them all
+CACHE_MAX_AGE = 0
+CACHE_MAX_ITEMS = 0
+
+# Default age in days beyond which cached items are moved out of the cache
+# into the channel's archive (see cache.Archive), 0 to keep them all cached
+CACHE_ARCHIVE_AGE = 0
+
+# Default number of words of content to keep in the plain text excerpt
+EXCERPT_WORDS = 50
+
+# Default size in bytes above which HTML is truncated, 0 for no limit,
+# and what truncated content and summaries end with instead
+MAX_CONTENT_BYTES = 0
+READ_MORE = ' <a class="read-more" href="%s">Read more&#8230;</a>'
+
+# Name of the file in the cache directory parsed feeds are kept in,
+# with parse_cache = persistent
+PARSE_CACHE_FILENAME = "parse_cache"
+
+# Name of the file in the cache directory sanitized HTML is kept in, and
+# the default number of results to keep there (sanitize_cache_size)
+SANITIZE_CACHE_FILENAME = "sanitize_cache"
+SANITIZE_CACHE_SIZE = 10000
+
+# Name of the file in the cache directory the item index is kept in
+# between runs (see Snapshot)
+SNAPSHOT_FILENAME = "snapshot"
+
+# Default number of channel cache files kept open at once, 0 for no limit
+CACHE_HANDLES = 256
+
+# Name of the file in the cache directory listing the channels whose cache
+# writes haven't been synced yet (see Journal), and the default number of
+# channels written between syncs, 0 to only sync at the end of the run
+JOURNAL_FILENAME = "journal"
+CACHE_COMMIT_INTERVAL = 0
+
+# Default for whether to write a read-only export of the cache after each
+# run, for rendering from (see cache.Export)
+CACHE_EXPORT = 0
+
 # Useful common date/time formats
 TIMEFMT_ISO = "%Y-%m-%dT%H:%M:%S+00:00"
 TIMEFMT_822 = "%a, %d %b %Y %H:%M:%S +0000"
@@ -74,15 +129,22 @@ DATE_FORMAT     = "%B %d, %Y %I:%M %p"
 NEW_DATE_FORMAT = "%B %d, %Y"
 ACTIVITY_THRESHOLD = 0
 
+# Number of consecutive failed strict parses after which a feed is parsed
+# with the loose parser straight away, and how often (in runs) to re-probe
+# the strict parser in case the feed has been fixed
+LOOSE_THRESHOLD = 3
+LOOSE_REPROBE   = 10
+
 class stripHtml(sgmllib.SGMLParser):
     "remove all tags from the data"
     def __init__(self, data):
         sgmllib.SGMLParser.__init__(self)
-        self.result=''
+        self.pieces=[]
         self.feed(data)
         self.close()
+        self.result=''.join(self.pieces)
     def handle_data(self, data):
-        if data: self.result+=data
+        if data: self.pieces.append(data)
 
 def template_info(item, date_format):
     """Produce a dictionary of template information."""
@@ -95,12 +157,351 @@ def template_info(item, date_format):
             info[key + "_822"] = time.strftime(TIMEFMT_822, date)
         else:
             info[key] = item[key]
-    if 'title' in item.keys():
+    # title_plain is stored when the item is updated, but not by older
+    # versions of Planet
+    if 'title' in item.keys() and 'title_plain' not in item.keys():
         info['title_plain'] = stripHtml(info['title']).result
 
     return info
 
 
+def fingerprint(entry, settings=None):
+    """Return a digest of the raw fields of a feedparser entry.
+
+    The settings given, anything else the item made from the entry
+    depends on, are digested along with them.
+    """
+    digest = hashlib.md5()
+    def walk(value):
+        if isinstance(value, dict):
+            keys = value.keys()
+            keys.sort()
+            digest.update("{")
+            for key in keys:
+                digest.update(cache.utf8(key) + ":")
+                walk(value[key])
+            digest.update("}")
+        elif isinstance(value, (list, tuple)):
+            digest.update("[")
+            for item in value:
+                walk(item)
+            digest.update("]")
+        elif isinstance(value, (str, unicode)):
+            value = cache.utf8(value)
+            digest.update("%d:%s" % (len(value), value))
+        else:
+            digest.update(repr(value))
+    walk(entry)
+    if settings is not None:
+        walk(settings)
+    return digest.hexdigest()
+
+
+class Statistics:
+    """Counters for a single run.
+
+    Anything can add to a named counter, integers for things counted and
+    floats for seconds; Planet.run resets them at the start and logs them
+    at the end.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Zero all the counters."""
+        self.counters = {}
+
+    def add(self, name, value=1):
+        """Add the value to the named counter."""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def get(self, name):
+        """Return the value of the named counter."""
+        return self.counters.get(name, 0)
+
+    def report(self, log):
+        """Log the value of each counter."""
+        names = self.counters.keys()
+        names.sort()
+        for name in names:
+            value = self.counters[name]
+            if isinstance(value, float):
+                log.info("%s: %.3fs", name, value)
+            else:
+                log.info("%s: %d", name, value)
+
+# Statistics for the current run
+stats = Statistics()
+
+
+class ParseCache:
+    """Parsed feeds, keyed by a digest of the document and all its parse
+    depends on (see feedparser.parse).
+
+    This is given to feedparser.parse() so that a feed subscribed to under
+    several URLs is only parsed once.  If a filename is given the results
+    are kept there between runs as well, for as long as the document is
+    the one last fetched for a channel.  The file is only kept locked
+    while it's used, as other processes may be using it too.
+    """
+    def __init__(self, filename=None):
+        self._results = {}
+        self._seen = {}
+        if filename:
+            self._db = cache.LockedDB(filename)
+        else:
+            self._db = None
+
+    def has_key(self, digest):
+        """Check whether the document has been parsed before."""
+        if self._results.has_key(digest):
+            return 1
+        if self._db is None:
+            return 0
+        found = self._db.has_key(digest)
+        self._db.release()
+        return found
+
+    def __getitem__(self, digest):
+        if not self._results.has_key(digest):
+            self._results[digest] = pickle.loads(self._db[digest])
+            self._db.release()
+        self._seen[digest] = 1
+        stats.add("parse_cache_hits")
+        return self._results[digest]
+
+    def __setitem__(self, digest, result):
+        self._results[digest] = result
+        self._seen[digest] = 1
+        if self._db is not None:
+            result = result.copy()
+            if result.has_key("bozo_exception"):
+                del(result["bozo_exception"])
+            try:
+                self._db[digest] = pickle.dumps(result, 2)
+            except pickle.PicklingError:
+                log.debug("Unable to store parsed document %s", digest)
+            self._db.sync()
+            self._db.release()
+
+    def close(self, digests=None):
+        """Drop the documents neither seen this run nor in digests, the
+        url_digest of every channel, and close the file.
+
+        Nothing is dropped if digests isn't given, as after a run that
+        didn't fetch the feeds.
+        """
+        if self._db is None:
+            return
+        if digests is not None:
+            kept = {}
+            for digest in digests:
+                kept[digest] = 1
+            for key in self._db.keys():
+                # keys start with the document's digest, see feedparser
+                if not self._seen.has_key(key) \
+                       and not kept.has_key(key.split(" ")[0]):
+                    del(self._db[key])
+        self._db.close()
+        self._db = None
+
+
+class Snapshot:
+    """The item index of every channel, as it was at the end of a run.
+
+    This is kept in a marshal file so that the next run can pick the
+    newest items without reading the items of every channel from the
+    cache, only those it shows.  The index is a list of (date, order,
+    channel, id, hidden) tuples, newest first, where channel is the
+    cache_basename of the channel and date is in seconds since the epoch.
+    A channel's entries are only used while its cache_serial is still the
+    one they were taken at, and its items haven't been read since.
+    """
+    VERSION = 1
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.serials = {}
+        self.index = []
+        if filename is None or not os.path.exists(filename):
+            return
+
+        try:
+            data = marshal.load(open(filename, "rb"))
+            if data["version"] == self.VERSION:
+                self.serials = data["serials"]
+                self.index = data["index"]
+        except (EOFError, ValueError, TypeError, KeyError):
+            log.warning("Ignoring unreadable snapshot %s", filename)
+
+    def fresh(self, channel):
+        """Check whether the snapshot is up to date for the channel."""
+        return not channel.items_read() and \
+               self.serials.get(channel.cache_basename()) == \
+               channel.cache_serial
+
+    def write(self, channels):
+        """Take a new snapshot of the channels and write it to the file.
+
+        Entries of channels the snapshot is still fresh for are kept,
+        the others are taken from the channel's items.
+        """
+        kept = {}
+        for channel in channels:
+            if self.fresh(channel):
+                kept[channel.cache_basename()] = 1
+
+        index = [ entry for entry in self.index if kept.has_key(entry[2]) ]
+        serials = {}
+        for channel in channels:
+            name = channel.cache_basename()
+            serials[name] = channel.cache_serial
+            if kept.has_key(name):
+                continue
+            for item in channel.items(hidden=1):
+                index.append((item.date_epoch(), item.order, name, item.id,
+                              int(item.has_key("hidden"))))
+        index.sort()
+        index.reverse()
+        self.index = index
+        self.serials = serials
+
+        if self.filename is not None:
+            new_filename = "%s.new.%d" % (self.filename, os.getpid())
+            output_fd = open(new_filename, "wb")
+            marshal.dump({ "version": self.VERSION, "serials": serials,
+                           "index": index }, output_fd)
+            output_fd.close()
+            os.rename(new_filename, self.filename)
+
+
+class Journal:
+    """Channels whose cache writes haven't been synced to disk yet.
+
+    Rather than each channel syncing its cache as soon as it's written,
+    channels are added to the journal and their caches synced together by
+    commit(), once interval channels have been added and at the end of the
+    run.  Until then their names are kept in a journal file of the run's
+    own, locked while the run goes on.  A journal file left by a run that
+    was interrupted can be locked, and the next run takes over the names
+    in it as interrupted: those caches may have lost writes, and stay in
+    its journal file until they've been written and synced again.
+    """
+    def __init__(self, filename, interval=0):
+        self.filename = "%s.%d" % (filename, os.getpid())
+        self.interval = interval
+        self.channels = []
+        self.interrupted = {}
+        self._fd = None
+
+        directory, prefix = os.path.split(filename)
+        if not os.path.isdir(directory):
+            return
+        left = []
+        for name in os.listdir(directory):
+            if name != prefix and not name.startswith(prefix + "."):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                input_fd = open(path, "r+")
+            except IOError:
+                # taken over by a run in another process
+                continue
+            if cache.fcntl is not None:
+                try:
+                    cache.fcntl.flock(input_fd.fileno(),
+                                      cache.fcntl.LOCK_EX | cache.fcntl.LOCK_NB)
+                except IOError:
+                    # still in use by a run in another process
+                    input_fd.close()
+                    continue
+                try:
+                    removed = os.stat(path).st_ino != \
+                              os.fstat(input_fd.fileno()).st_ino
+                except OSError:
+                    removed = 1
+                if removed:
+                    # taken over by a run in another process since opened
+                    input_fd.close()
+                    continue
+            for name in input_fd.read().split("\n"):
+                if name:
+                    self.interrupted[name] = 1
+            left.append((path, input_fd))
+        if self.interrupted:
+            self.write()
+        for path, input_fd in left:
+            if path != self.filename:
+                os.remove(path)
+            input_fd.close()
+
+    def write(self):
+        """Write the names of the interrupted channels, and those added
+        since the last commit, to the journal file."""
+        if self._fd is None:
+            # made under another name and locked before it's renamed, so
+            # another run never finds it unlocked and takes it over
+            directory, name = os.path.split(self.filename)
+            new_filename = os.path.join(directory, "." + name)
+            self._fd = open(new_filename, "w")
+            if cache.fcntl is not None:
+                cache.fcntl.flock(self._fd.fileno(), cache.fcntl.LOCK_EX)
+            os.rename(new_filename, self.filename)
+        self._fd.seek(0)
+        self._fd.truncate()
+        names = self.interrupted.copy()
+        for channel in self.channels:
+            names[channel.cache_basename()] = 1
+        self._fd.write("".join([ name + "\n" for name in names.keys() ]))
+        self._fd.flush()
+
+    def add(self, channel):
+        """Note that the channel is about to write to its cache.
+
+        The channels added before it are committed first if there are
+        interval of them.
+        """
+        if self.interval and len(self.channels) >= self.interval:
+            self.commit()
+        if self._fd is None:
+            self.write()
+        self._fd.write(channel.cache_basename() + "\n")
+        self._fd.flush()
+        self.channels.append(channel)
+
+    def commit(self):
+        """Sync the caches of the channels added since the last commit."""
+        if not self.channels:
+            return
+
+        start = time.time()
+        synced = {}
+        for channel in self.channels:
+            self.interrupted.pop(channel.cache_basename(), None)
+            # channels kept in SQLite share a connection, commit it once
+            db = channel._cache._db
+            if not synced.has_key(id(db)):
+                channel._cache.sync()
+                synced[id(db)] = 1
+                stats.add("cache_syncs")
+            channel.cache_release()
+        self.channels = []
+        self.write()
+        stats.add("cache_commits")
+        stats.add("cache_commit_time", time.time() - start)
+
+    def close(self):
+        """Commit, and remove the journal file unless channels are still
+        to be recovered."""
+        self.commit()
+        if self._fd is None:
+            return
+        if not self.interrupted:
+            os.remove(self.filename)
+        self._fd.close()
+        self._fd = None
+
+
 class Planet:
     """A set of channels.
 
@@ -110,9 +511,25 @@ class Planet:
     Properties:
         user_agent      User-Agent header to fetch feeds with.
         cache_directory Directory to store cached channels in.
+        cache_backend   How to store them, "dbhash", "gdbm", "sqlite" or
+                        "memory".
+        cache_max_age   Age in days after which cached items are expired.
+        cache_max_items Number of newest items kept in each channel's cache.
+        cache_archive_age Age in days after which cached items are archived.
+        cache_export    Whether to write a read-only export of the cache.
+        cache_commit_interval Number of channels written between syncs.
+        cache_handles   Number of channel cache files kept open at once.
         new_feed_items  Number of items to display from a new feed.
+        excerpt_words   Number of words of content in each item's excerpt.
+        max_content_bytes Size in bytes above which HTML is truncated.
         filter          A regular expression that articles must match.
         exclude         A regular expression that articles must not match.
+        parse_cache     Parsed feeds shared between channels (ParseCache).
+        sanitize_cache  Sanitized HTML kept between runs (SanitizeCache).
+        snapshot        Item index of the channels (Snapshot).
+        export          Export the channels are read from when rendering.
+        archive         Whether archived items are read too, to render them.
+        journal         Channels whose caches are still to be synced.
     """
     def __init__(self, config):
         self.config = config
@@ -121,9 +538,24 @@ class Planet:
 
         self.user_agent = USER_AGENT
         self.cache_directory = CACHE_DIRECTORY
+        self.cache_backend = CACHE_BACKEND
+        self.cache_max_age = CACHE_MAX_AGE
+        self.cache_max_items = CACHE_MAX_ITEMS
+        self.cache_archive_age = CACHE_ARCHIVE_AGE
+        self.cache_export = CACHE_EXPORT
+        self.cache_commit_interval = CACHE_COMMIT_INTERVAL
+        self.cache_handles = CACHE_HANDLES
         self.new_feed_items = NEW_FEED_ITEMS
+        self.excerpt_words = EXCERPT_WORDS
+        self.max_content_bytes = MAX_CONTENT_BYTES
         self.filter = None
         self.exclude = None
+        self.parse_cache = ParseCache()
+        self.sanitize_cache = None
+        self.snapshot = None
+        self.export = None
+        self.archive = 0
+        self.journal = None
 
     def tmpl_config_get(self, template, option, default=None, raw=0, vars=None):
         """Get a template value from the configuration, with a default."""
@@ -217,19 +649,110 @@ class Planet:
 
         return items_list
 
-    def run(self, planet_name, planet_link, template_files, offline = False):
+    def run(self, planet_name, planet_link, template_files, offline = False,
+            render = False, archive = False):
+        """Load the channels and, unless offline, update them.
+
+        When render is true the channels are read from the export of the
+        cache written by the last run with cache_export set, and nothing
+        is written, so any number of processes can render at once.  When
+        archive is true the archived items of the channels are read along
+        with the cached ones, and the channels aren't updated.
+        """
         log = logging.getLogger("planet.runner")
 
+        stats.reset()
+
         # Create a planet
         log.info("Loading cached data")
         if self.config.has_option("Planet", "cache_directory"):
             self.cache_directory = self.config.get("Planet", "cache_directory")
+        if self.config.has_option("Planet", "cache_backend"):
+            self.cache_backend = self.config.get("Planet", "cache_backend")
+        if self.cache_backend not in ("dbhash", "gdbm", "sqlite", "memory"):
+            log.warning("Unknown cache_backend '%s', using dbhash",
+                        self.cache_backend)
+            self.cache_backend = "dbhash"
+        elif self.cache_backend == "sqlite" and cache.sqlite3 is None:
+            log.error("sqlite3 module not found, using dbhash cache_backend")
+            self.cache_backend = "dbhash"
+        elif self.cache_backend == "gdbm" and cache.gdbm is None:
+            log.error("gdbm module not found, using dbhash cache_backend")
+            self.cache_backend = "dbhash"
+        if self.config.has_option("Planet", "cache_max_age"):
+            self.cache_max_age = float(self.config.get("Planet",
+                                                       "cache_max_age"))
+        if self.config.has_option("Planet", "cache_max_items"):
+            self.cache_max_items = int(self.config.get("Planet",
+                                                       "cache_max_items"))
+        if self.config.has_option("Planet", "cache_archive_age"):
+            self.cache_archive_age = float(self.config.get("Planet",
+                "cache_archive_age"))
+        if self.cache_archive_age and cache.zlib is None:
+            log.error("zlib module not found, not archiving items")
+            self.cache_archive_age = 0
+        if self.config.has_option("Planet", "cache_export"):
+            self.cache_export = self.config.getboolean("Planet",
+                                                       "cache_export")
+        if self.config.has_option("Planet", "cache_commit_interval"):
+            self.cache_commit_interval = int(self.config.get("Planet",
+                "cache_commit_interval"))
+        if self.config.has_option("Planet", "cache_handles"):
+            self.cache_handles = int(self.config.get("Planet",
+                                                     "cache_handles"))
+        cache.handles.size = self.cache_handles
+        cache.handles.reset()
         if self.config.has_option("Planet", "new_feed_items"):
             self.new_feed_items  = int(self.config.get("Planet", "new_feed_items"))
+        if self.config.has_option("Planet", "excerpt_words"):
+            self.excerpt_words = int(self.config.get("Planet", "excerpt_words"))
+        if self.config.has_option("Planet", "max_content_bytes"):
+            self.max_content_bytes = int(self.config.get("Planet",
+                                                         "max_content_bytes"))
         self.user_agent = "%s +%s %s" % (planet_name, planet_link,
                                               self.user_agent)
         if self.config.has_option("Planet", "filter"):
             self.filter = self.config.get("Planet", "filter")
+        if archive:
+            offline = True
+            self.archive = 1
+        if render:
+            offline = True
+            try:
+                self.export = cache.Export(self.cache_directory)
+            except (IOError, OSError, EOFError, ValueError, TypeError,
+                    KeyError):
+                log.warning("No export of the cache in %s, reading the cache",
+                            self.cache_directory)
+        if self.config.has_option("Planet", "parse_cache") \
+               and self.config.get("Planet", "parse_cache") == "persistent" \
+               and not render:
+            if not os.path.isdir(self.cache_directory):
+                os.makedirs(self.cache_directory)
+            self.parse_cache = ParseCache(os.path.join(self.cache_directory,
+                                                       PARSE_CACHE_FILENAME))
+        if self.config.has_option("Planet", "sanitize_cache_size"):
+            sanitize_cache_size = int(self.config.get("Planet",
+                                                      "sanitize_cache_size"))
+        else:
+            sanitize_cache_size = SANITIZE_CACHE_SIZE
+        if sanitize_cache_size and sanitize.sqlite3 is not None \
+               and not render:
+            if not os.path.isdir(self.cache_directory):
+                os.makedirs(self.cache_directory)
+            self.sanitize_cache = sanitize.SanitizeCache(
+                os.path.join(self.cache_directory, SANITIZE_CACHE_FILENAME),
+                sanitize_cache_size)
+        if not archive:
+            self.snapshot = Snapshot(os.path.join(self.cache_directory,
+                                                  SNAPSHOT_FILENAME))
+        if not offline:
+            self.journal = Journal(os.path.join(self.cache_directory,
+                                                JOURNAL_FILENAME),
+                                   self.cache_commit_interval)
+            if self.journal.interrupted:
+                log.warning("Last run was interrupted, fetching %d feeds "
+                            "in full", len(self.journal.interrupted))
 
         # The other configuration blocks are channels to subscribe to
         for feed_url in self.config.sections():
@@ -237,8 +760,26 @@ class Planet:
                 continue
 
             # Create a channel, configure it and subscribe it
-            channel = Channel(self, feed_url)
+            interrupted = self.journal is not None and \
+                self.journal.interrupted.has_key(cache.filename("", feed_url))
+            if interrupted:
+                self.recover_cache(feed_url)
+            try:
+                channel = Channel(self, feed_url)
+            except KeyboardInterrupt:
+                raise
+            except:
+                # such as a cache written with another cache_backend
+                log.exception("Cache of <%s> can't be opened with "
+                              "cache_backend %s, skipping the feed (see "
+                              "planet-cache --migrate)", feed_url,
+                              self.cache_backend)
+                continue
             self.subscribe(channel)
+            if interrupted:
+                # the cache may have lost items the feed won't send again
+                channel.url_etag = None
+                channel.url_modified = None
 
             # Update it
             try:
@@ -248,6 +789,65 @@ class Planet:
                 raise
             except:
                 log.exception("Update of <%s> failed", feed_url)
+            channel.cache_release()
+
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if offline:
+            self.parse_cache.close()
+        else:
+            self.parse_cache.close([ channel.url_digest for channel
+                                     in self.channels(hidden=1, sorted=0)
+                                     if channel.has_key("url_digest") ])
+        if self.sanitize_cache is not None:
+            stats.add("sanitize_cache_hits", self.sanitize_cache.hits)
+            stats.add("sanitize_cache_misses", self.sanitize_cache.misses)
+            self.sanitize_cache.close()
+            self.sanitize_cache = None
+        if os.path.isdir(self.cache_directory) and not (render or archive):
+            self.snapshot.write(self.channels(hidden=1, sorted=0))
+            if self.cache_export:
+                cache.write_export(self.cache_directory,
+                    [ (channel.cache_basename(), channel.cache_serial,
+                       channel._cache)
+                      for channel in self.channels(hidden=1, sorted=0) ])
+        stats.add("cache_handles_opened", cache.handles.opened)
+        stats.add("cache_handles_evicted", cache.handles.evicted)
+        self.report_duplicates()
+        stats.report(log)
+
+    def recover_cache(self, feed_url):
+        """Move the channel's cache aside if it can't be read any more."""
+        if self.cache_backend == "sqlite":
+            return
+        cache_filename = cache.filename(self.cache_directory, feed_url)
+        if not os.path.exists(cache_filename):
+            return
+        try:
+            cache.open_dbhash(cache_filename, "r",
+                              cache.BACKENDS[self.cache_backend]).close()
+        except KeyboardInterrupt:
+            raise
+        except:
+            log.error("Cache of <%s> is unreadable, moved to %s.broken",
+                      feed_url, cache_filename)
+            os.rename(cache_filename, cache_filename + ".broken")
+
+    def report_duplicates(self):
+        """Log the channels whose feeds are identical."""
+        log = logging.getLogger("planet.runner")
+        digests = {}
+        for channel in self.channels(hidden=1, sorted=0):
+            if channel.has_key("url_digest"):
+                digests.setdefault(channel.url_digest, []).append(channel)
+
+        for channels in digests.values():
+            if len(channels) < 2:
+                continue
+            log.warning("Identical feeds: %s", ", ".join(
+                [ "<%s>" % c.configured_url for c in channels ]))
+            stats.add("duplicate_feeds", len(channels) - 1)
 
     def generate_all_files(self, template_files, planet_name,
                 planet_link, planet_feed, owner_name, owner_email):
@@ -366,9 +966,8 @@ class Planet:
 
         The sharp-eyed will note that this looks a little strange code-wise,
         it turns out that Python gets *really* slow if we try to sort the
-        actual items themselves.  Also we use mktime here, but it's ok
-        because we discard the numbers and just need them to be relatively
-        consistent between each other.
+        actual items themselves, so we sort on the dates in seconds since
+        the epoch each item keeps.
         """
         planet_filter_re = None
         if self.filter:
@@ -380,18 +979,34 @@ class Planet:
         items = []
         seen_guids = {}
         if not channels: channels=self.channels(hidden=hidden, sorted=0)
+
+        # Without filters the newest items can be read off the snapshot
+        # taken at the end of the run, or the timeline index of an SQLite
+        # cache, rather than sorting every item
+        indexed = sorted and channels \
+                  and not (planet_filter_re or planet_exclude_re) \
+                  and not [ c for c in channels if c.filter or c.exclude ]
+        if indexed and self.snapshot is not None \
+               and not [ c for c in channels if not self.snapshot.fresh(c) ]:
+            items = self.snapshot_items(channels, hidden, max_items)
+            channels = []
+        elif indexed and isinstance(channels[0]._cache, cache.SQLiteCache):
+            items = self.timeline_items(channels, hidden, max_items)
+            channels = []
+        else:
+            indexed = 0
+
         for channel in channels:
+            channel_filter_re = None
+            if channel.filter:
+                channel_filter_re = re.compile(channel.filter, re.I)
+            channel_exclude_re = None
+            if channel.exclude:
+                channel_exclude_re = re.compile(channel.exclude, re.I)
+
             for item in channel._items.values():
                 if hidden or not item.has_key("hidden"):
 
-                    channel_filter_re = None
-                    if channel.filter:
-                        channel_filter_re = re.compile(channel.filter,
-                                                       re.I)
-                    channel_exclude_re = None
-                    if channel.exclude:
-                        channel_exclude_re = re.compile(channel.exclude,
-                                                        re.I)
                     if (planet_filter_re or planet_exclude_re \
                         or channel_filter_re or channel_exclude_re):
                         title = ""
@@ -419,12 +1034,13 @@ class Planet:
                             or channel_exclude_re.search(content)):
                             continue
 
-                    if not seen_guids.has_key(item.id):
-                        seen_guids[item.id] = 1;
-                        items.append((time.mktime(item.date), item.order, item))
+                    guid = item.id
+                    if not seen_guids.has_key(guid):
+                        seen_guids[guid] = 1;
+                        items.append((item.date_epoch(), item.order, item))
 
         # Sort the list
-        if sorted:
+        if sorted and not indexed:
             items.sort()
             items.reverse()
 
@@ -445,6 +1061,57 @@ class Planet:
 
         return [ i[-1] for i in items ]
 
+    def snapshot_items(self, channels, hidden=0, max_items=0):
+        """Return the newest items of the channels from the snapshot.
+
+        Returns a list of (date, order, item) tuples like the one items()
+        sorts, read in order from the snapshot until there are max_items
+        of them.  Only those items are read from the channels' caches.
+        """
+        by_name = {}
+        for channel in channels:
+            by_name[channel.cache_basename()] = channel
+
+        items = []
+        seen_guids = {}
+        for date, order, name, id_, item_hidden in self.snapshot.index:
+            if not by_name.has_key(name) or seen_guids.has_key(id_):
+                continue
+            if hidden or not item_hidden:
+                seen_guids[id_] = 1
+                items.append((date, order, by_name[name].load_item(id_)))
+                if len(items) == max_items:
+                    break
+
+        return items
+
+    def timeline_items(self, channels, hidden=0, max_items=0):
+        """Return the newest items of the channels from the SQLite cache.
+
+        Returns a list of (date, order, item) tuples like the one items()
+        sorts, read in order from the timeline index until there are
+        max_items of them.
+        """
+        by_name = {}
+        for channel in channels:
+            by_name[channel._cache.channel] = channel
+
+        items = []
+        seen_guids = {}
+        for name, id_, date, order in channels[0]._cache.timeline(hidden):
+            if not by_name.has_key(name):
+                continue
+            item = by_name[name]._items.get(id_)
+            if item is None or seen_guids.has_key(item.id):
+                continue
+            if hidden or not item.has_key("hidden"):
+                seen_guids[item.id] = 1
+                items.append((date, order, item))
+                if len(items) == max_items:
+                    break
+
+        return items
+
 class Channel(cache.CachedInfo):
     """A list of news items.
 
@@ -456,9 +1123,13 @@ class Channel(cache.CachedInfo):
         url_etag        E-Tag of the feed URL.
         url_modified    Last modified time of the feed URL.
         url_status      Last HTTP status of the feed URL.
+        url_digest      SHA-1 digest of the feed last fetched from the URL.
         hidden          Channel should be hidden (True if exists).
         name            Name of the feed owner, or feed title.
+        title_plain     Title with any HTML markup removed (*).
         next_order      Next order number to be assigned to NewsItem
+        strict_failures Number of consecutive runs the feed wasn't well-formed.
+        strict_time     Seconds the last failed strict parse took.
 
         updated         Correct UTC-Normalised update time of the feed.
         last_updated    Correct UTC-Normalised time the feed was last updated.
@@ -489,6 +1160,21 @@ class Channel(cache.CachedInfo):
 
         filter          A regular expression that articles must match.
         exclude         A regular expression that articles must not match.
+        max_content_bytes Size in bytes above which HTML is truncated,
+                        overriding Planet.max_content_bytes.
+        cache_max_age   Age in days after which items are expired,
+                        overriding Planet.cache_max_age.
+        cache_max_items Number of newest items kept, overriding
+                        Planet.cache_max_items.
+        cache_archive_age Age in days after which items are archived,
+                        overriding Planet.cache_archive_age.
+        expired_ids     Ids of expired or archived items the feed still
+                        carries, one per line, so they aren't added again.
+        cache_serial    Number changed each time items, or the channel's own
+                        fields, are written to the cache, to tell whether a
+                        Snapshot or the export is up to date.
+        deleted_items   Number of items deleted since the cache was last
+                        compacted.
 
     Properties marked (*) will only be present if the original feed
     contained them.  Note that the optional 'modified' date field is simply
@@ -503,12 +1189,24 @@ class Channel(cache.CachedInfo):
     def __init__(self, planet, url):
         if not os.path.isdir(planet.cache_directory):
             os.makedirs(planet.cache_directory)
-        cache_filename = cache.filename(planet.cache_directory, url)
-        cache_file = dbhash.open(cache_filename, "c", 0666)
+        if planet.export is not None:
+            cache_file = planet.export.channel(cache.filename("", url))
+        elif planet.cache_backend == "sqlite":
+            cache_file = cache.SQLiteCache(
+                os.path.join(planet.cache_directory, SQLITE_CACHE_FILENAME),
+                cache.filename("", url))
+        else:
+            cache_filename = cache.filename(planet.cache_directory, url)
+            cache_file = cache.open_dbhash(cache_filename,
+                backend=cache.BACKENDS[planet.cache_backend])
+        if planet.archive:
+            cache_file = cache.ArchiveCache(cache_file, cache.Archive(
+                cache.archive_filename(planet.cache_directory,
+                                       cache.filename("", url))))
 
         cache.CachedInfo.__init__(self, cache_file, url, root=1)
 
-        self._items = {}
+        self._loaded = {}
         self._planet = planet
         self._expired = []
         self.url = url
@@ -522,9 +1220,18 @@ class Channel(cache.CachedInfo):
         self.last_updated = None
         self.filter = None
         self.exclude = None
+        self.max_content_bytes = None
+        self.cache_max_age = None
+        self.cache_max_items = None
+        self.cache_archive_age = None
+        self.expired_ids = ""
+        self.deleted_items = "0"
+        self.cache_serial = "0"
         self.next_order = "0"
+        self.strict_failures = "0"
+        self.strict_time = "0"
         self.cache_read()
-        self.cache_read_entries()
+        self.cache_release()
 
         if planet.config.has_section(url):
             for option in planet.config.options(url):
@@ -539,15 +1246,35 @@ class Channel(cache.CachedInfo):
         """Return the item from the channel."""
         return self._items[id_]
 
+    def load_item(self, id_):
+        """Return the item, reading only it from the cache if the items
+        haven't been read yet."""
+        if self.items_read():
+            return self._items[id_]
+        if not self._loaded.has_key(id_):
+            self._loaded[id_] = NewsItem(self, id_)
+        return self._loaded[id_]
+
+    def items_read(self):
+        """Check whether the items have been read from the cache."""
+        return self.__dict__.has_key("_items")
+
     # Special methods
     __contains__ = has_item
 
+    def __getattr__(self, key):
+        # The items are only read from the cache once they're needed
+        if key == "_items":
+            self.cache_read_entries()
+            return self._items
+        return cache.CachedInfo.__getattr__(self, key)
+
     def items(self, hidden=0, sorted=0):
         """Return the item list."""
         items = []
         for item in self._items.values():
             if hidden or not item.has_key("hidden"):
-                items.append((time.mktime(item.date), item.order, item))
+                items.append((item.date_epoch(), item.order, item))
 
         if sorted:
             items.sort()
@@ -561,27 +1288,161 @@ class Channel(cache.CachedInfo):
 
     def cache_read_entries(self):
         """Read entry information from the cache."""
-        keys = self._cache.keys()
-        for key in keys:
-            if key.find(" ") != -1: continue
+        self._items = {}
+        for key in self._cache.ids():
             if self.has_key(key): continue
 
-            item = NewsItem(self, key)
+            if self._loaded.has_key(key):
+                item = self._loaded[key]
+            else:
+                item = NewsItem(self, key)
             self._items[key] = item
 
     def cache_basename(self):
         return cache.filename('',self._id)
 
+    def cache_lock(self):
+        """Lock the cache against other processes for writing.
+
+        If another process has it locked, the journal is committed first,
+        so that this process doesn't hold the caches of other channels
+        while it waits.
+        """
+        if not self._cache.lock(exclusive=1, blocking=0):
+            if self._planet.journal is not None:
+                self._planet.journal.commit()
+            self._cache.lock(exclusive=1)
+
+    def cache_refresh(self):
+        """Read the cache again, as another process has written to it."""
+        self.cache_read()
+        if self.items_read():
+            del(self.__dict__["_items"])
+        self._loaded = {}
+        self._expired = []
+        stats.add("caches_refreshed")
+
     def cache_write(self, sync=1):
-        """Write channel and item information to the cache."""
-        for item in self._items.values():
-            item.cache_write(sync=0)
+        """Write changed channel and item information to the cache.
+
+        Items past the channel's expiry limits are removed first (see
+        expire_items), and those old enough are moved to its archive (see
+        archive_items).  Once more items have been deleted since the cache
+        was last compacted than it still holds, it's compacted again.
+        While the planet has a journal, the cache is synced when the journal
+        is committed rather than straight away.
+        """
+        self.cache_lock()
+        self.expire_items()
+        self.archive_items()
+        journal = self._planet.journal
+        if sync and journal is not None:
+            journal.add(self)
+
+        if self.items_read():
+            items = self._items.values()
+        else:
+            items = self._loaded.values()
+        # the export copies the channel's own fields along with its items
+        changed = len(self._expired) or len(self._dirty)
+        for item in items:
+            written = item.cache_write(sync=0)
+            if written:
+                changed = 1
+                stats.add("cache_items_written")
+                stats.add("cache_keys_written", written)
         for item in self._expired:
             item.cache_clear(sync=0)
-        cache.CachedInfo.cache_write(self, sync)
+            stats.add("cache_items_deleted")
+        if changed:
+            self.cache_serial = str(int(self.cache_serial) + 1)
+
+        compact = 0
+        if self._expired:
+            deleted = int(self.deleted_items) + len(self._expired)
+            if sync and deleted > len(self._items):
+                deleted = 0
+                compact = 1
+            self.deleted_items = str(deleted)
+        written = cache.CachedInfo.cache_write(self,
+                                               sync and journal is None)
+        stats.add("cache_keys_written", written)
+        if sync and journal is None:
+            stats.add("cache_syncs")
+        if compact:
+            self._cache.compact()
+            stats.add("caches_compacted")
+        if sync and journal is None:
+            self.cache_release()
 
         self._expired = []
 
+    def expire_items(self):
+        """Expire items older than cache_max_age days, or past the newest
+        cache_max_items.
+
+        The limits set for the channel override the planet's.  Expired
+        items are remembered in expired_ids, so they aren't added back
+        while the feed still carries them.
+        """
+        max_age = self._planet.cache_max_age
+        if self.cache_max_age is not None:
+            max_age = float(self.cache_max_age)
+        max_items = self._planet.cache_max_items
+        if self.cache_max_items is not None:
+            max_items = int(self.cache_max_items)
+        if not max_age and not max_items:
+            return
+
+        oldest = time.time() - max_age * 86400
+        expired_ids = self.expired_ids.split("\n")
+        count = 0
+        for item in self.items(hidden=1, sorted=1):
+            count += 1
+            if (max_items and count > max_items) \
+                   or (max_age and item.date_epoch() < oldest):
+                del(self._items[item.id])
+                self._expired.append(item)
+                expired_ids.append(item.id)
+                stats.add("items_expired")
+                log.debug("Expired item <%s>", item.id)
+
+        self.expired_ids = "\n".join([ id_ for id_ in expired_ids if id_ ])
+
+    def archive_items(self):
+        """Move items older than cache_archive_age days out of the cache,
+        into the channel's archive (see cache.Archive).
+
+        The limit set for the channel overrides the planet's.  Archived
+        items are remembered in expired_ids, as expired ones are.  The
+        archive is written before the items are deleted from the cache.
+        """
+        max_age = self._planet.cache_archive_age
+        if self.cache_archive_age is not None:
+            max_age = float(self.cache_archive_age)
+        if not max_age or isinstance(self._cache, cache.ArchiveCache):
+            return
+
+        oldest = time.time() - max_age * 86400
+        archived = [ item for item in self.items(hidden=1, sorted=0)
+                     if item.date_epoch() < oldest ]
+        if not archived:
+            return
+        archive = cache.Archive(cache.archive_filename(
+            self._planet.cache_directory, self.cache_basename()))
+        archive.append([ (item.cache_id(), item.cache_fields())
+                         for item in archived ])
+
+        expired_ids = self.expired_ids.split("\n")
+        for item in archived:
+            del(self._items[item.id])
+            self._expired.append(item)
+            expired_ids.append(item.id)
+            stats.add("items_archived")
+            log.debug("Archived item <%s>", item.id)
+
+        self.expired_ids = "\n".join([ id_ for id_ in expired_ids if id_ ])
+
     def feed_information(self):
         """
         Returns a description string for the feed embedded in this channel.
@@ -604,9 +1465,38 @@ class Channel(cache.CachedInfo):
         This does the actual work of pulling down the feed and if it changes
         updates the cached information about the feed and entries within it.
         """
+        if self._planet.sanitize_cache is not None:
+            sanitize_html = self._planet.sanitize_cache.HTML
+        else:
+            sanitize_html = sanitize.HTML
+
+        # only content and summaries are truncated, titles and the like
+        # are sanitized in full
+        max_bytes = self.content_limit()
+        def content_sanitizer(htmlSource, encoding, baseuri):
+            return sanitize_html(htmlSource, encoding, baseuri, max_bytes)
+
+        failures = int(self.strict_failures)
+        strict = failures < LOOSE_THRESHOLD or not failures % LOOSE_REPROBE
         info = feedparser.parse(self.url,
                                 etag=self.url_etag, modified=self.url_modified,
-                                agent=self._planet.user_agent)
+                                agent=self._planet.user_agent,
+                                profile=self.IGNORE_KEYS + NewsItem.IGNORE_KEYS,
+                                strict=strict,
+                                results=self._planet.parse_cache,
+                                sanitizer=sanitize_html,
+                                content_sanitizer=content_sanitizer,
+                                sanitizer_version="%s %d" % (
+                                    sanitize.version(), max_bytes))
+
+        # Another process may have updated the feed while it was fetched
+        self.cache_lock()
+        if self._cache.changed():
+            log.info("Cache of %s changed, reading it again",
+                     self.feed_information())
+            self.cache_refresh()
+
+        self.update_parser_mode(info, strict)
         if info.has_key("status"):
            self.url_status = str(info.status)
         elif info.has_key("entries") and len(info.entries)>0:
@@ -650,10 +1540,56 @@ class Channel(cache.CachedInfo):
             log.debug("Last Modified: %s",
                       time.strftime(TIMEFMT_ISO, self.url_modified))
 
+        if info.has_key("digest"):
+            self.url_digest = info.digest
+
         self.update_info(info.feed)
         self.update_entries(info.entries)
         self.cache_write()
 
+    def content_limit(self):
+        """Return the size in bytes above which HTML is truncated, the
+        channel's max_content_bytes or else the planet's."""
+        if self.max_content_bytes is not None:
+            return int(self.max_content_bytes)
+        return self._planet.max_content_bytes
+
+    def entry_settings(self):
+        """Return the settings items are made from entries with, for their
+        fingerprint: the excerpt length, the HTML size limit and the
+        sanitizer's version and engine."""
+        return (self._planet.excerpt_words, self.content_limit(),
+                sanitize.version())
+
+    def update_parser_mode(self, info, strict):
+        """Learn whether the feed is worth parsing strictly.
+
+        Counts the consecutive runs the strict parser failed, or was
+        skipped, so update() can go straight to the loose parser once
+        a feed has been broken for a while.  Only the feed itself counts:
+        an HTTP error page, which is rarely well-formed, is left out.
+        """
+        if info.has_key("status") and not 200 <= info.status < 400:
+            # Error page, not the feed
+            pass
+        elif info.has_key("strict_parse_time"):
+            stats.add("strict_parses")
+            if info.has_key("loose_parse_time"):
+                self.strict_failures = str(int(self.strict_failures) + 1)
+                self.strict_time = "%f" % info.strict_parse_time
+                stats.add("strict_parse_failures")
+            else:
+                self.strict_failures = "0"
+        elif not strict and info.has_key("loose_parse_time"):
+            log.debug("Skipped strict parse of %s", self.feed_information())
+            self.strict_failures = str(int(self.strict_failures) + 1)
+            stats.add("strict_parses_skipped")
+            stats.add("strict_parse_time_saved", float(self.strict_time))
+        if info.has_key("loose_parse_time"):
+            stats.add("loose_parse_time", info.loose_parse_time)
+        if info.has_key("strict_parse_time"):
+            stats.add("strict_parse_time", info.strict_parse_time)
+
     def update_info(self, feed):
         """Update information from the feed.
 
@@ -698,19 +1634,23 @@ class Channel(cache.CachedInfo):
             elif isinstance(feed[key], (str, unicode)):
                 # String fields
                 try:
+                    value = feed[key]
                     detail = key + '_detail'
                     if feed.has_key(detail) and feed[detail].has_key('type'):
-                        if feed[detail].type == 'text/html':
-                            feed[key] = sanitize.HTML(feed[key])
-                        elif feed[detail].type == 'text/plain':
-                            feed[key] = escape(feed[key])
-                    self.set_as_string(key, feed[key])
+                        # HTML has already been sanitized by feedparser
+                        if feed[detail].type == 'text/plain':
+                            value = escape(value)
+                    self.set_as_string(key, value)
                 except KeyboardInterrupt:
                     raise
                 except:
                     log.exception("Ignored '%s' of <%s>, unknown format",
                                   key, self.url)
 
+        if feed.has_key("title"):
+            self.set_as_string("title_plain",
+                               stripHtml(self.get_as_string("title")).result)
+
     def update_entries(self, entries):
         """Update entries from the feed.
 
@@ -732,8 +1672,14 @@ class Channel(cache.CachedInfo):
         self.last_updated = self.updated
         self.updated = time.gmtime()
 
+        expired_ids = {}
+        for id_ in self.expired_ids.split("\n"):
+            expired_ids[id_] = 1
+        still_expired = []
+
         new_items = []
         feed_items = []
+        settings = self.entry_settings()
         for entry in entries:
             # Try really hard to find some kind of unique identifier
             if entry.has_key("id"):
@@ -750,14 +1696,29 @@ class Channel(cache.CachedInfo):
                 log.error("Unable to find or generate id, entry ignored")
                 continue
 
-            # Create the item if necessary and update
+            # Don't add back items expired while the feed still has them
+            if expired_ids.has_key(entry_id) and not self.has_item(entry_id):
+                still_expired.append(entry_id)
+                continue
+
+            # Create the item if necessary and update, unless the entry
+            # and the settings are exactly as they were last time (items
+            # cached before the plain text fields were stored are updated
+            # once to add them)
+            entry_fingerprint = fingerprint(entry, settings)
             if self.has_item(entry_id):
                 item = self._items[entry_id]
             else:
                 item = NewsItem(self, entry_id)
                 self._items[entry_id] = item
                 new_items.append(item)
-            item.update(entry)
+            if item.has_key("fingerprint") and item.has_key("word_count") \
+                   and item.fingerprint == entry_fingerprint:
+                stats.add("entries_unchanged")
+            else:
+                item.update(entry)
+                item.fingerprint = entry_fingerprint
+                stats.add("entries_updated")
             feed_items.append(entry_id)
 
             # Hide excess items the first time through
@@ -766,6 +1727,9 @@ class Channel(cache.CachedInfo):
                 item.hidden = "yes"
                 log.debug("Marked <%s> as hidden (new feed)", entry_id)
 
+        # Forget the expired items the feed no longer has
+        self.expired_ids = "\n".join(still_expired)
+
         # Assign order numbers in reverse
         new_items.reverse()
         for item in new_items:
@@ -804,11 +1768,17 @@ class NewsItem(cache.CachedInfo):
         date            Corrected UTC-Normalised update time, for sorting.
         order           Order in which items on the same date can be sorted.
         hidden          Item should be hidden (True if exists).
+        fingerprint     Digest of the feed entry the item was last updated from.
 
         title           One-line title (*).
+        title_plain     Title with any HTML markup removed (*).
         link            Link to the original format text (*).
         summary         Short first-page summary (*).
+        summary_bytes   Size of the summary before it was truncated (*).
         content         Full HTML content.
+        content_bytes   Size of the content before it was truncated (*).
+        excerpt         First words of the content as plain text.
+        word_count      Number of words in the content.
 
         modified        Date the item claims to have been modified (*).
         issued          Date the item claims to have been issued (*).
@@ -833,19 +1803,27 @@ class NewsItem(cache.CachedInfo):
     IGNORE_KEYS = ("categories", "contributors", "enclosures", "links",
                    "guidislink", "date", "tags")
 
+    # Keys read from the cache when the item is created, enough to select
+    # and sort items (get_date looks at the dates the item claims too); the
+    # rest, content and all, are read when first used
+    INDEX_KEYS = ("id", "date", "order", "hidden", "updated", "modified",
+                  "published", "issued", "created")
+
     def __init__(self, channel, id_):
         cache.CachedInfo.__init__(self, channel._cache, id_)
 
         self._channel = channel
+        self._date_updated = None
         self.id = id_
         self.id_hash = hashlib.md5(id_).hexdigest()
         self.date = None
         self.order = None
         self.content = None
-        self.cache_read()
+        self.cache_read(self.INDEX_KEYS)
 
     def update(self, entry):
         """Update the item from the feedparser entry given."""
+        self._date_updated = None
         for key in entry.keys():
             if key in self.IGNORE_KEYS or key + "_parsed" in self.IGNORE_KEYS:
                 # Ignored fields
@@ -880,36 +1858,68 @@ class NewsItem(cache.CachedInfo):
                 # Content field: concatenate the values
                 value = ""
                 for item in entry[key]:
-                    if item.type == 'text/html':
-                        item.value = sanitize.HTML(item.value)
-                    elif item.type == 'text/plain':
-                        item.value = escape(item.value)
+                    item_value = item.value
+                    if item.type == 'text/plain':
+                        item_value = escape(item_value)
                     if item.has_key('language') and item.language and \
                        (not self._channel.has_key('language') or
                        item.language != self._channel.language) :
                         self.set_as_string(key + "_language", item.language)
-                    value += cache.utf8(item.value)
+                    value += cache.utf8(item_value)
                 self.set_as_string(key, value)
             elif isinstance(entry[key], (str, unicode)):
                 # String fields
                 try:
+                    value = entry[key]
                     detail = key + '_detail'
                     if entry.has_key(detail):
                         if entry[detail].has_key('type'):
-                            if entry[detail].type == 'text/html':
-                                entry[key] = sanitize.HTML(entry[key])
-                            elif entry[detail].type == 'text/plain':
-                                entry[key] = escape(entry[key])
-                    self.set_as_string(key, entry[key])
+                            # HTML has already been sanitized by feedparser
+                            if entry[detail].type == 'text/plain':
+                                value = escape(value)
+                    self.set_as_string(key, value)
                 except KeyboardInterrupt:
                     raise
                 except:
                     log.exception("Ignored '%s' of <%s>, unknown format",
                                   key, self.id)
 
+        # Link truncated HTML to the full item, and note how big it was
+        for key in ("content", "summary"):
+            if self.has_key(key) and self.key_type(key) == self.STRING:
+                value, size = sanitize.truncated(self.get_as_string(key))
+                if size is None:
+                    continue
+                if self.has_key("link"):
+                    link = escape(self.get_as_string("link"))
+                    value += READ_MORE % link.replace('"', "&quot;")
+                self.set_as_string(key, value)
+                self.set_as_string(key + "_bytes", str(size))
+                stats.add("content_truncated")
+                log.info("Truncated %s of <%s> from %d bytes", key, self.id,
+                         size)
+
         # Generate the date field if we need to
         self.get_date("date")
 
+        # Plain text versions of the title and content, so templates don't
+        # need to parse HTML every time they're generated
+        self.update_plain_text()
+
+    def update_plain_text(self):
+        """Update the plain text fields derived from the title and content."""
+        if self.has_key("title"):
+            self.set_as_string("title_plain",
+                               stripHtml(self.get_as_string("title")).result)
+
+        words = stripHtml(self.get_content("content")).result.split()
+        excerpt_words = self._channel._planet.excerpt_words
+        excerpt = " ".join(words[:excerpt_words])
+        if len(words) > excerpt_words:
+            excerpt += " ..."
+        self.set_as_string("excerpt", excerpt)
+        self.set_as_string("word_count", str(len(words)))
+
     def get_date(self, key):
         """Get (or update) the date key.
 
@@ -923,25 +1933,39 @@ class NewsItem(cache.CachedInfo):
         entries appear in posting sequence but don't overlap entries
         added in previous updates and don't creep into the next one.
         """
+        self.date_epoch(key)
+        return self.get_as_date(key)
+
+    def date_epoch(self, key="date"):
+        """Get (or update) the date key in seconds since the epoch.
+
+        This is what get_date returns, without making a time tuple of it.
+        The answer only changes when the item or the channel is updated,
+        so it's kept until then.
+        """
+        updated = self._channel.get_as_epoch("updated")
+        if self._date_updated == updated and self._dates.has_key(key):
+            return self._dates[key][0]
+        self._date_updated = updated
 
         for other_key in ("updated", "modified", "published", "issued", "created"):
             if self.has_key(other_key):
-                date = self.get_as_date(other_key)
+                date = self.get_as_epoch(other_key)
                 break
         else:
             date = None
 
         if date is not None:
-            if date > self._channel.updated:
-                date = self._channel.updated
+            if date > updated:
+                date = updated
 #            elif date < self._channel.last_updated:
 #                date = self._channel.updated
         elif self.has_key(key) and self.key_type(key) != self.NULL:
-            return self.get_as_date(key)
+            return self.get_as_epoch(key)
         else:
-            date = self._channel.updated
+            date = updated
 
-        self.set_as_date(key, date)
+        self.set_as_epoch(key, date)
         return date
 
     def get_content(self, key):
@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Benchmarks of the cache backends, archiving and the HTML sanitizer.
+
+Replays a run's worth of cache use against each cache_backend: loading
+the channels, updating them a few times over and rendering the newest
+items, as planet does it.  The channels of an existing cache are used if
+one is given, otherwise made up ones.  The replay is done in a directory
+made in the cache directory, so it runs on the same storage.
+
+The upgrade benchmark writes the channels to dbhash caches in the original
+layout and gives their size before and after cache.upgrade rewrites them
+in the compact one.
+
+The archiving benchmark writes the channels to dbhash caches, and times a
+scan of every item's index keys, as loading the channels does, before and
+after moving the items older than a number of days into the archives.
+
+The listing benchmark writes the channels to dbhash caches, with their
+dates in the format caches had before they were kept as seconds since the
+epoch and in that one, and times loading them into a planet, which works
+out the items' dates, and Planet.items over them, which sorts on those
+dates, against sorting on time.mktime of the items' date tuples as
+Planet.items used to.
+
+The sanitizer benchmark times each sanitizer engine over the HTML of real
+feeds, as they give it before it's sanitized, or over that kept in a
+cache.
+"""
+
+import os
+import time
+import ConfigParser
+import shutil
+import tempfile
+
+import planet
+import bulk
+import cache
+import feedparser
+import sanitize
+
+# Size of the made up channels used when there's no cache to replay:
+# the number of channels, of items in each, and of bytes of content
+CHANNELS = 50
+ITEMS = 100
+CONTENT_BYTES = 2048
+
+# Number of times each channel is updated, and the number of new items
+# each update brings (and of old ones it expires)
+ROUNDS = 3
+NEW_ITEMS = 5
+
+# Number of items rendered
+RENDER_ITEMS = 60
+
+# Size of the made up channels Planet.items is timed over when there's no
+# cache to list: the number of channels, of items in each, and of bytes of
+# content
+LISTING_CHANNELS = 20
+LISTING_ITEMS = 5000
+LISTING_CONTENT_BYTES = 256
+
+# Number of times the caches are scanned before and after archiving; the
+# quickest scan is taken
+SCAN_ROUNDS = 3
+
+# Sanitizer engines compared, and the number of times the HTML is
+# sanitized by each
+ENGINES = ("sgmllib", "fast")
+SANITIZE_ROUNDS = 5
+
+# Fields of cached items whose HTML is sanitized
+HTML_KEYS = ("title", "summary", "content")
+
+
+def read_channels(directory):
+    """Return the channels of the dbhash cache in the directory.
+
+    Each is a (name, fields, items) tuple, where items is a list of
+    (id, fields) tuples.  Files that aren't channel caches are skipped.
+    """
+    channels = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            continue
+        try:
+            store = cache.open_dbhash(path, "r")
+            fields = store.read(None)
+        except KeyboardInterrupt:
+            raise
+        except:
+            continue
+
+        try:
+            if fields.has_key("url"):
+                channels.append((name, fields,
+                                 [ (id_, store.read(id_))
+                                   for id_ in store.ids() ]))
+        finally:
+            store.close()
+
+    return channels
+
+def make_channels(count=CHANNELS, length=ITEMS,
+                  content_bytes=CONTENT_BYTES):
+    """Return made up channels, as read_channels does."""
+    now = int(time.time())
+    channels = []
+    for channel in range(count):
+        url = "http://example.com/%d/feed" % channel
+        fields = { "url": (cache.CachedInfo.STRING, url),
+                   "name": (cache.CachedInfo.STRING, "Channel %d" % channel),
+                   "updated": (cache.CachedInfo.DATE, str(now)),
+                   "cache_serial": (cache.CachedInfo.STRING, "1") }
+        items = []
+        for item in range(length):
+            id_ = "%s/%d" % (url, item)
+            date = now - (channel * length + item) * 3600
+            items.append((id_, make_item(id_, date, item, content_bytes)))
+        channels.append((cache.filename("", url), fields, items))
+
+    return channels
+
+def make_item(id_, date, order, content_bytes=CONTENT_BYTES):
+    """Return the fields of a made up item."""
+    return { "id": (cache.CachedInfo.STRING, id_),
+             "link": (cache.CachedInfo.STRING, id_),
+             "title": (cache.CachedInfo.STRING, "Item %d" % order),
+             "date": (cache.CachedInfo.DATE, str(date)),
+             "updated": (cache.CachedInfo.DATE, str(date)),
+             "order": (cache.CachedInfo.STRING, str(order)),
+             "content": (cache.CachedInfo.STRING, "x" * content_bytes),
+             "summary": (cache.CachedInfo.STRING, "x" * (content_bytes / 8)) }
+
+def item_epoch(fields):
+    """Return the date of the item in seconds since the epoch."""
+    if fields.has_key("date"):
+        return cache.epoch(fields["date"][1])
+    return 0
+
+def open_store(backend, directory, name):
+    """Open the cache of the channel, as Channel does."""
+    if backend == "sqlite":
+        return cache.SQLiteCache(os.path.join(directory,
+                                              planet.SQLITE_CACHE_FILENAME),
+                                 name)
+    else:
+        return cache.open_dbhash(os.path.join(directory, name),
+                                 backend=cache.BACKENDS[backend])
+
+def replay(backend, directory, channels):
+    """Replay the workload with the backend in the directory.
+
+    Returns a dictionary of the seconds taken to load, update and render
+    the channels, and the size in bytes of the files left.
+    """
+    results = {}
+
+    start = time.time()
+    for name, fields, items in channels:
+        store = open_store(backend, directory, name)
+        store.write(None, fields)
+        for id_, item in items:
+            store.write(id_, item)
+        store.sync()
+        store.close()
+    results["load"] = time.time() - start
+
+    start = time.time()
+    for round in range(ROUNDS):
+        for name, fields, items in channels:
+            store = open_store(backend, directory, name)
+            store.lock(exclusive=1)
+            fields = store.read(None)
+            dates = []
+            for id_ in store.ids():
+                item, others = store.read_keys(id_,
+                                               planet.NewsItem.INDEX_KEYS)
+                dates.append((item_epoch(item), id_))
+            dates.sort()
+
+            newest = dates and dates[-1][0] or 0
+            for new in range(NEW_ITEMS):
+                id_ = "%s/%d/%d" % (name, round, new)
+                store.write(id_, make_item(id_, newest + new + 1, new))
+            for date, id_ in dates[:NEW_ITEMS]:
+                store.delete(id_)
+            store.write_keys(None, { "cache_serial":
+                (cache.CachedInfo.STRING, str(round + 2)) }, [])
+            store.sync()
+            store.close()
+    results["update"] = time.time() - start
+
+    start = time.time()
+    dates = []
+    stores = {}
+    for name, fields, items in channels:
+        store = stores[name] = open_store(backend, directory, name)
+        store.read(None)
+        for id_ in store.ids():
+            item, others = store.read_keys(id_, planet.NewsItem.INDEX_KEYS)
+            dates.append((item_epoch(item), name, id_))
+    dates.sort()
+    dates.reverse()
+    for date, name, id_ in dates[:RENDER_ITEMS]:
+        stores[name].read(id_)
+    for store in stores.values():
+        store.close()
+    results["render"] = time.time() - start
+
+    size = 0
+    for path, dirs, files in os.walk(directory):
+        for name in files:
+            size += os.path.getsize(os.path.join(path, name))
+    results["size"] = size
+
+    return results
+
+def backends():
+    """Return the names of the backends that can be used here."""
+    names = cache.BACKENDS.keys()
+    if cache.sqlite3 is not None:
+        names.append("sqlite")
+    names.sort()
+    return names
+
+def run(directory, channels=None, names=None):
+    """Replay the workload with each backend, in the cache directory.
+
+    Returns a list of (backend, results) tuples, with the results replay
+    returns.  The channels of the cache are used unless others are given,
+    or made up ones if it has none.
+    """
+    if channels is None:
+        channels = read_channels(directory)
+    if not channels:
+        channels = make_channels()
+    if names is None:
+        names = backends()
+
+    results = []
+    for name in names:
+        work_directory = tempfile.mkdtemp(prefix="benchmark-", dir=directory)
+        try:
+            results.append((name, replay(name, work_directory, channels)))
+        finally:
+            shutil.rmtree(work_directory)
+            memory = cache.BACKENDS["memory"]
+            for filename in memory.files.keys():
+                if filename.startswith(work_directory):
+                    del(memory.files[filename])
+
+    return results
+
+
+def upgrading(directory, channels=None):
+    """Rewrite the channels in the compact format, in the cache directory.
+
+    The channels are written to dbhash caches in the original layout, in
+    a directory made in the cache directory, and rewritten there with
+    cache.upgrade.  Returns the number of caches rewritten and their size
+    in bytes before and after.  The channels of the cache are used unless
+    others are given, or made up ones if it has none.
+    """
+    if channels is None:
+        channels = read_channels(directory)
+    if not channels:
+        channels = make_channels()
+
+    work_directory = tempfile.mkdtemp(prefix="benchmark-", dir=directory)
+    try:
+        for name, fields, items in channels:
+            store = cache.DBCache(cache.dbhash.open(
+                os.path.join(work_directory, name), "n", 0666))
+            store.write(None, fields)
+            for id_, item in items:
+                store.write(id_, item)
+            store.close()
+
+        upgraded = cache.upgrade(work_directory)
+    finally:
+        shutil.rmtree(work_directory)
+
+    return (len(upgraded), sum([ old for name, old, new in upgraded ]),
+            sum([ new for name, old, new in upgraded ]))
+
+def scan(paths, rounds=SCAN_ROUNDS):
+    """Return the seconds the quickest of the rounds took to read the
+    index keys of every item in the channel caches."""
+    best = None
+    for round in range(rounds):
+        start = time.time()
+        for path in paths:
+            store = cache.open_dbhash(path, "r")
+            try:
+                store.read(None)
+                for id_ in store.ids():
+                    store.read_keys(id_, planet.NewsItem.INDEX_KEYS)
+            finally:
+                store.close()
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+
+    return best
+
+def tier(paths):
+    """Return a dictionary of the number of items in the channel caches,
+    their size and the size of their archives in bytes, and the seconds
+    a scan of them takes."""
+    results = { "items": 0, "size": 0, "archive_size": 0 }
+    for path in paths:
+        stats = bulk.stats(path)
+        results["items"] += stats["items"]
+        results["size"] += stats["bytes"]
+        results["archive_size"] += stats["archive_bytes"]
+    results["scan"] = scan(paths)
+    return results
+
+def archiving(directory, days, channels=None):
+    """Archive the items older than days, in the cache directory.
+
+    The channels are written to dbhash caches in a directory made in the
+    cache directory, and archived there with bulk.archive.  Returns the
+    (before, after) results of tier.  The channels of the cache are used
+    unless others are given, or made up ones if it has none.
+    """
+    if channels is None:
+        channels = read_channels(directory)
+    if not channels:
+        channels = make_channels()
+
+    work_directory = tempfile.mkdtemp(prefix="benchmark-", dir=directory)
+    try:
+        paths = []
+        for name, fields, items in channels:
+            path = os.path.join(work_directory, name)
+            store = cache.open_dbhash(path)
+            store.write(None, fields)
+            for id_, item in items:
+                store.write(id_, item)
+            store.sync()
+            store.close()
+            paths.append(path)
+
+        before = tier(paths)
+        for path in paths:
+            bulk.archive(path, days)
+        after = tier(paths)
+    finally:
+        shutil.rmtree(work_directory)
+
+    return before, after
+
+
+def old_dates(fields):
+    """Return the fields with their dates in the format caches had before
+    they were kept as seconds since the epoch."""
+    old = {}
+    for key, (type_, value) in fields.items():
+        if type_ == cache.CachedInfo.DATE:
+            value = " ".join([ str(part) for part in
+                               time.gmtime(cache.epoch(value)) ])
+        old[key] = (type_, value)
+    return old
+
+def listing(directory, channels=None, max_items=RENDER_ITEMS):
+    """Time Planet.items over the channels, in the cache directory.
+
+    For each format of dates, the old time tuples and seconds since the
+    epoch, the channels are written to dbhash caches in a directory made
+    in the cache directory and loaded into a planet, offline.  Returns a
+    list of (format, items, load, listing, mktime) tuples: the number of
+    items, the seconds loading them took, which works out their dates,
+    the seconds Planet.items took, and the seconds sorting the items on
+    time.mktime of their date tuples, as Planet.items used to, took.  The
+    channels of the cache are used unless others are given, or made up
+    ones if it has none.
+    """
+    if channels is None:
+        channels = read_channels(directory)
+    if not channels:
+        channels = make_channels(LISTING_CHANNELS, LISTING_ITEMS,
+                                 LISTING_CONTENT_BYTES)
+
+    results = []
+    for format in ("tuple", "epoch"):
+        work_directory = tempfile.mkdtemp(prefix="benchmark-", dir=directory)
+        try:
+            config = ConfigParser.ConfigParser()
+            config.add_section("Planet")
+            config.set("Planet", "cache_directory", work_directory)
+            config.set("Planet", "sanitize_cache_size", "0")
+            for name, fields, items in channels:
+                store = cache.open_dbhash(os.path.join(work_directory, name))
+                if format == "tuple":
+                    store.write(None, old_dates(fields))
+                    for id_, item in items:
+                        store.write(id_, old_dates(item))
+                else:
+                    store.write(None, fields)
+                    for id_, item in items:
+                        store.write(id_, item)
+                store.sync()
+                store.close()
+                config.add_section(fields["url"][1])
+
+            start = time.time()
+            my_planet = planet.Planet(config)
+            my_planet.run("benchmark", "http://example.com", [], offline=1)
+            load = time.time() - start
+            # List the items themselves, not those of the snapshot
+            my_planet.snapshot = None
+
+            start = time.time()
+            my_planet.items(max_items=max_items)
+            seconds = time.time() - start
+
+            items = my_planet.items(sorted=0)
+            count = len(items)
+            start = time.time()
+            items = [ (time.mktime(item.date), item.order, item)
+                      for item in items ]
+            items.sort()
+            items.reverse()
+            mktime = time.time() - start
+
+            results.append((format, count, load, seconds, mktime))
+        finally:
+            shutil.rmtree(work_directory)
+
+    return results
+
+
+def read_html(sources):
+    """Return the HTML of the feeds or cache directories given.
+
+    Returns a list of (html, encoding, baseuri) tuples, the arguments
+    sanitize.HTML is called with.  The HTML of a feed, a file or URL, is
+    taken before it's sanitized; that of a cache directory's channels has
+    been sanitized already, but is what planet has aggregated.
+    """
+    corpus = []
+    def keep(html, encoding, baseuri):
+        corpus.append((html, encoding, baseuri))
+        return html
+
+    for source in sources:
+        if os.path.isdir(source):
+            for name, fields, items in read_channels(source):
+                baseuri = fields.get("link", (None, None))[1]
+                for id_, item in items:
+                    for key in HTML_KEYS:
+                        if item.has_key(key):
+                            corpus.append((item[key][1], "utf-8", baseuri))
+        else:
+            feedparser.parse(source, sanitizer=keep)
+
+    return corpus
+
+def sanitize_engines(corpus, engines=ENGINES, rounds=SANITIZE_ROUNDS):
+    """Sanitize the HTML of read_html with each engine.
+
+    Returns a list of (engine, seconds, bytes per second, differences)
+    tuples, where differences is the number of inputs the engine gives
+    other output for than the first.
+    """
+    size = 0
+    for html, encoding, baseuri in corpus:
+        if type(html) == type(u''):
+            html = html.encode("utf-8")
+        size += len(html)
+
+    results = []
+    expected = None
+    old_engine = sanitize.ENGINE
+    try:
+        for engine in engines:
+            sanitize.ENGINE = engine
+            start = time.time()
+            for round in range(rounds):
+                output = [ sanitize.HTML(html, encoding, baseuri)
+                           for html, encoding, baseuri in corpus ]
+            seconds = time.time() - start
+
+            if expected is None:
+                expected = output
+            differences = len([ 1 for a, b in zip(expected, output)
+                                if a != b ])
+            results.append((engine, seconds,
+                            seconds and size * rounds / seconds or 0,
+                            differences))
+    finally:
+        sanitize.ENGINE = old_engine
+
+    return results
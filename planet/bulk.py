@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Bulk operations on a cache directory.
+
+The channel caches of a directory are worked on directly, a record at a
+time, without building Channel and NewsItem objects; and several at once,
+one per process, so a large cache can be gone through quickly.  Only the
+dbhash caches are worked on, as with cache.migrate and cache.upgrade.
+
+Channels are exported as JSON, one line per record: the channel's own
+fields first, with an id of null, then those of each of its items, then
+those of its archived items (see cache.Archive), marked "archived".  Each
+field is given as a [type, value] pair.
+"""
+
+import os
+import time
+
+try:
+    import json
+except:
+    json = None
+
+try:
+    import multiprocessing
+except:
+    multiprocessing = None
+
+import cache
+
+# Number of processes the channels are shared out between; None for one
+# per processor
+PROCESSES = None
+
+
+def channel_files(directory):
+    """Return the paths of the channel caches in the directory.
+
+    Files that aren't channel caches are skipped.
+    """
+    paths = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            continue
+        try:
+            store = cache.open_dbhash(path, "r")
+        except KeyboardInterrupt:
+            raise
+        except:
+            continue
+
+        try:
+            try:
+                if store.read(None).has_key("url"):
+                    paths.append(path)
+            except KeyboardInterrupt:
+                raise
+            except:
+                pass
+        finally:
+            store.close()
+
+    paths.sort()
+    return paths
+
+def map_channels(func, paths, processes=None, args=()):
+    """Call func with each of the paths, and args, in as many processes
+    at once.
+
+    Yields the results as they come, in the order of the paths; the paths
+    are only gone through one at a time if multiprocessing is missing or
+    there's just the one process.
+    """
+    if processes is None:
+        processes = PROCESSES
+    calls = [ (func, path, args) for path in paths ]
+    if multiprocessing is None or processes == 1 or len(paths) < 2:
+        for call in calls:
+            yield call_channel(call)
+        return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(call_channel, calls):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def call_channel(call):
+    """Call func with the path and args of the (func, path, args) call,
+    for map_channels."""
+    func, path, args = call
+    return func(path, *args)
+
+def stats(path):
+    """Return the statistics of the channel cache.
+
+    Returns a dictionary of the name of the file, the channel's url, the
+    number of items, the size in bytes and the dates of the oldest and
+    newest items in seconds since the epoch (None if there are none); and
+    the number of archived items and the size of the archive.
+    """
+    store = cache.open_dbhash(path, "r")
+    try:
+        url = store.read_keys(None, ["url"])[0].get("url", (None, None))[1]
+        ids = store.ids()
+        dates = []
+        for id_ in ids:
+            fields, others = store.read_keys(id_, ["date"])
+            if fields.has_key("date"):
+                dates.append(cache.epoch(fields["date"][1]))
+    finally:
+        store.close()
+
+    oldest = newest = None
+    if dates:
+        oldest, newest = min(dates), max(dates)
+    archive = open_archive(path)
+    return { "name": os.path.basename(path),
+             "url": url,
+             "items": len(ids),
+             "bytes": os.path.getsize(path),
+             "oldest": oldest,
+             "newest": newest,
+             "archived": len(archive.read()),
+             "archive_bytes": archive.size() }
+
+def vacuum(path):
+    """Reclaim the space of deleted records in the channel cache.
+
+    Returns a (name, old size, new size) tuple.
+    """
+    store = cache.open_dbhash(path, "w")
+    try:
+        size = os.path.getsize(path)
+        store.lock(exclusive=1)
+        store.compact()
+    finally:
+        store.close()
+
+    return (os.path.basename(path), size, os.path.getsize(path))
+
+def open_archive(path):
+    """Return the Archive of the channel cache."""
+    return cache.Archive(cache.archive_filename(os.path.dirname(path),
+                                                os.path.basename(path)))
+
+def archive(path, days):
+    """Move the items older than days out of the channel cache into its
+    archive, as Channel.archive_items does, and compact the cache.
+
+    Returns a (name, items archived, old size, new size) tuple.
+    """
+    oldest = time.time() - days * 86400
+    store = cache.open_dbhash(path, "w")
+    try:
+        store.lock(exclusive=1)
+        size = os.path.getsize(path)
+        records = []
+        for id_ in store.ids():
+            fields, others = store.read_keys(id_, ["date"])
+            if fields.has_key("date") \
+                   and cache.epoch(fields["date"][1]) < oldest:
+                records.append((id_, store.read(id_)))
+
+        if records:
+            open_archive(path).append(records)
+
+            fields = store.read_keys(None, ["expired_ids", "cache_serial"])[0]
+            expired_ids = fields.get("expired_ids", (None, ""))[1].split("\n")
+            for id_, item in records:
+                store.delete(id_)
+                expired_ids.append(item.get("id", (None, id_))[1])
+            serial = int(fields.get("cache_serial", (None, "0"))[1]) + 1
+            store.write_keys(None, {
+                "expired_ids": (cache.CachedInfo.STRING,
+                    "\n".join([ id_ for id_ in expired_ids if id_ ])),
+                "cache_serial": (cache.CachedInfo.STRING, str(serial)),
+                "deleted_items": (cache.CachedInfo.STRING, "0") }, [])
+            store.sync()
+            store.compact()
+    finally:
+        store.close()
+
+    return (os.path.basename(path), len(records), size, os.path.getsize(path))
+
+def export_record(name, id_, fields, archived=0):
+    """Return the JSON line of the fields of an item, or the channel."""
+    data = {}
+    for key, (type_, value) in fields.items():
+        data[cache.utf8(key)] = [ type_, cache.utf8(value) ]
+    if id_ is not None:
+        id_ = cache.utf8(id_)
+    record = { "channel": name, "id": id_, "fields": data }
+    if archived:
+        record["archived"] = True
+    return json.dumps(record) + "\n"
+
+def export(path):
+    """Return the JSON lines of the channel cache, as a string."""
+    name = os.path.basename(path)
+    store = cache.open_dbhash(path, "r")
+    try:
+        lines = [ export_record(name, None, store.read(None)) ]
+        for id_ in store.ids():
+            lines.append(export_record(name, id_, store.read(id_)))
+    finally:
+        store.close()
+
+    for id_, fields in open_archive(path).read().items():
+        lines.append(export_record(name, id_, fields, archived=1))
+
+    return "".join(lines)
+
+def import_records(directory, lines):
+    """Write the exported JSON lines into the channel caches of the
+    directory.
+
+    Items are added to those already cached, replacing any of the same
+    id, and archived items appended to the channel's archive.  The lines
+    are read one at a time, and each channel's cache is kept open until a
+    line of another comes.  Each channel's cache_serial is then set past
+    both its own and the imported one, so snapshots and exports of the
+    channel are taken again.  Returns the number of channels and of items
+    written.
+    """
+    channels = items = 0
+    name = path = store = None
+    serial = 0
+    archived = []
+    try:
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record["channel"] != name:
+                if store is not None:
+                    import_close(path, store, archived, serial)
+                    store = None
+                    archived = []
+                name = record["channel"]
+                filename = os.path.basename(name.encode("utf-8"))
+                if not filename:
+                    raise ValueError("Not a channel cache name: %r" % name)
+                path = os.path.join(directory, filename)
+                store = cache.open_dbhash(path)
+                store.lock(exclusive=1)
+                serial = read_serial(store)
+
+            fields = {}
+            for key, (type_, value) in record["fields"].items():
+                fields[key.encode("utf-8")] = (type_.encode("utf-8"),
+                                               value.encode("utf-8"))
+            if record["id"] is None:
+                store.write(None, fields)
+                channels += 1
+            elif record.get("archived"):
+                archived.append((record["id"].encode("utf-8"), fields))
+                items += 1
+            else:
+                store.write(record["id"].encode("utf-8"), fields)
+                items += 1
+    finally:
+        if store is not None:
+            import_close(path, store, archived, serial)
+
+    return channels, items
+
+def read_serial(store):
+    """Return the cache_serial of the channel cache, 0 if it has none."""
+    fields = store.read_keys(None, ["cache_serial"])[0]
+    try:
+        return int(fields.get("cache_serial", (None, "0"))[1])
+    except ValueError:
+        return 0
+
+def import_close(path, store, archived, serial):
+    """Write the archived items imported for the channel cache to its
+    archive, set its cache_serial past serial and its own, and sync and
+    close the cache."""
+    try:
+        open_archive(path).append(archived)
+        serial = max(serial, read_serial(store)) + 1
+        store.write_keys(None, { "cache_serial":
+            (cache.CachedInfo.STRING, str(serial)) }, [])
+        store.sync()
+    finally:
+        store.close()
@@ -12,7 +12,66 @@ that the rest of the code can take the persistance for granted.
 
 import os
 import re
+import mmap
+import errno
+import weakref
+import time
+import dbhash
+import marshal
+import calendar
 
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+try:
+    from cStringIO import StringIO
+except:
+    from StringIO import StringIO
+
+# sqlite3 is needed for the SQLite cache (SQLiteCache)
+try:
+    import sqlite3
+except:
+    sqlite3 = None
+
+# fcntl is needed to lock caches against other processes (LockedDB)
+try:
+    import fcntl
+except:
+    fcntl = None
+
+# gdbm is needed for the gdbm cache backend (GDBMBackend)
+try:
+    import gdbm
+except:
+    gdbm = None
+
+# zlib is needed to archive old items (Archive)
+try:
+    import zlib
+except:
+    zlib = None
+
+# Name of the subdirectory of the cache directory the lock files of the
+# dbhash caches are kept in
+LOCK_DIRECTORY = "locks"
+
+# Kinds of lock (see FileLock)
+UNLOCKED = 0
+SHARED = 1
+EXCLUSIVE = 2
+
+# Names of the files of the read-only export of the cache (see Export):
+# its index, and its data, numbered by generation
+EXPORT_INDEX = "export.index"
+EXPORT_DATA = "export.data.%d"
+re_export_data = re.compile(r'^export\.data\.(\d+)$')
+
+# Name of the subdirectory of the cache directory the archives of old
+# items are kept in (see Archive)
+ARCHIVE_DIRECTORY = "archive"
 
 # Regular expressions to sanitise cache filenames
 re_url_scheme    = re.compile(r'^[^:]*://')
@@ -32,6 +91,14 @@ class CachedInfo:
     If you wish to support special fields you can derive a class off this
     and implement get_FIELD and set_FIELD functions which will be
     automatically called.
+
+    Dates are cached as seconds since the epoch, but given and returned
+    as time tuples, both of which are kept once worked out.
+
+    Only some of the keys need be read from the cache to begin with (see
+    cache_read), the rest are read the first time one of them is used.
+    Keys are marked dirty when they're changed, and only those are written
+    back by cache_write.
     """
     STRING = "string"
     DATE   = "date"
@@ -41,95 +108,109 @@ class CachedInfo:
         self._type = {}
         self._value = {}
         self._cached = {}
+        self._unread = {}
+        self._dirty = {}
+        self._dates = {}
 
         self._cache = cache
         self._id = id_.replace(" ", "%20")
         self._root = root
 
-    def cache_key(self, key):
-        """Return the cache key name for the given key."""
-        key = key.replace(" ", "_")
+    def cache_id(self):
+        """Return the id of the record in the cache, None for the root."""
         if self._root:
-            return key
+            return None
         else:
-            return self._id + " " + key
+            return self._id
 
-    def cache_read(self):
-        """Read information from the cache."""
-        if self._root:
-            keys_key = " keys"
-        else:
-            keys_key = self._id
+    def cache_read(self, keys=None):
+        """Read information from the cache.
 
-        if self._cache.has_key(keys_key):
-            keys = self._cache[keys_key].split(" ")
+        If a list of keys is given only those are read, the others in the
+        cache are left to be read by cache_read_rest when first needed.
+        """
+        if keys is None:
+            fields = self._cache.read(self.cache_id())
+            self._unread = {}
         else:
-            return
+            fields, others = self._cache.read_keys(self.cache_id(), keys)
+            for key in others:
+                if not self._cached.has_key(key) or self._cached[key]:
+                    self._unread[key] = 1
+                    if self._dirty.has_key(key):
+                        del(self._dirty[key])
+        self.cache_set_fields(fields)
 
-        for key in keys:
-            cache_key = self.cache_key(key)
+    def cache_read_rest(self):
+        """Read the keys cache_read left unread."""
+        keys = self._unread.keys()
+        self._unread = {}
+        fields, others = self._cache.read_keys(self.cache_id(), keys)
+        self.cache_set_fields(fields)
+
+    def cache_set_fields(self, fields):
+        """Set the keys read from the cache."""
+        for key, (type_, value) in fields.items():
             if not self._cached.has_key(key) or self._cached[key]:
                 # Key either hasn't been loaded, or is one for the cache
-                self._value[key] = self._cache[cache_key]
-                self._type[key] = self._cache[cache_key + " type"]
+                self._value[key] = value
+                self._type[key] = type_
                 self._cached[key] = 1
+                if self._dirty.has_key(key):
+                    del(self._dirty[key])
+                if self._dates.has_key(key):
+                    del(self._dates[key])
 
     def cache_write(self, sync=1):
-        """Write information to the cache."""
-        self.cache_clear(sync=0)
-
-        keys = []
-        for key in self.keys():
-            cache_key = self.cache_key(key)
-            if not self._cached[key]:
-                if self._cache.has_key(cache_key):
-                    # Non-cached keys need to be cleared
-                    del(self._cache[cache_key])
-                    del(self._cache[cache_key + " type"])
-                continue
+        """Write the keys changed since the last read or write to the cache.
 
-            keys.append(key)
-            self._cache[cache_key] = self._value[key]
-            self._cache[cache_key + " type"] = self._type[key]
-
-        if self._root:
-            keys_key = " keys"
-        else:
-            keys_key = self._id
+        Returns the number of keys written or deleted.
+        """
+        fields = {}
+        deleted = []
+        for key in self._dirty.keys():
+            if self._value.has_key(key) and self._cached[key]:
+                fields[key] = (self._type[key], self._value[key])
+            else:
+                deleted.append(key)
+        self._dirty = {}
 
-        self._cache[keys_key] = " ".join(keys)
+        if fields or deleted:
+            self._cache.write_keys(self.cache_id(), fields, deleted)
         if sync:
             self._cache.sync()
+        return len(fields) + len(deleted)
 
     def cache_clear(self, sync=1):
         """Remove information from the cache."""
-        if self._root:
-            keys_key = " keys"
-        else:
-            keys_key = self._id
-
-        if self._cache.has_key(keys_key):
-            keys = self._cache[keys_key].split(" ")
-            del(self._cache[keys_key])
-        else:
-            return
-
-        for key in keys:
-            cache_key = self.cache_key(key)
-            del(self._cache[cache_key])
-            del(self._cache[cache_key + " type"])
-
+        self._cache.delete(self.cache_id())
         if sync:
             self._cache.sync()
 
+    def cache_release(self):
+        """Let other processes write to the cache until it's next used."""
+        self._cache.release()
+
+    def cache_fields(self):
+        """Return the keys kept in the cache, as the cache's read does."""
+        if self._unread:
+            self.cache_read_rest()
+        fields = {}
+        for key in self._value.keys():
+            if self._cached[key]:
+                fields[key] = (self._type[key], self._value[key])
+        return fields
+
     def has_key(self, key):
         """Check whether the key exists."""
         key = key.replace(" ", "_")
-        return self._value.has_key(key)
+        return self._value.has_key(key) or self._unread.has_key(key)
 
     def key_type(self, key):
         """Return the key type."""
         key = key.replace(" ", "_")
+        if self._unread.has_key(key):
+            self.cache_read_rest()
         return self._type[key]
 
     def set(self, key, value, cached=1):
@@ -141,12 +222,9 @@ class CachedInfo:
         """
         key = key.replace(" ", "_")
 
-        try:
-            func = getattr(self, "set_" + key)
-        except AttributeError:
-            pass
-        else:
-            return func(key, value)
+        func = getattr(self.__class__, "set_" + key, None)
+        if func is not None:
+            return func(self, key, value)
 
         if value == None:
             return self.set_as_null(key, value)
@@ -164,13 +242,12 @@ class CachedInfo:
         """
         key = key.replace(" ", "_")
 
-        try:
-            func = getattr(self, "get_" + key)
-        except AttributeError:
-            pass
-        else:
-            return func(key)
+        func = getattr(self.__class__, "get_" + key, None)
+        if func is not None:
+            return func(self, key)
 
+        if self._unread.has_key(key):
+            self.cache_read_rest()
         try:
             func = getattr(self, "get_as_" + self._type[key])
         except AttributeError:
@@ -189,9 +266,27 @@ class CachedInfo:
         """
         value = utf8(value)
 
+        self.set_value(key, self.STRING, value, cached)
+
+    def set_value(self, key, type_, value, cached=1):
+        """Set the key to the value of the given type.
+
+        The key is marked dirty unless it already had that value.
+        """
         key = key.replace(" ", "_")
+        if self._unread.has_key(key):
+            del(self._unread[key])
+            changed = 1
+        else:
+            changed = not self._value.has_key(key) \
+                      or self._value[key] != value or self._type[key] != type_
+        if changed or self._cached[key] != cached:
+            self._dirty[key] = 1
+        if changed and self._dates.has_key(key):
+            del(self._dates[key])
+
         self._value[key] = value
-        self._type[key] = self.STRING
+        self._type[key] = type_
         self._cached[key] = cached
 
     def get_as_string(self, key):
@@ -199,6 +294,8 @@ class CachedInfo:
         key = key.replace(" ", "_")
         if not self.has_key(key):
             raise KeyError, key
+        if self._unread.has_key(key):
+            self.cache_read_rest()
 
         return self._value[key]
 
@@ -207,31 +304,46 @@ class CachedInfo:
 
         The date should be a 9-item tuple as returned by time.gmtime().
         """
-        value = " ".join([ str(s) for s in value ])
-
-        key = key.replace(" ", "_")
-        self._value[key] = value
-        self._type[key] = self.DATE
-        self._cached[key] = cached
+        self.set_as_epoch(key, calendar.timegm(value), cached)
 
     def get_as_date(self, key):
         """Return the key as a date value."""
         key = key.replace(" ", "_")
+        if not self._dates.has_key(key) or self._dates[key][1] is None:
+            value = self.get_as_epoch(key)
+            self._dates[key] = (value, tuple(time.gmtime(value)))
+
+        return self._dates[key][1]
+
+    def set_as_epoch(self, key, value, cached=1):
+        """Set the key to the date value given in seconds since the epoch."""
+        value = int(value)
+        self.set_value(key, self.DATE, str(value), cached)
+
+        key = key.replace(" ", "_")
+        if not self._dates.has_key(key):
+            self._dates[key] = (value, None)
+
+    def get_as_epoch(self, key):
+        """Return the key as a date value in seconds since the epoch."""
+        key = key.replace(" ", "_")
+        if self._dates.has_key(key):
+            return self._dates[key][0]
         if not self.has_key(key):
             raise KeyError, key
+        if self._unread.has_key(key):
+            self.cache_read_rest()
 
-        value = self._value[key]
-        return tuple([ int(i) for i in value.split(" ") ])
+        value = epoch(self._value[key])
+        self._dates[key] = (value, None)
+        return value
 
     def set_as_null(self, key, value, cached=1):
         """Set the key to the null value.
 
         This only exists to make things less magic.
         """
-        key = key.replace(" ", "_")
-        self._value[key] = ""
-        self._type[key] = self.NULL
-        self._cached[key] = cached
+        self.set_value(key, self.NULL, "", cached)
 
     def get_as_null(self, key):
         """Return the key as the null value."""
@@ -247,17 +359,28 @@ class CachedInfo:
         if not self.has_key(key):
             raise KeyError, key
 
+        self._dirty[key] = 1
+        if self._dates.has_key(key):
+            del(self._dates[key])
+        if self._unread.has_key(key):
+            del(self._unread[key])
+            if not self._value.has_key(key):
+                return
         del(self._value[key])
         del(self._type[key])
         del(self._cached[key])
 
     def keys(self):
         """Return the list of cached keys."""
-        return self._value.keys()
+        keys = self._value.keys()
+        for key in self._unread.keys():
+            if not self._value.has_key(key):
+                keys.append(key)
+        return keys
 
     def __iter__(self):
         """Iterate the cached keys."""
-        return iter(self._value.keys())
+        return iter(self.keys())
 
     # Special methods
     __contains__ = has_key
@@ -279,6 +402,1261 @@ class CachedInfo:
             raise AttributeError, key
 
 
+class Backend:
+    """How the cache file of each channel is kept.
+
+    A backend opens the file of a channel's cache, and gets, puts, deletes
+    and iterates over the string records in the handle it returns, syncs
+    them to disk and closes it.  This one does so on the dict-like handle
+    of a dbm-style module, given to the constructor; the file-per-channel
+    caches (LockedDB) work on any backend.
+    """
+    def __init__(self, module):
+        self.module = module
+
+    def open(self, filename, flag="c"):
+        """Open the file and return its handle."""
+        return self.module.open(filename, flag, 0666)
+
+    def get(self, db, key):
+        """Return the record, raising KeyError if there isn't one."""
+        return db[key]
+
+    def has_key(self, db, key):
+        """Check whether there's a record for the key."""
+        return db.has_key(key)
+
+    def put(self, db, key, value):
+        """Set the record."""
+        db[key] = value
+
+    def delete(self, db, key):
+        """Remove the record."""
+        del(db[key])
+
+    def iterate(self, db):
+        """Return the keys of all the records."""
+        return db.keys()
+
+    def sync(self, db):
+        """Write any changes to disk."""
+        db.sync()
+
+    def close(self, db):
+        """Write any changes to disk and close the handle."""
+        db.close()
+
+    def compact(self, db, filename):
+        """Reclaim the space of deleted records, returning the handle to
+        use from then on.
+
+        The records are copied into a new file that replaces the old one,
+        as Berkeley DB files never shrink.
+        """
+        new_filename = filename + ".new"
+        if os.path.exists(new_filename):
+            os.remove(new_filename)
+        new_db = self.open(new_filename, "n")
+        for key in self.iterate(db):
+            self.put(new_db, key, self.get(db, key))
+        self.close(new_db)
+        self.close(db)
+        os.rename(new_filename, filename)
+        return self.open(filename, "w")
+
+
+class GDBMBackend(Backend):
+    """Keeps each channel's cache in a gdbm file."""
+    def __init__(self):
+        Backend.__init__(self, gdbm)
+
+    def open(self, filename, flag="c"):
+        # the file is only opened under a LockedDB lock, so gdbm's own
+        # locking, which won't let two processes open it to write, is off
+        return gdbm.open(filename, flag + "u", 0666)
+
+    def compact(self, db, filename):
+        db.reorganize()
+        return db
+
+
+class MemoryBackend(Backend):
+    """Keeps the caches in memory, for as long as the process runs.
+
+    The records are lost at the end of the run, so this is only any use
+    for trying things out, and for comparing the others against.
+    """
+    def __init__(self):
+        Backend.__init__(self, None)
+        self.files = {}
+
+    def open(self, filename, flag="c"):
+        filename = os.path.abspath(filename)
+        if flag == "n" or not self.files.has_key(filename):
+            if flag in ("r", "w"):
+                raise IOError, "no such cache: %s" % filename
+            self.files[filename] = {}
+        return self.files[filename]
+
+    def sync(self, db):
+        pass
+
+    close = sync
+
+    def compact(self, db, filename):
+        return db
+
+
+# Backends for the file-per-channel caches, by the name cache_backend
+# gives them; "sqlite" is SQLiteCache rather than one of these
+BACKENDS = { "dbhash": Backend(dbhash), "memory": MemoryBackend() }
+if gdbm is not None:
+    BACKENDS["gdbm"] = GDBMBackend()
+
+
+class FileLock:
+    """An advisory lock on a file, shared within the process.
+
+    flock locks belong to an open file, so two of them on the same file in
+    one process would wait on each other.  Instead there is one FileLock
+    for each file (see file_lock), and it holds the strongest lock any of
+    the holders in the process asked for.  The file is only kept open
+    while it's locked.
+    """
+    _locks = {}
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = None
+        self.mode = UNLOCKED
+        self.holders = {}
+
+    def acquire(self, holder, mode, blocking=1):
+        """Lock the file for the holder, SHARED or EXCLUSIVE.
+
+        Returns false, without waiting, if blocking is false and another
+        process holds a conflicting lock.
+        """
+        old_mode = self.holders.get(holder, UNLOCKED)
+        self.holders[holder] = mode
+        wanted = max(self.holders.values())
+        if wanted > self.mode and not self.flock(wanted, blocking):
+            self.holders[holder] = old_mode
+            # a failed conversion can lose the lock held before
+            self.flock(max(self.holders.values()))
+            return 0
+        return 1
+
+    def release(self, holder):
+        """Drop the holder's lock."""
+        if self.holders.has_key(holder):
+            del(self.holders[holder])
+        wanted = max([ UNLOCKED ] + self.holders.values())
+        if wanted < self.mode:
+            self.flock(wanted)
+
+    def flock(self, mode, blocking=1):
+        """Change the lock on the file, returning false if it would have
+        to wait and blocking is false."""
+        if mode == UNLOCKED:
+            if self._fd is not None:
+                self._fd.close()
+                self._fd = None
+            self.mode = UNLOCKED
+            return 1
+
+        if self._fd is None:
+            self._fd = open(self.filename, "a")
+        if mode == EXCLUSIVE:
+            operation = fcntl.LOCK_EX
+        else:
+            operation = fcntl.LOCK_SH
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self._fd.fileno(), operation)
+        except IOError, e:
+            if blocking or e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            self.mode = UNLOCKED
+            return 0
+        self.mode = mode
+        return 1
+
+def file_lock(directory, name):
+    """Return the FileLock for the file of the cache directory, None
+    without fcntl."""
+    if fcntl is None:
+        return None
+    directory = os.path.join(directory, LOCK_DIRECTORY)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    filename = os.path.abspath(os.path.join(directory, name))
+    if not FileLock._locks.has_key(filename):
+        FileLock._locks[filename] = FileLock(filename)
+    return FileLock._locks[filename]
+
+
+class HandlePool:
+    """The files of the caches (LockedDB) open at once.
+
+    Once size files are open, the one used least recently is released to
+    make room for the next, and opened again when it's next used; a file
+    with writes still to sync is synced first.  0 means no limit.  The
+    files opened, and those released to make room, are counted for the
+    run's statistics.
+    """
+    def __init__(self, size=0):
+        self.size = size
+        self.opened = 0
+        self.evicted = 0
+        self._used = {}
+        self._tick = 0
+
+    def reset(self):
+        """Zero the counts."""
+        self.opened = 0
+        self.evicted = 0
+
+    def use(self, db):
+        """Note that the file of the LockedDB has just been used."""
+        self._tick += 1
+        self._used[id(db)] = (self._tick, weakref.ref(db))
+
+    def opening(self, db):
+        """Make room for the file of the LockedDB, about to be opened."""
+        self.opened += 1
+        if not self.size or len(self._used) < self.size:
+            return
+
+        used = self._used.items()
+        used.sort(lambda a, b: cmp(a[1][0], b[1][0]))
+        for key, (tick, ref) in used[:len(used) - self.size + 1]:
+            other = ref()
+            if other is None:
+                del(self._used[key])
+            elif other is not db:
+                other.sync()
+                other.release()
+                self.evicted += 1
+
+    def closed(self, db):
+        """Note that the file of the LockedDB has been closed."""
+        if self._used.has_key(id(db)):
+            del(self._used[id(db)])
+
+# Files open at once (see Planet.cache_handles)
+handles = HandlePool()
+
+
+class LockedDB:
+    """A dbhash file only kept open under an advisory lock.
+
+    The file is opened, with a shared lock, when first read, and the lock
+    made exclusive when first written to.  release() closes the file and
+    drops the lock, unless there are writes still to sync, and the file is
+    opened again when next used; changed() tells whether another process
+    wrote to it in between.  So any number of processes can read a cache
+    at once, and one can write to it when none is reading.
+
+    The lock is taken on a file of the same name in LOCK_DIRECTORY, as the
+    cache file itself is replaced when compacted.  The file is kept by the
+    Backend given, dbhash by default.
+    """
+    def __init__(self, filename, flag="c", backend=None):
+        self.filename = filename
+        self.flag = flag
+        if backend is None:
+            backend = BACKENDS["dbhash"]
+        self.backend = backend
+        self._db = None
+        self._lock = UNLOCKED
+        self._pending = 0
+        self._stat = None
+        self._changed = 0
+
+        self._file_lock = None  # for __del__, should file_lock fail
+        self._file_lock = file_lock(os.path.dirname(filename),
+                                    os.path.basename(filename))
+
+    def file_stat(self):
+        """Return what changes when the file is written to."""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+    def lock(self, exclusive=0, blocking=1):
+        """Lock the file, shared or exclusive, and open it.
+
+        Returns false, without waiting, if blocking is false and another
+        process holds a conflicting lock.
+        """
+        if exclusive:
+            wanted = EXCLUSIVE
+        else:
+            wanted = SHARED
+        if wanted > self._lock:
+            if self._file_lock is not None:
+                # another process can get in while a lock is converted,
+                # so the file is opened again once it has been
+                if self._file_lock.mode < wanted:
+                    self.close_file()
+                if not self._file_lock.acquire(id(self), wanted, blocking):
+                    self.close_file()
+                    return 0
+            self._lock = wanted
+
+        if self._db is None:
+            handles.opening(self)
+            stat = self.file_stat()
+            if self._stat is not None and stat != self._stat:
+                self._changed = 1
+            self._db = self.backend.open(self.filename, self.flag)
+        handles.use(self)
+        return 1
+
+    def changed(self):
+        """Check whether another process has written to the file since it
+        was last released, and forget it."""
+        changed = self._changed
+        self._changed = 0
+        return changed
+
+    def close_file(self):
+        """Close the file, noting its state to tell if it changes."""
+        if self._db is not None:
+            self.backend.close(self._db)
+            self._db = None
+            self._stat = self.file_stat()
+            handles.closed(self)
+
+    def release(self):
+        """Close the file and drop the lock, unless there are writes still
+        to sync."""
+        if self._pending:
+            return
+        self.close_file()
+        if self._file_lock is not None:
+            self._file_lock.release(id(self))
+        self._lock = UNLOCKED
+
+    def replace(self, filename):
+        """Replace the file with another, keeping the lock."""
+        self.lock(exclusive=1)
+        self.backend.close(self._db)
+        os.rename(filename, self.filename)
+        self._db = self.backend.open(self.filename, "w")
+        self._pending = 0
+
+    def compact(self):
+        """Reclaim the space of deleted records, keeping the lock."""
+        self.lock(exclusive=1)
+        self._db = self.backend.compact(self._db, self.filename)
+        self._pending = 0
+
+    def has_key(self, key):
+        self.lock()
+        return self.backend.has_key(self._db, key)
+
+    def keys(self):
+        self.lock()
+        return self.backend.iterate(self._db)
+
+    def __getitem__(self, key):
+        self.lock()
+        return self.backend.get(self._db, key)
+
+    def __setitem__(self, key, value):
+        self.lock(exclusive=1)
+        self._pending = 1
+        self.backend.put(self._db, key, value)
+
+    def __delitem__(self, key):
+        self.lock(exclusive=1)
+        self._pending = 1
+        self.backend.delete(self._db, key)
+
+    def sync(self):
+        if self._db is not None:
+            self.backend.sync(self._db)
+        self._pending = 0
+
+    def close(self):
+        self.sync()
+        self.release()
+
+    def __del__(self):
+        # the lock is shared with the rest of the process, so mustn't be
+        # left held; the file closes itself
+        if self._file_lock is not None:
+            self._file_lock.release(id(self))
+        handles.closed(self)
+
+
+class DBCache:
+    """Cache of a channel kept in a dbhash file of its own.
+
+    Each field of an item is kept in two records, "<id> <key>" holding the
+    value and "<id> <key> type" its type, and the keys of the item are
+    listed in the "<id>" record.  The channel's own fields are kept the
+    same way but without the id, and listed in the " keys" record.
+    """
+    def __init__(self, db, filename=None):
+        self._db = db
+        self.filename = filename
+
+    def keys_key(self, id_):
+        """Return the name of the record listing the keys of id_."""
+        if id_ is None:
+            return " keys"
+        else:
+            return id_
+
+    def cache_key(self, id_, key):
+        """Return the name of the record holding the key of id_."""
+        if id_ is None:
+            return key
+        else:
+            return id_ + " " + key
+
+    def keys(self, id_):
+        """Return the keys of id_ listed in the cache."""
+        keys_key = self.keys_key(id_)
+        if self._db.has_key(keys_key):
+            return [ key for key in self._db[keys_key].split(" ") if key ]
+        else:
+            return []
+
+    def read(self, id_):
+        """Return the fields of the item, or the channel if id_ is None.
+
+        The fields are returned as a dictionary of (type, value) tuples.
+        """
+        fields = {}
+        for key in self.keys(id_):
+            cache_key = self.cache_key(id_, key)
+            fields[key] = (self._db[cache_key + " type"], self._db[cache_key])
+        return fields
+
+    def read_keys(self, id_, keys):
+        """Return only the given keys of the item, or the channel.
+
+        Returns the fields as read does, and a list of the other keys
+        the cache has for it.
+        """
+        wanted = {}
+        for key in keys:
+            wanted[key] = 1
+
+        fields = {}
+        others = []
+        for key in self.keys(id_):
+            if wanted.has_key(key):
+                cache_key = self.cache_key(id_, key)
+                fields[key] = (self._db[cache_key + " type"],
+                               self._db[cache_key])
+            else:
+                others.append(key)
+        return fields, others
+
+    def write(self, id_, fields):
+        """Replace the fields of the item, or the channel if id_ is None."""
+        self.delete(id_)
+        for key, (type_, value) in fields.items():
+            cache_key = self.cache_key(id_, key)
+            self._db[cache_key] = value
+            self._db[cache_key + " type"] = type_
+        self._db[self.keys_key(id_)] = " ".join(fields.keys())
+
+    def write_keys(self, id_, fields, deleted):
+        """Change only the given keys of the item, or the channel.
+
+        The fields are set and the deleted keys removed, other keys are
+        left as they are.
+        """
+        keys = self.keys(id_)
+        listed = {}
+        for key in keys:
+            listed[key] = 1
+
+        changed = 0
+        for key, (type_, value) in fields.items():
+            cache_key = self.cache_key(id_, key)
+            self._db[cache_key] = value
+            self._db[cache_key + " type"] = type_
+            if not listed.has_key(key):
+                keys.append(key)
+                changed = 1
+        for key in deleted:
+            if listed.has_key(key):
+                cache_key = self.cache_key(id_, key)
+                del(self._db[cache_key])
+                del(self._db[cache_key + " type"])
+                keys.remove(key)
+                changed = 1
+
+        if changed:
+            self._db[self.keys_key(id_)] = " ".join(keys)
+
+    def delete(self, id_):
+        """Remove the item, or the channel if id_ is None."""
+        keys_key = self.keys_key(id_)
+        if not self._db.has_key(keys_key):
+            return
+
+        for key in self.keys(id_):
+            cache_key = self.cache_key(id_, key)
+            del(self._db[cache_key])
+            del(self._db[cache_key + " type"])
+        del(self._db[keys_key])
+
+    def ids(self):
+        """Return the ids of the items in the cache."""
+        root = {}
+        for key in self.keys(None):
+            root[key] = 1
+        return [ key for key in self._db.keys()
+                 if key.find(" ") == -1 and not root.has_key(key) ]
+
+    def sync(self):
+        """Write any changes to disk."""
+        self._db.sync()
+
+    def lock(self, exclusive=0, blocking=1):
+        """Lock the cache against other processes (see LockedDB.lock)."""
+        if isinstance(self._db, LockedDB):
+            return self._db.lock(exclusive, blocking)
+        return 1
+
+    def changed(self):
+        """Check whether another process has written to the cache since
+        it was last released."""
+        if isinstance(self._db, LockedDB):
+            return self._db.changed()
+        return 0
+
+    def release(self):
+        """Let other processes write to the cache until it's next used."""
+        if isinstance(self._db, LockedDB):
+            self._db.release()
+
+    def compact(self):
+        """Reclaim the space of deleted records (see Backend.compact)."""
+        if isinstance(self._db, LockedDB):
+            self._db.compact()
+
+    def close(self):
+        """Close the cache."""
+        self._db.close()
+
+
+class CompactDBCache(DBCache):
+    """Cache of a channel kept in a dbhash file, one record per item.
+
+    Each item is kept, fields and types together, pickled in the record
+    named by its id, and the channel's fields the same way in the
+    " channel" record.  The " version" record holds the format version, it
+    tells these files from those written by DBCache (version 1).
+    """
+    VERSION = "2"
+    VERSION_KEY = " version"
+    CHANNEL_KEY = " channel"
+
+    def keys_key(self, id_):
+        """Return the name of the record holding id_."""
+        if id_ is None:
+            return self.CHANNEL_KEY
+        else:
+            return id_
+
+    def keys(self, id_):
+        """Return the keys of id_ in the cache."""
+        return self.read(id_).keys()
+
+    def read(self, id_):
+        """Return the fields of the item, or the channel if id_ is None.
+
+        The fields are returned as a dictionary of (type, value) tuples.
+        """
+        keys_key = self.keys_key(id_)
+        if self._db.has_key(keys_key):
+            return pickle.loads(self._db[keys_key])
+        else:
+            return {}
+
+    def read_keys(self, id_, keys):
+        """Return only the given keys of the item, or the channel.
+
+        Returns the fields as read does, and a list of the other keys
+        the cache has for it.  The whole record is still read, but only
+        the keys asked for are kept.
+        """
+        fields = {}
+        others = self.read(id_)
+        for key in keys:
+            if others.has_key(key):
+                fields[key] = others[key]
+                del(others[key])
+        return fields, others.keys()
+
+    def write(self, id_, fields):
+        """Replace the fields of the item, or the channel if id_ is None."""
+        self._db[self.keys_key(id_)] = pickle.dumps(fields, 2)
+        if id_ is None:
+            self._db[self.VERSION_KEY] = self.VERSION
+
+    def write_keys(self, id_, fields, deleted):
+        """Change only the given keys of the item, or the channel.
+
+        The fields are set and the deleted keys removed, other keys are
+        left as they are; the record is rewritten with them.
+        """
+        data = self.read(id_)
+        data.update(fields)
+        for key in deleted:
+            if data.has_key(key):
+                del(data[key])
+        self.write(id_, data)
+
+    def delete(self, id_):
+        """Remove the item, or the channel if id_ is None."""
+        keys_key = self.keys_key(id_)
+        if self._db.has_key(keys_key):
+            del(self._db[keys_key])
+
+    def ids(self):
+        """Return the ids of the items in the cache."""
+        return [ key for key in self._db.keys() if not key.startswith(" ") ]
+
+
+def open_dbhash(filename, flag="c", backend=None):
+    """Open the dbhash cache of a channel, or that of another Backend.
+
+    Returns a DBCache for files written in the original layout, and a
+    CompactDBCache for any other, new files included.
+    """
+    db = LockedDB(filename, flag, backend)
+    if db.has_key(" keys") and not db.has_key(CompactDBCache.VERSION_KEY):
+        return DBCache(db, filename)
+    else:
+        return CompactDBCache(db, filename)
+
+
+class SQLiteCache:
+    """Cache of a channel kept in an SQLite database shared by all channels.
+
+    The channel's fields are kept in the channels table, and each item in
+    a row of the items table, pickled, with its hidden flag, date and order
+    in columns of their own so the newest items of every channel can be
+    found with the items_timeline index (see timeline).
+    """
+    _connections = {}
+
+    def __init__(self, filename, channel):
+        self.filename = filename
+        self.channel = channel
+
+        if not self._connections.has_key(filename):
+            db = sqlite3.connect(filename, timeout=30)
+            db.text_factory = str
+            db.execute("CREATE TABLE IF NOT EXISTS channels "
+                       "(channel TEXT PRIMARY KEY, data BLOB)")
+            db.execute("CREATE TABLE IF NOT EXISTS items "
+                       "(channel TEXT, id TEXT, hidden INTEGER, date REAL, "
+                       "ord TEXT, data BLOB, PRIMARY KEY (channel, id))")
+            db.execute("CREATE INDEX IF NOT EXISTS items_timeline "
+                       "ON items (hidden, date, ord)")
+            db.commit()
+            self._connections[filename] = db
+        self._db = self._connections[filename]
+
+    def read(self, id_):
+        """Return the fields of the item, or the channel if id_ is None.
+
+        The fields are returned as a dictionary of (type, value) tuples.
+        """
+        if id_ is None:
+            row = self._db.execute("SELECT data FROM channels "
+                                   "WHERE channel = ?",
+                                   (self.channel,)).fetchone()
+        else:
+            row = self._db.execute("SELECT data FROM items "
+                                   "WHERE channel = ? AND id = ?",
+                                   (self.channel, id_)).fetchone()
+        if row is None:
+            return {}
+        return pickle.loads(str(row[0]))
+
+    def read_keys(self, id_, keys):
+        """Return only the given keys of the item, or the channel.
+
+        Returns the fields as read does, and a list of the other keys
+        the cache has for it.  The whole row is still read, but only the
+        keys asked for are kept.
+        """
+        fields = {}
+        others = self.read(id_)
+        for key in keys:
+            if others.has_key(key):
+                fields[key] = others[key]
+                del(others[key])
+        return fields, others.keys()
+
+    def write(self, id_, fields):
+        """Replace the fields of the item, or the channel if id_ is None."""
+        data = buffer(pickle.dumps(fields, 2))
+        if id_ is None:
+            self._db.execute("INSERT OR REPLACE INTO channels VALUES (?, ?)",
+                             (self.channel, data))
+            return
+
+        # the columns sort the same way as Planet.items() sorts items
+        date = None
+        if fields.has_key("date") and fields["date"][0] == CachedInfo.DATE:
+            date = epoch(fields["date"][1])
+        order = fields.has_key("order") and fields["order"][1] or None
+        self._db.execute("INSERT OR REPLACE INTO items "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         (self.channel, id_, int(fields.has_key("hidden")),
+                          date, order, data))
+
+    def write_keys(self, id_, fields, deleted):
+        """Change only the given keys of the item, or the channel.
+
+        The fields are set and the deleted keys removed, other keys are
+        left as they are; the row is rewritten with them.
+        """
+        data = self.read(id_)
+        data.update(fields)
+        for key in deleted:
+            if data.has_key(key):
+                del(data[key])
+        self.write(id_, data)
+
+    def delete(self, id_):
+        """Remove the item, or the channel if id_ is None."""
+        if id_ is None:
+            self._db.execute("DELETE FROM channels WHERE channel = ?",
+                             (self.channel,))
+        else:
+            self._db.execute("DELETE FROM items WHERE channel = ? AND id = ?",
+                             (self.channel, id_))
+
+    def ids(self):
+        """Return the ids of the items in the cache."""
+        return [ row[0] for row in
+                 self._db.execute("SELECT id FROM items WHERE channel = ?",
+                                  (self.channel,)) ]
+
+    def timeline(self, hidden=0):
+        """Iterate over the items of every channel in the database.
+
+        Yields (channel, id, date, order) tuples, newest first, leaving out
+        hidden items unless hidden is true.
+        """
+        if hidden:
+            where = ""
+        else:
+            where = "WHERE hidden = 0 "
+        return self._db.execute("SELECT channel, id, date, ord FROM items " +
+                                where + "ORDER BY date DESC, ord DESC")
+
+    def sync(self):
+        """Write any changes to disk."""
+        self._db.commit()
+
+    def compact(self):
+        """Nothing to do, SQLite reuses the space of deleted rows."""
+        pass
+
+    def lock(self, exclusive=0, blocking=1):
+        """Nothing to do, SQLite locks the database itself."""
+        return 1
+
+    def changed(self):
+        """Check whether another process has written to the cache; as it
+        is never released, it can't have."""
+        return 0
+
+    def release(self):
+        """Nothing to do, SQLite locks the database itself."""
+        pass
+
+    def close(self):
+        """Close the cache; the database stays open for other channels."""
+        self._db.commit()
+
+
+class Export:
+    """Read-only export of the caches of every channel.
+
+    The values of all the fields are laid end to end in a data file, which
+    is mapped into memory, and a marshal index gives the type, offset and
+    length of each.  Reading a field only copies that slice of the data,
+    and processes reading the same export share its pages.
+
+    Each channel's fields are kept together, with offsets relative to the
+    start of the channel, so an unchanged channel can be copied into the
+    next export as it is.  Every export is written to a new data file, and
+    the index naming it replaces the old one in one rename, so readers
+    always see a whole export (see write_export).
+    """
+    VERSION = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        # the data file named by the index may be removed by a newer export
+        # just after it was read, in which case there is a newer index
+        for attempt in range(3):
+            index = marshal.load(open(os.path.join(directory,
+                                                   EXPORT_INDEX), "rb"))
+            if index["version"] != self.VERSION:
+                raise ValueError, "unknown export version"
+            try:
+                data_fd = open(os.path.join(directory, EXPORT_DATA %
+                                            index["generation"]), "rb")
+            except IOError:
+                continue
+            break
+        else:
+            raise IOError, "export keeps changing"
+
+        self.generation = index["generation"]
+        self.channels = index["channels"]
+        if index["size"]:
+            self.data = mmap.mmap(data_fd.fileno(), index["size"],
+                                  access=mmap.ACCESS_READ)
+        else:
+            self.data = ""
+        data_fd.close()
+
+    def channel(self, name):
+        """Return the cache of the channel, an ExportCache."""
+        return ExportCache(self, name)
+
+    def close(self):
+        """Unmap the data file."""
+        if self.data:
+            self.data.close()
+        self.data = ""
+
+
+class ExportCache:
+    """Cache of a channel read from an Export.
+
+    This only reads, writing to it raises IOError.
+    """
+    def __init__(self, export, channel):
+        self.export = export
+        self.channel = channel
+        self._records = {}
+        self._start = 0
+        if export.channels.has_key(channel):
+            self._records = export.channels[channel]["records"]
+            self._start = export.channels[channel]["start"]
+
+    def read(self, id_):
+        """Return the fields of the item, or the channel if id_ is None.
+
+        The fields are returned as a dictionary of (type, value) tuples.
+        """
+        return self.read_keys(id_, None)[0]
+
+    def read_keys(self, id_, keys):
+        """Return only the given keys of the item, or the channel.
+
+        Returns the fields as read does, and a list of the other keys
+        the cache has for it.  All the keys are read if keys is None.
+        """
+        data = self.export.data
+        fields = {}
+        others = []
+        for key, (type_, offset, length) in self._records.get(id_,
+                                                              {}).items():
+            if keys is None or key in keys:
+                offset += self._start
+                fields[key] = (type_, data[offset:offset + length])
+            else:
+                others.append(key)
+        return fields, others
+
+    def write(self, *args):
+        """Refuse to write, the export is only read."""
+        raise IOError, "the export of the cache is read-only"
+
+    write_keys = delete = write
+
+    def ids(self):
+        """Return the ids of the items in the cache."""
+        return [ id_ for id_ in self._records.keys() if id_ is not None ]
+
+    def sync(self):
+        """Nothing to do, the export is only read."""
+        pass
+
+    compact = close = release = sync
+
+    def lock(self, exclusive=0, blocking=1):
+        """Nothing to do, the export is replaced rather than written."""
+        return 1
+
+    def changed(self):
+        """Check whether the export has been written to, it never is."""
+        return 0
+
+
+class Archive:
+    """Archive of the old items of a channel, kept out of its cache.
+
+    Items are appended as pickled (id, fields) records to a gzip file,
+    a gzip member for each lot, and only read back all at once; should
+    an item be archived twice, the last copy is the one read.  Appends
+    are synced to disk before returning, so the items can be deleted from
+    the cache straight after.  An append that fails is cut back off the
+    file, and a member left cut short by one that was killed is skipped
+    when reading, so the lots appended after it can still be read.
+    """
+    # zlib window bits for the gzip format
+    WBITS = 16 + 15
+
+    # Start of each gzip member: its magic number and compression method
+    HEADER = "\x1f\x8b\x08"
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def need_zlib(self):
+        """Raise IOError if the zlib module, needed to write or read the
+        archive, is missing."""
+        if zlib is None:
+            raise IOError, "zlib module needed for " + self.filename
+
+    def append(self, records):
+        """Add the (id, fields) records to the archive."""
+        if not records:
+            return
+        self.need_zlib()
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        compressor = zlib.compressobj(9, zlib.DEFLATED, self.WBITS)
+        data = "".join([ pickle.dumps(record, 2) for record in records ])
+        output_fd = open(self.filename, "ab")
+        try:
+            output_fd.seek(0, 2)
+            size = output_fd.tell()
+            try:
+                output_fd.write(compressor.compress(data) + compressor.flush())
+                output_fd.flush()
+                os.fsync(output_fd.fileno())
+            except:
+                output_fd.truncate(size)
+                raise
+        finally:
+            output_fd.close()
+
+    def members(self, data):
+        """Yield the uncompressed data of each whole gzip member in data.
+
+        A member that's cut short, or damaged, is skipped by going on from
+        the next gzip header after its start.
+        """
+        start = 0
+        while start < len(data):
+            decompressor = zlib.decompressobj(self.WBITS)
+            try:
+                output = decompressor.decompress(buffer(data, start))
+                end = len(data) - len(decompressor.unused_data)
+                if end == len(data):
+                    # Only a member that was ended leaves what follows it
+                    decompressor.decompress(self.HEADER)
+                    if not decompressor.unused_data:
+                        raise zlib.error, "member cut short"
+            except zlib.error:
+                start = data.find(self.HEADER, start + 1)
+                if start < 0:
+                    break
+                continue
+
+            yield output
+            start = end
+
+    def records(self):
+        """Yield the (id, fields) records of the archive, oldest first.
+
+        The records of a lot left cut short by an interrupted append are
+        skipped.
+        """
+        if not os.path.exists(self.filename):
+            return
+        self.need_zlib()
+        data = open(self.filename, "rb").read()
+        for member in self.members(data):
+            input = StringIO(member)
+            while input.tell() < len(member):
+                try:
+                    record = pickle.load(input)
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    break
+                yield record
+
+    def read(self):
+        """Return a dictionary of the fields of each archived item."""
+        items = {}
+        for id_, fields in self.records():
+            items[id_] = fields
+        return items
+
+    def size(self):
+        """Return the size of the archive in bytes."""
+        if os.path.exists(self.filename):
+            return os.path.getsize(self.filename)
+        return 0
+
+def archive_filename(directory, name):
+    """Return the filename of the archive of the channel named name (its
+    cache_basename) in the cache directory."""
+    return os.path.join(directory, ARCHIVE_DIRECTORY, name + ".gz")
+
+
+class ArchiveCache:
+    """Cache of a channel read along with its Archive.
+
+    The archived items are read from the archive, the rest from the
+    channel's own cache; an item in both is read from the cache.  Only
+    the items in the cache can be written to, writing to an archived one
+    raises IOError.
+    """
+    def __init__(self, cache, archive):
+        self.cache = cache
+        self._cached = {}
+        for id_ in cache.ids():
+            self._cached[id_] = 1
+        self._archived = {}
+        for id_, fields in archive.read().items():
+            if not self._cached.has_key(id_):
+                self._archived[id_] = fields
+
+    def archived(self, id_):
+        """Check whether the item is read from the archive."""
+        return self._archived.has_key(id_)
+
+    def read(self, id_):
+        """Return the fields of the item, or the channel if id_ is None."""
+        if self.archived(id_):
+            return self._archived[id_].copy()
+        return self.cache.read(id_)
+
+    def read_keys(self, id_, keys):
+        """Return only the given keys of the item, or the channel, and a
+        list of the other keys there are for it."""
+        if not self.archived(id_):
+            return self.cache.read_keys(id_, keys)
+        fields = {}
+        others = []
+        for key, value in self._archived[id_].items():
+            if key in keys:
+                fields[key] = value
+            else:
+                others.append(key)
+        return fields, others
+
+    def write(self, id_, fields):
+        """Replace the fields of the item, or the channel if id_ is None."""
+        if self.archived(id_):
+            raise IOError, "archived items are read-only"
+        self.cache.write(id_, fields)
+
+    def write_keys(self, id_, fields, deleted):
+        """Change only the given keys of the item, or the channel."""
+        if self.archived(id_):
+            raise IOError, "archived items are read-only"
+        self.cache.write_keys(id_, fields, deleted)
+
+    def delete(self, id_):
+        """Remove the item, or the channel if id_ is None."""
+        if self.archived(id_):
+            raise IOError, "archived items are read-only"
+        self.cache.delete(id_)
+
+    def ids(self):
+        """Return the ids of the items in the cache and the archive."""
+        return self.cache.ids() + self._archived.keys()
+
+    def sync(self):
+        """Write any changes to disk."""
+        self.cache.sync()
+
+    def lock(self, exclusive=0, blocking=1):
+        """Lock the cache against other processes."""
+        return self.cache.lock(exclusive, blocking)
+
+    def changed(self):
+        """Check whether another process has written to the cache."""
+        return self.cache.changed()
+
+    def release(self):
+        """Let other processes write to the cache until it's next used."""
+        self.cache.release()
+
+    def compact(self):
+        """Reclaim the space of deleted records in the cache."""
+        self.cache.compact()
+
+    def close(self):
+        """Close the cache."""
+        self.cache.close()
+
+
+def write_export(directory, channels):
+    """Export the caches of the channels to the directory.
+
+    The channels are given as a list of (name, serial, cache) tuples.
+    Channels whose serial is the same as in the last export are copied
+    from it, the others are read from their cache.  Data files of older
+    exports are removed once the new index is in place.  Processes take
+    turns to write exports.
+    """
+    lock = file_lock(directory, EXPORT_INDEX)
+    if lock is not None:
+        lock.acquire("write_export", EXCLUSIVE)
+    try:
+        _write_export(directory, channels)
+    finally:
+        if lock is not None:
+            lock.release("write_export")
+
+def _write_export(directory, channels):
+    try:
+        old = Export(directory)
+    except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+        old = None
+
+    if old is not None:
+        generation = old.generation + 1
+    else:
+        generation = 1
+    data_fd = open(os.path.join(directory, EXPORT_DATA % generation), "wb")
+    offset = 0
+    index = {}
+    for name, serial, store in channels:
+        if old is not None and old.channels.has_key(name) \
+               and old.channels[name]["serial"] == serial:
+            entry = old.channels[name].copy()
+            data_fd.write(old.data[entry["start"]:entry["end"]])
+            entry["end"] = offset + entry["end"] - entry["start"]
+            entry["start"] = offset
+            offset = entry["end"]
+            index[name] = entry
+            continue
+
+        start = offset
+        records = {}
+        for id_ in [ None ] + store.ids():
+            fields = {}
+            for key, (type_, value) in store.read(id_).items():
+                data_fd.write(value)
+                fields[key] = (type_, offset - start, len(value))
+                offset += len(value)
+            records[id_] = fields
+        index[name] = { "serial": serial, "start": start, "end": offset,
+                        "records": records }
+    data_fd.close()
+    if old is not None:
+        old.close()
+
+    index_filename = os.path.join(directory, EXPORT_INDEX)
+    index_fd = open(index_filename + ".new", "wb")
+    marshal.dump({ "version": Export.VERSION, "generation": generation,
+                   "size": offset, "channels": index }, index_fd)
+    index_fd.close()
+    os.rename(index_filename + ".new", index_filename)
+
+    for filename in os.listdir(directory):
+        match = re_export_data.match(filename)
+        if match and int(match.group(1)) < generation:
+            os.remove(os.path.join(directory, filename))
+
+
+def migrate(directory, database):
+    """Import the dbhash caches in directory into an SQLite database.
+
+    Returns the number of channels imported.  Files that aren't channel
+    caches are skipped.
+    """
+    count = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or path == database:
+            continue
+        try:
+            old = open_dbhash(path, "r")
+        except dbhash.bsddb._db.DBError:
+            continue
+
+        try:
+            channel = old.read(None)
+            if not channel:
+                continue
+            new = SQLiteCache(database, name)
+            new.write(None, channel)
+            for id_ in old.ids():
+                new.write(id_, old.read(id_))
+            new.sync()
+            count += 1
+        finally:
+            old.close()
+
+    return count
+
+def upgrade(directory):
+    """Rewrite the dbhash caches in directory in the compact format.
+
+    Returns a list of (name, old size, new size) tuples for the channel
+    caches rewritten.  Caches already in the compact format, and files
+    that aren't channel caches, are skipped.
+    """
+    upgraded = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            continue
+        try:
+            old = open_dbhash(path, "r")
+        except dbhash.bsddb._db.DBError:
+            continue
+
+        try:
+            if isinstance(old, CompactDBCache):
+                continue
+            old.lock(exclusive=1)
+            new_path = path + ".new"
+            if os.path.exists(new_path):
+                os.remove(new_path)
+            new = CompactDBCache(dbhash.open(new_path, "n", 0666))
+            new.write(None, old.read(None))
+            for id_ in old.ids():
+                new.write(id_, old.read(id_))
+            new.close()
+
+            size = os.path.getsize(path)
+            old._db.replace(new_path)
+            upgraded.append((name, size, os.path.getsize(path)))
+        finally:
+            old.close()
+
+    return upgraded
+
+
 def filename(directory, filename):
     """Return a filename suitable for the cache.
 
@@ -292,6 +1670,17 @@ def filename(directory, filename):
 
     return os.path.join(directory, filename)
 
+def epoch(value):
+    """Return the seconds since the epoch of a cached date value.
+
+    Dates used to be cached as the fields of a time tuple separated by
+    spaces, those are still understood.
+    """
+    if value.find(" ") == -1:
+        return int(value)
+    else:
+        return calendar.timegm([ int(i) for i in value.split(" ") ])
+
 def utf8(value):
     """Return the value as a UTF-8 string."""
     if type(value) == type(u''):
@@ -65,12 +65,37 @@ TIDY_MARKUP = 0
 # if TIDY_MARKUP = 1
 PREFERRED_TIDY_INTERFACES = ["uTidy", "mxTidy"]
 
+# Parser to use for feeds which aren't well-formed XML.  "tolerant" is a fast
+# regular expression tokenizer; "sgmllib" is the original sgmllib.SGMLParser
+# based parser, kept as a fallback should the tolerant one misbehave.
+LOOSE_PARSER = "tolerant"
+
+# Keys which may be named in the profile argument to parse().  Elements that
+# would only produce these keys are skipped while parsing, so callers that
+# throw the keys away never pay for them.  Keys with no elements listed are
+# checked by the handlers themselves, because the same elements also carry
+# information that is always wanted (or are often left unclosed in illformed
+# feeds).
+PROFILE_ELEMENTS = {'tags': ['category', 'dc_subject', 'keywords',
+                             'itunes_category', 'itunes_keywords'],
+                    'categories': ['category', 'dc_subject', 'keywords',
+                                   'itunes_category', 'itunes_keywords'],
+                    'contributors': ['contributor', 'dc_contributor'],
+                    'cloud': [],
+                    'textinput': [],
+                    'links': [],
+                    'enclosures': []}
+
 # ---------- required modules (should come with any Python distribution) ----------
 import sgmllib, re, sys, copy, urlparse, time, rfc822, types, cgi, urllib, urllib2
 try:
     from cStringIO import StringIO as _StringIO
 except:
     from StringIO import StringIO as _StringIO
+try:
+    from hashlib import sha1 as _sha1
+except:
+    from sha import new as _sha1
 
 # ---------- optional modules (feedparser will work without these, but with reduced functionality) ----------
 
@@ -384,8 +409,15 @@ class _FeedParserMixin:
     can_contain_relative_uris = ['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description']
     can_contain_dangerous_markup = ['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description']
     html_types = ['text/html', 'application/xhtml+xml']
+
+    # function(html, encoding, baseuri) to resolve relative URIs within, and
+    # sanitize, embedded markup in one go, rather than with the two below
+    sanitizer = None
+    # and one used instead for the content and summary of entries
+    content_sanitizer = None
+    content_elements = ['content', 'summary', 'description']
     
-    def __init__(self, baseuri=None, baselang=None, encoding='utf-8'):
+    def __init__(self, baseuri=None, baselang=None, encoding='utf-8', profile=None):
         if _debug: sys.stderr.write('initializing FeedParser\n')
         if not self._matchnamespaces:
             for k, v in self.namespaces.items():
@@ -419,8 +451,33 @@ class _FeedParserMixin:
         if baselang:
             self.feeddata['language'] = baselang
 
+        # keys the caller doesn't want, and the elements that produce them
+        self.profile = {}
+        self.skipelements = {}
+        for key in profile or []:
+            if PROFILE_ELEMENTS.has_key(key):
+                self.profile[key] = 1
+                for element in PROFILE_ELEMENTS[key]:
+                    self.skipelements[element] = 1
+
+    def _skipElement(self, tag):
+        # elements which only produce keys excluded by the profile are
+        # dropped without calling their handlers; any text they contain
+        # falls through to the enclosing element, which discards it
+        if self.incontent:
+            return 0
+        if tag.find(':') <> -1:
+            prefix, suffix = tag.split(':', 1)
+        else:
+            prefix, suffix = '', tag
+        prefix = self.namespacemap.get(prefix, prefix)
+        if prefix:
+            prefix = prefix + '_'
+        return self.skipelements.has_key(prefix + suffix)
+
     def unknown_starttag(self, tag, attrs):
         if _debug: sys.stderr.write('start %s with %s\n' % (tag, attrs))
+        if self.skipelements and self._skipElement(tag): return
         # normalize attrs
         attrs = [(k.lower(), v) for k, v in attrs]
         attrs = [(k, k in ('rel', 'type') and v.lower() or v) for k, v in attrs]
@@ -491,6 +548,7 @@ class _FeedParserMixin:
 
     def unknown_endtag(self, tag):
         if _debug: sys.stderr.write('end %s\n' % tag)
+        if self.skipelements and self._skipElement(tag): return
         # match namespaces
         if tag.find(':') <> -1:
             prefix, suffix = tag.split(':', 1)
@@ -686,15 +744,26 @@ class _FeedParserMixin:
         except KeyError:
             pass
 
-        # resolve relative URIs within embedded markup
-        if self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types:
-            if element in self.can_contain_relative_uris:
-                output = _resolveRelativeURIs(output, self.baseuri, self.encoding)
-        
-        # sanitize embedded markup
-        if self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types:
-            if element in self.can_contain_dangerous_markup:
-                output = _sanitizeHTML(output, self.encoding)
+        if self.sanitizer:
+            # resolve relative URIs within, and sanitize, embedded markup
+            if self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types:
+                if element in self.can_contain_dangerous_markup:
+                    sanitizer = self.sanitizer
+                    if self.content_sanitizer and self.inentry and \
+                           element in self.content_elements and not \
+                           (self.inimage or self.intextinput or self.insource):
+                        sanitizer = self.content_sanitizer
+                    output = sanitizer(output, self.encoding, self.baseuri or '')
+        else:
+            # resolve relative URIs within embedded markup
+            if self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types:
+                if element in self.can_contain_relative_uris:
+                    output = _resolveRelativeURIs(output, self.baseuri, self.encoding)
+
+            # sanitize embedded markup
+            if self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types:
+                if element in self.can_contain_dangerous_markup:
+                    output = _sanitizeHTML(output, self.encoding)
 
         if self.encoding and type(output) != type(u''):
             try:
@@ -727,7 +796,7 @@ class _FeedParserMixin:
                 self.entries[-1][element].append(contentparams)
             elif element == 'link':
                 self.entries[-1][element] = output
-                if output:
+                if output and not self.profile.has_key('links'):
                     self.entries[-1]['links'][-1]['href'] = output
             else:
                 if element == 'description':
@@ -743,7 +812,8 @@ class _FeedParserMixin:
                 element = 'subtitle'
             context[element] = output
             if element == 'link':
-                context['links'][-1]['href'] = output
+                if not self.profile.has_key('links'):
+                    context['links'][-1]['href'] = output
             elif self.incontent:
                 contentparams = copy.deepcopy(self.contentparams)
                 contentparams['value'] = output
@@ -869,8 +939,9 @@ class _FeedParserMixin:
     def _start_textinput(self, attrsD):
         self.intextinput = 1
         self.push('textinput', 0)
-        context = self._getContext()
-        context.setdefault('textinput', FeedParserDict())
+        if not self.profile.has_key('textinput'):
+            context = self._getContext()
+            context.setdefault('textinput', FeedParserDict())
     _start_textInput = _start_textinput
     
     def _end_textinput(self):
@@ -939,8 +1010,7 @@ class _FeedParserMixin:
         elif self.incontributor:
             self._save_contributor('name', value)
         elif self.intextinput:
-            context = self._getContext()
-            context['textinput']['name'] = value
+            self._save_textinput('name', value)
     _end_itunes_name = _end_name
 
     def _start_width(self, attrsD):
@@ -984,8 +1054,7 @@ class _FeedParserMixin:
             context = self._getContext()
             context['image']['href'] = value
         elif self.intextinput:
-            context = self._getContext()
-            context['textinput']['link'] = value
+            self._save_textinput('link', value)
     _end_homepage = _end_url
     _end_uri = _end_url
 
@@ -1018,6 +1087,11 @@ class _FeedParserMixin:
         context[prefix + '_detail'][key] = value
         self._sync_author_detail()
 
+    def _save_textinput(self, key, value):
+        context = self._getContext()
+        if context.has_key('textinput'):
+            context['textinput'][key] = value
+
     def _save_contributor(self, key, value):
         context = self._getContext()
         context.setdefault('contributors', [FeedParserDict()])
@@ -1204,6 +1278,7 @@ class _FeedParserMixin:
     _end_itunes_category = _end_category
 
     def _start_cloud(self, attrsD):
+        if self.profile.has_key('cloud'): return
         self._getContext()['cloud'] = FeedParserDict(attrsD)
         
     def _start_link(self, attrsD):
@@ -1214,8 +1289,9 @@ class _FeedParserMixin:
             attrsD['href'] = self.resolveURI(attrsD['href'])
         expectingText = self.infeed or self.inentry or self.insource
         context = self._getContext()
-        context.setdefault('links', [])
-        context['links'].append(FeedParserDict(attrsD))
+        if not self.profile.has_key('links'):
+            context.setdefault('links', [])
+            context['links'].append(FeedParserDict(attrsD))
         if attrsD['rel'] == 'enclosure':
             self._start_enclosure(attrsD)
         if attrsD.has_key('href'):
@@ -1230,7 +1306,7 @@ class _FeedParserMixin:
         value = self.pop('link')
         context = self._getContext()
         if self.intextinput:
-            context['textinput']['link'] = value
+            self._save_textinput('link', value)
         if self.inimage:
             context['image']['link'] = value
     _end_producturl = _end_link
@@ -1256,7 +1332,7 @@ class _FeedParserMixin:
         value = self.popContent('title')
         context = self._getContext()
         if self.intextinput:
-            context['textinput']['title'] = value
+            self._save_textinput('title', value)
         elif self.inimage:
             context['image']['title'] = value
     _end_dc_title = _end_title
@@ -1280,7 +1356,7 @@ class _FeedParserMixin:
             value = self.popContent('description')
             context = self._getContext()
             if self.intextinput:
-                context['textinput']['description'] = value
+                self._save_textinput('description', value)
             elif self.inimage:
                 context['image']['description'] = value
         self._summaryKey = None
@@ -1343,7 +1419,8 @@ class _FeedParserMixin:
         
     def _start_enclosure(self, attrsD):
         attrsD = self._itsAnHrefDamnIt(attrsD)
-        self._getContext().setdefault('enclosures', []).append(FeedParserDict(attrsD))
+        if not self.profile.has_key('enclosures'):
+            self._getContext().setdefault('enclosures', []).append(FeedParserDict(attrsD))
         href = attrsD.get('href')
         if href:
             context = self._getContext()
@@ -1402,10 +1479,10 @@ class _FeedParserMixin:
 
 if _XML_AVAILABLE:
     class _StrictFeedParser(_FeedParserMixin, xml.sax.handler.ContentHandler):
-        def __init__(self, baseuri, baselang, encoding):
+        def __init__(self, baseuri, baselang, encoding, profile=None):
             if _debug: sys.stderr.write('trying StrictFeedParser\n')
             xml.sax.handler.ContentHandler.__init__(self)
-            _FeedParserMixin.__init__(self, baseuri, baselang, encoding)
+            _FeedParserMixin.__init__(self, baseuri, baselang, encoding, profile)
             self.bozo = 0
             self.exc = None
         
@@ -1594,9 +1671,9 @@ class _BaseHTMLProcessor(sgmllib.SGMLParser):
         return ''.join([str(p) for p in self.pieces])
 
 class _LooseFeedParser(_FeedParserMixin, _BaseHTMLProcessor):
-    def __init__(self, baseuri, baselang, encoding):
+    def __init__(self, baseuri, baselang, encoding, profile=None):
         sgmllib.SGMLParser.__init__(self)
-        _FeedParserMixin.__init__(self, baseuri, baselang, encoding)
+        _FeedParserMixin.__init__(self, baseuri, baselang, encoding, profile)
 
     def decodeEntities(self, element, data):
         data = data.replace('&#60;', '&lt;')
@@ -1622,6 +1699,146 @@ class _LooseFeedParser(_FeedParserMixin, _BaseHTMLProcessor):
     def strattrs(self, attrs):
         return ''.join([' %s="%s"' % t for t in attrs])
  
+# tokens recognised by _TolerantFeedParser; each alternative is wrapped in a
+# named group so that match.lastgroup says which one matched.  The patterns
+# follow what sgmllib (with the patches above) accepts, and the "broken"
+# alternatives catch markup that sgmllib would leave unterminated, which it
+# ends up passing on as text.  Runs of text and the predefined XML entities
+# form a single token, since handle_entityref keeps those entities verbatim.
+_tolerant_token = re.compile(r"""
+    (?P<data>(?:[^<&]+|&(?:lt|gt|amp|quot|apos);)+)
+  | (?P<starttag><(?P<tag>[a-zA-Z][-_.:a-zA-Z0-9]*)
+                  (?P<attrs>(?![-_.:a-zA-Z0-9])[^<>]*)(?:>|(?=<)))
+  | (?P<endtag></(?P<endname>[^<>]*)(?:>|(?=<)))
+  | (?P<comment><!--(?P<commenttext>.*?)--\s*>)
+  | (?P<brokencomment><!--)
+  | (?P<cdata><!\[CDATA\[(?P<cdatatext>.*?)(?:\]\]>|\Z))
+  | (?P<decl><![^>]*>)
+  | (?P<pi><\?(?P<pitext>[^>]*)>)
+  | (?P<lasttag><>)
+  | (?P<charref>&\#(?P<charname>x[0-9a-fA-F]+|[0-9]+)(?:;|(?=[^0-9a-fA-F])))
+  | (?P<entityref>&(?P<entityname>[a-zA-Z][-.a-zA-Z0-9]*)(?:;|(?=[^a-zA-Z0-9])))
+  | (?P<broken><(?:[a-zA-Z/!?]))
+  | (?P<text>[<&])
+""", re.VERBOSE | re.DOTALL)
+_tolerant_entitysplit = re.compile(r'(&(?:lt|gt|amp|quot|apos);)').split
+_tolerant_shorttag = re.compile(r'<([a-zA-Z][-.a-zA-Z0-9]*)/(?:([^/]*)/)?')
+_tolerant_attrfind = sgmllib.attrfind
+_tolerant_attrref = re.compile('&(?:([a-zA-Z][-.a-zA-Z0-9]*)|#([0-9]+))(;?)')
+_tolerant_attrentities = {'lt': '<', 'gt': '>', 'amp': '&', 'quot': '"', 'apos': "'"}
+
+def _tolerant_convert_ref(match):
+    # same conversion sgmllib.SGMLParser applies to attribute values
+    name, number, semicolon = match.groups()
+    if number:
+        if int(number) <= 127:
+            return chr(int(number))
+        return '&#%s%s' % (number, semicolon)
+    elif semicolon:
+        return _tolerant_attrentities.get(name, '&%s;' % name)
+    else:
+        return '&%s' % name
+
+class _TolerantFeedParser(_LooseFeedParser):
+    """Loose feed parser using a single regular expression tokenizer.
+
+    This drives exactly the same handlers as _LooseFeedParser, but walks the
+    document with one compiled pattern instead of sgmllib's per-character
+    dispatch, which makes it several times faster on illformed feeds.
+    """
+    _r_barebang = re.compile(r'<!((?!DOCTYPE|--|\[))', re.IGNORECASE)
+    _r_shorttag = re.compile(r'<([^<\s]+?)\s*/>')
+
+    def feed(self, data):
+        data = self._r_barebang.sub(r'&lt;!\1', data)
+        data = self._r_shorttag.sub(self._shorttag_replace, data)
+        data = data.replace('&#39;', "'")
+        data = data.replace('&#34;', '"')
+        if self.encoding and type(data) == type(u''):
+            data = data.encode(self.encoding)
+
+        match = _tolerant_token.match
+        lasttag = '???'
+        i = 0
+        n = len(data)
+        while i < n:
+            m = match(data, i)
+            kind = m.lastgroup
+            if kind == 'data':
+                text = m.group(kind)
+                if '&' in text and self.contentparams.get('type') == 'application/xhtml+xml':
+                    # inline xhtml escapes text, but not entity references
+                    for piece in _tolerant_entitysplit(text):
+                        if piece.startswith('&'):
+                            self.handle_entityref(piece[1:-1])
+                        elif piece:
+                            self.handle_data(piece)
+                else:
+                    self.handle_data(text)
+            elif kind == 'starttag' or kind == 'broken':
+                short = None
+                if kind == 'broken' or m.group('attrs')[:1] == '/':
+                    short = _tolerant_shorttag.match(data, i)
+                if short:
+                    # SGML shorthand: <tag/data/ == <tag>data</tag>
+                    if short.group(2) is None:
+                        break
+                    m = short
+                    tag = m.group(1).lower()
+                    self.unknown_starttag(tag, [])
+                    self.handle_data(m.group(2))
+                    self.unknown_endtag(tag)
+                elif kind == 'broken':
+                    # unterminated markup: treat everything left as text
+                    break
+                else:
+                    tag = lasttag = m.group('tag').lower()
+                    self.unknown_starttag(tag, self._parse_attrs(data, m.end('tag'), m.end('attrs')))
+            elif kind == 'endtag':
+                self.unknown_endtag(m.group('endname').strip().lower())
+            elif kind == 'charref':
+                self.handle_charref(m.group('charname'))
+            elif kind == 'entityref':
+                self.handle_entityref(m.group('entityname'))
+            elif kind == 'cdata':
+                self.handle_data(_xmlescape(m.group('cdatatext')), 0)
+            elif kind == 'comment':
+                self.handle_comment(m.group('commenttext'))
+            elif kind == 'decl':
+                # declarations are skipped, as in parse_declaration
+                pass
+            elif kind == 'pi':
+                self.handle_pi(m.group('pitext'))
+            elif kind == 'lasttag':
+                self.unknown_starttag(lasttag, [])
+            elif kind == 'text':
+                self.handle_data(m.group(kind))
+            else:
+                # unterminated comment: treat everything left as text
+                break
+            i = m.end()
+        if i < n:
+            self.handle_data(data[i:])
+
+    def _parse_attrs(self, data, k, j):
+        # like sgmllib, a quoted value may run on past the end of the tag
+        attrs = []
+        while k < j:
+            match = _tolerant_attrfind.match(data, k)
+            if not match: break
+            attrname, rest, attrvalue = match.group(1, 2, 3)
+            if not rest:
+                attrvalue = attrname
+            else:
+                if (attrvalue[:1] == "'" == attrvalue[-1:] or
+                    attrvalue[:1] == '"' == attrvalue[-1:]):
+                    attrvalue = attrvalue[1:-1]
+                if '&' in attrvalue:
+                    attrvalue = _tolerant_attrref.sub(_tolerant_convert_ref, attrvalue)
+            attrs.append((attrname.lower(), attrvalue))
+            k = match.end(0)
+        return attrs
+
 class _RelativeURIResolver(_BaseHTMLProcessor):
     relative_uris = [('a', 'href'),
                      ('applet', 'codebase'),
@@ -2507,6 +2724,10 @@ def _stripDoctype(data):
     rss_version may be 'rss091n' or None
     stripped_data is the same XML document, minus the DOCTYPE
     '''
+    # nothing can match past the last '>', and trying to match each of
+    # many unterminated declarations there would take quadratic time
+    end = data.rfind('>') + 1
+    data, tail = data[:end], data[end:]
     entity_pattern = re.compile(r'<!ENTITY([^>]*?)>', re.MULTILINE)
     data = entity_pattern.sub('', data)
     doctype_pattern = re.compile(r'<!DOCTYPE([^>]*?)>', re.MULTILINE)
@@ -2517,10 +2738,39 @@ def _stripDoctype(data):
     else:
         version = None
     data = doctype_pattern.sub('', data)
-    return version, data
+    return version, data + tail
     
-def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[]):
-    '''Parse a feed from a URL, file, stream, or string'''
+# Keys of a parse() result which come from parsing the document, rather than
+# from fetching it, and so can be shared between identical documents
+PARSE_RESULT_KEYS = ['feed', 'entries', 'version', 'namespaces', 'encoding',
+                     'bozo', 'bozo_exception']
+
+def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], profile=None, strict=1, results=None, sanitizer=None, sanitizer_version=None, content_sanitizer=None):
+    '''Parse a feed from a URL, file, stream, or string
+
+    profile is an optional list of result keys the caller has no use for,
+    see PROFILE_ELEMENTS; the elements producing them are not parsed.
+
+    strict=0 skips the XML parser and goes straight to the loose one, for
+    feeds the caller knows aren't well-formed.  The time taken by each
+    parser is returned in strict_parse_time and loose_parse_time.
+
+    results is an optional dictionary of earlier results keyed by the SHA-1
+    digest of the document, a space, and a digest of all else its parse
+    depends on: the base URI and language, the HTTP Content-Type, and the
+    version of the parser and of the sanitizer.  The digest of the
+    document alone is returned in digest.  Documents found there aren't parsed again.  Only
+    the PARSE_RESULT_KEYS of each result are stored, and they are shared,
+    so mustn't be modified.
+
+    sanitizer is an optional function(html, encoding, baseuri) used to
+    resolve relative URIs within embedded markup and sanitize it in a
+    single pass, instead of _resolveRelativeURIs and _sanitizeHTML.
+    content_sanitizer, if given, is used instead of sanitizer for the
+    content and summary of entries, the markup that can be truncated.
+    sanitizer_version is a string that changes whenever the output of
+    either would, for the results key.
+    '''
     result = FeedParserDict()
     result['feed'] = FeedParserDict()
     result['entries'] = []
@@ -2607,6 +2857,15 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
     if not data:
         return result
 
+    # if we've parsed this document before, we're done
+    result['digest'] = _sha1(data).hexdigest()
+    results_key = result['digest'] + ' ' + _sha1(repr((baseuri, baselang,
+        http_headers.get('content-type'), __version__,
+        sanitizer_version))).hexdigest()
+    if results is not None and results.has_key(results_key):
+        result.update(results[results_key])
+        return result
+
     # determine character encoding
     use_strict_parser = 0
     known_encoding = 0
@@ -2665,11 +2924,14 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
             (result['encoding'], proposed_encoding))
         result['encoding'] = proposed_encoding
 
-    if not _XML_AVAILABLE:
+    if not _XML_AVAILABLE or not strict:
         use_strict_parser = 0
     if use_strict_parser:
+        started = time.time()
         # initialize the SAX parser
-        feedparser = _StrictFeedParser(baseuri, baselang, 'utf-8')
+        feedparser = _StrictFeedParser(baseuri, baselang, 'utf-8', profile)
+        feedparser.sanitizer = sanitizer
+        feedparser.content_sanitizer = content_sanitizer
         saxparser = xml.sax.make_parser(PREFERRED_XML_PARSERS)
         saxparser.setFeature(xml.sax.handler.feature_namespaces, 1)
         saxparser.setContentHandler(feedparser)
@@ -2691,13 +2953,27 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
             result['bozo'] = 1
             result['bozo_exception'] = feedparser.exc or e
             use_strict_parser = 0
+        result['strict_parse_time'] = time.time() - started
     if not use_strict_parser:
-        feedparser = _LooseFeedParser(baseuri, baselang, known_encoding and 'utf-8' or '')
+        started = time.time()
+        if LOOSE_PARSER == 'sgmllib':
+            feedparser = _LooseFeedParser(baseuri, baselang, known_encoding and 'utf-8' or '', profile)
+        else:
+            feedparser = _TolerantFeedParser(baseuri, baselang, known_encoding and 'utf-8' or '', profile)
+        feedparser.sanitizer = sanitizer
+        feedparser.content_sanitizer = content_sanitizer
         feedparser.feed(data)
+        result['loose_parse_time'] = time.time() - started
     result['feed'] = feedparser.feeddata
     result['entries'] = feedparser.entries
     result['version'] = result['version'] or feedparser.version
     result['namespaces'] = feedparser.namespacesInUse
+    if results is not None:
+        saved = {}
+        for key in PARSE_RESULT_KEYS:
+            if result.has_key(key):
+                saved[key] = result[key]
+        results[results_key] = saved
     return result
 
 if __name__ == '__main__':
@@ -6,7 +6,7 @@ __author__ = ["Mark Pilgrim <http://diveintomark.org/>",
               "Aaron Swartz <http://www.aaronsw.com/>"]
 __contributors__ = ["Sam Ruby <http://intertwingly.net/>"]
 __license__ = "BSD"
-__version__ = "0.25"
+__version__ = "0.27"
 
 _debug = 0
 
@@ -19,7 +19,18 @@ TIDY_MARKUP = 0
 # if TIDY_MARKUP = 1
 PREFERRED_TIDY_INTERFACES = ["uTidy", "mxTidy"]
 
-import sgmllib, re
+# Sanitizer used by HTML(): "fast" is a regular expression tokenizer, and
+# "sgmllib" the original sgmllib.SGMLParser based one, kept as a fallback
+# should the fast one misbehave.
+ENGINE = "fast"
+
+import sgmllib, re, urlparse, htmlentitydefs, hashlib, time
+
+# sqlite3 is needed for the cache of sanitized HTML (SanitizeCache)
+try:
+    import sqlite3
+except:
+    sqlite3 = None
 
 # chardet library auto-detects character encodings
 # Download from http://chardet.feedparser.org/
@@ -34,6 +45,15 @@ except:
     chardet = None
     _chardet = lambda data: None
 
+_r_attrbareamp = re.compile("&(?!#\d+;|#x[0-9a-fA-F]+;|\w+;)")
+
+def _escape_attr(value):
+    """Escape an attribute value, whose references have been decoded, to
+    be written back inside double quotes."""
+    value = _r_attrbareamp.sub('&amp;', value)
+    value = value.replace('<', '&lt;').replace('>', '&gt;')
+    return value.replace('"', '&#34;').replace("'", '&#39;')
+
 class _BaseHTMLProcessor(sgmllib.SGMLParser):
     elements_no_end_tag = ['area', 'base', 'basefont', 'br', 'col', 'frame', 'hr',
       'img', 'input', 'isindex', 'link', 'meta', 'param']
@@ -83,7 +103,7 @@ class _BaseHTMLProcessor(sgmllib.SGMLParser):
             if type(value) != type(u''):
                 value = unicode(value, self.encoding)
             uattrs.append((unicode(key, self.encoding), value))
-        strattrs = u''.join([u' %s="%s"' % (key, value) for key, value in uattrs]).encode(self.encoding)
+        strattrs = u''.join([u' %s="%s"' % (key, _escape_attr(value)) for key, value in uattrs]).encode(self.encoding)
         if tag in self.elements_no_end_tag:
             self.pieces.append('<%(tag)s%(strattrs)s />' % locals())
         else:
@@ -230,10 +250,337 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
             text = text.replace('<', '')
             _BaseHTMLProcessor.handle_data(self, text)
 
-def HTML(htmlSource, encoding='utf8'):
-    p = _HTMLSanitizer(encoding)
-    p.feed(htmlSource)
-    data = p.output()
+_r_urifixer = re.compile('^([A-Za-z][A-Za-z0-9+-.]*://)(/*)(.*?)')
+
+def _resolveURI(baseuri, uri):
+    uri = _r_urifixer.sub(r'\1\3', uri)
+    return urlparse.urljoin(baseuri, uri)
+
+class _ContentSanitizer(_HTMLSanitizer):
+    """Resolve relative URIs and sanitize in a single pass.
+
+    Gives the same result as feedparser's _resolveRelativeURIs and
+    _sanitizeHTML followed by _HTMLSanitizer, but tokenizes the markup once
+    rather than three times.
+    """
+    relative_uris = [('a', 'href'),
+                     ('applet', 'codebase'),
+                     ('area', 'href'),
+                     ('blockquote', 'cite'),
+                     ('body', 'background'),
+                     ('del', 'cite'),
+                     ('form', 'action'),
+                     ('frame', 'longdesc'),
+                     ('frame', 'src'),
+                     ('iframe', 'longdesc'),
+                     ('iframe', 'src'),
+                     ('head', 'profile'),
+                     ('img', 'longdesc'),
+                     ('img', 'src'),
+                     ('img', 'usemap'),
+                     ('input', 'src'),
+                     ('input', 'usemap'),
+                     ('ins', 'cite'),
+                     ('link', 'href'),
+                     ('object', 'classid'),
+                     ('object', 'codebase'),
+                     ('object', 'data'),
+                     ('object', 'usemap'),
+                     ('q', 'cite'),
+                     ('script', 'src')]
+
+    def __init__(self, encoding, baseuri):
+        _HTMLSanitizer.__init__(self, encoding)
+        self.baseuri = baseuri
+
+    def resolveURI(self, uri):
+        return _resolveURI(self.baseuri, uri)
+
+    def feed(self, data):
+        data = data.replace('&#39;', "'")
+        data = data.replace('&#34;', '"')
+        _HTMLSanitizer.feed(self, data)
+
+    def unknown_starttag(self, tag, attrs):
+        if tag in self.acceptable_elements and not self.ignore_level:
+            attrs = self.normalize_attrs(attrs)
+            attrs = [(key, ((tag, key) in self.relative_uris) and self.resolveURI(value) or value) for key, value in attrs]
+        _HTMLSanitizer.unknown_starttag(self, tag, attrs)
+
+    def handle_entityref(self, ref):
+        if htmlentitydefs.name2codepoint.has_key(ref):
+            self.pieces.append('&%(ref)s;' % locals())
+        else:
+            self.pieces.append('&amp;%(ref)s' % locals())
+
+_fast_token = re.compile(r"""
+    (?P<data>[^<&]+)
+  | (?P<starttag><(?P<tag>[a-zA-Z][-_.:a-zA-Z0-9]*)
+                  (?P<attrs>(?![-_.:a-zA-Z0-9])[^<>]*)(?:>|(?=<)))
+  | (?P<endtag></(?P<endname>[^<>]*)(?:>|(?=<)))
+  | (?P<comment><!--(?P<commenttext>.*?)--\s*>)
+  | (?P<pi><\?[^>]*>)
+  | (?P<lasttag><>)
+  | (?P<charref>&\#(?P<charname>x?[0-9A-Fa-f]+)(?:;|(?=[^0-9A-Fa-f])))
+  | (?P<entityref>&(?P<entityname>[a-zA-Z][-.a-zA-Z0-9]*)(?:;|(?=[^a-zA-Z0-9])))
+  | (?P<amp>&(?:[a-zA-Z][a-zA-Z0-9]*|\#[0-9]*)?)
+  | (?P<lt><(?![a-zA-Z/!?>]))
+""", re.VERBOSE | re.DOTALL)
+_fast_declaration = re.compile(r'<!(?!--)')
+_fast_shorttag = re.compile(r'<([a-zA-Z][-.a-zA-Z0-9]*)/(?:([^/]*)/)?')
+_fast_attrfind = sgmllib.attrfind
+_fast_attrref = re.compile('&(?:([a-zA-Z][-.a-zA-Z0-9]*)|#([0-9]+))(;?)')
+_fast_attrentities = {'lt': '<', 'gt': '>', 'amp': '&', 'quot': '"', 'apos': "'"}
+
+def _fast_convert_ref(match):
+    # same conversion sgmllib.SGMLParser applies to attribute values
+    name, number, semicolon = match.groups()
+    if number:
+        if int(number) <= 127:
+            return chr(int(number))
+        return '&#%s%s' % (number, semicolon)
+    elif semicolon:
+        return _fast_attrentities.get(name, '&%s;' % name)
+    else:
+        return '&%s' % name
+
+class _FastSanitizer:
+    """Sanitizer using a single regular expression tokenizer.
+
+    Produces the same output as _HTMLSanitizer, or _ContentSanitizer if a
+    baseuri is given, but walks the markup with one compiled pattern and
+    checks the whitelists with sets.  Attribute values are kept as encoded
+    strings rather than decoded and encoded again.  Markup containing SGML
+    declarations, which are rare, is handed to the sgmllib based sanitizer.
+    """
+    def __init__(self, encoding, baseuri=None):
+        self.encoding = encoding
+        self.baseuri = baseuri
+        self.pieces = []
+        self.acceptable_elements = set(_HTMLSanitizer.acceptable_elements)
+        self.acceptable_attributes = set(_HTMLSanitizer.acceptable_attributes)
+        self.ignorable_elements = set(_HTMLSanitizer.ignorable_elements)
+        self.elements_no_end_tag = set(_HTMLSanitizer.elements_no_end_tag)
+        self.relative_uris = set(_ContentSanitizer.relative_uris)
+
+    def feed(self, data):
+        if self.baseuri is not None:
+            data = data.replace('&#39;', "'")
+            data = data.replace('&#34;', '"')
+        data = _HTMLSanitizer._r_barebang.sub(r'&lt;!\1', data)
+        data = _HTMLSanitizer._r_bareamp.sub("&amp;", data)
+        data = _HTMLSanitizer._r_shorttag.sub(self._shorttag_replace, data)
+        if self.encoding and type(data) == type(u''):
+            data = data.encode(self.encoding)
+
+        if _fast_declaration.search(data):
+            if self.baseuri is None:
+                p = _HTMLSanitizer(self.encoding)
+            else:
+                p = _ContentSanitizer(self.encoding, self.baseuri)
+            sgmllib.SGMLParser.feed(p, data)
+            while p.tag_stack:
+                _BaseHTMLProcessor.unknown_endtag(p, p.tag_stack.pop())
+            self.pieces = p.pieces
+            return
+
+        match = _fast_token.match
+        append = self.pieces.append
+        self.tag_stack = []
+        self.ignore_level = 0
+        lasttag = '???'
+        i = 0
+        n = len(data)
+        while i < n:
+            m = match(data, i)
+            kind = m and m.lastgroup
+            if kind is None or (kind == 'starttag' and m.group('attrs')[:1] == '/'):
+                # SGML shorthand: <tag/data/ == <tag>data</tag>
+                short = _fast_shorttag.match(data, i)
+                if short:
+                    if short.group(2) is None:
+                        break
+                    tag = short.group(1).lower()
+                    self.start(tag)
+                    if not self.ignore_level:
+                        append(short.group(2).replace('<', ''))
+                    self.end(tag)
+                    i = short.end()
+                    continue
+                elif kind is None:
+                    # unterminated markup, sgmllib would wait for more
+                    break
+            i = m.end()
+
+            if kind == 'data':
+                if not self.ignore_level:
+                    append(m.group(kind))
+            elif kind == 'starttag':
+                lasttag = m.group('tag').lower()
+                self.start(lasttag, data, m.end('tag'), m.end('attrs'))
+            elif kind == 'endtag':
+                self.end(m.group('endname').strip().lower())
+            elif kind == 'charref':
+                append('&#%s;' % m.group('charname'))
+            elif kind == 'entityref':
+                self.handle_entityref(m.group('entityname'))
+            elif kind == 'comment':
+                append('<!--%s-->' % m.group('commenttext'))
+            elif kind == 'lasttag':
+                self.start(lasttag)
+            elif kind == 'amp':
+                if i == n:
+                    break
+                if not self.ignore_level:
+                    append(m.group(kind))
+            elif kind == 'lt':
+                if i == n:
+                    break
+
+        while self.tag_stack:
+            append('</%s>' % self.tag_stack.pop())
+
+    def start(self, tag, data='', k=0, j=0):
+        if tag in self.ignorable_elements:
+            self.ignore_level += 1
+        elif not self.ignore_level and tag in self.acceptable_elements:
+            attrs = self.attrs(tag, data, k, j)
+            if tag in self.elements_no_end_tag:
+                self.pieces.append('<%s%s />' % (tag, attrs))
+            else:
+                self.tag_stack.append(tag)
+                self.pieces.append('<%s%s>' % (tag, attrs))
+
+    def end(self, tag):
+        if tag in self.ignorable_elements:
+            self.ignore_level -= 1
+        elif not self.ignore_level and tag in self.acceptable_elements \
+                 and tag not in self.elements_no_end_tag:
+            # close anything left open inside the element, and the element
+            # itself if it was opened
+            while self.tag_stack:
+                top = self.tag_stack.pop()
+                self.pieces.append('</%s>' % top)
+                if top == tag:
+                    break
+
+    def _shorttag_replace(self, match):
+        tag = match.group(1)
+        if tag in self.elements_no_end_tag:
+            return '<' + tag + ' />'
+        else:
+            return '<' + tag + '></' + tag + '>'
+
+    def attrs(self, tag, data, k, j):
+        """Return the whitelisted attributes of the tag, ready for output."""
+        # like sgmllib, a quoted value may run on past the end of the tag
+        attrs = []
+        while k < j:
+            match = _fast_attrfind.match(data, k)
+            if not match: break
+            k = match.end(0)
+            name, rest, value = match.group(1, 2, 3)
+            key = name.lower()
+            if key not in self.acceptable_attributes:
+                continue
+            if not rest:
+                value = name
+            else:
+                if (value[:1] == "'" == value[-1:] or
+                    value[:1] == '"' == value[-1:]):
+                    value = value[1:-1]
+                if '&' in value:
+                    value = _fast_attrref.sub(_fast_convert_ref, value)
+            if key == 'rel' or key == 'type':
+                value = value.lower() or value
+            if self.baseuri is not None and (tag, key) in self.relative_uris:
+                value = _resolveURI(self.baseuri, value) or value
+            attrs.append(' %s="%s"' % (key, _escape_attr(value)))
+        return ''.join(attrs)
+
+    def handle_entityref(self, ref):
+        if self.baseuri is not None and \
+               not htmlentitydefs.name2codepoint.has_key(ref):
+            self.pieces.append('&amp;%s' % ref)
+        else:
+            self.pieces.append('&%s;' % ref)
+
+    def output(self):
+        return ''.join(self.pieces)
+
+# Comment left at the end of HTML truncated by HTML(), giving the size of
+# the original
+TRUNCATED = "<!-- truncated from %d bytes -->"
+_r_truncated = re.compile(r"<!-- truncated from (\d+) bytes -->$")
+_r_any_truncated = re.compile(r"<!-- truncated from \d+ bytes -->")
+
+def _truncate(data, max_bytes):
+    """Cut data at the last tag or space before max_bytes.
+
+    Anything left unterminated at the end is dropped by the sanitizer, and
+    elements still open are closed.
+    """
+    cut = max(data.rfind('<', 0, max_bytes + 1),
+              data.rfind(' ', 0, max_bytes + 1),
+              data.rfind('\n', 0, max_bytes + 1))
+    if cut <= 0:
+        # no boundary at all, but don't split a UTF-8 character
+        cut = max_bytes
+        while type(data) == type('') and cut and '\x80' <= data[cut] < '\xc0':
+            cut -= 1
+    return data[:cut]
+
+def _strip_truncated(data):
+    """Remove any TRUNCATED comments from data, including those only
+    formed once others are removed."""
+    while 1:
+        stripped = _r_any_truncated.sub('', data)
+        if stripped == data:
+            return data
+        data = stripped
+
+def truncated(data):
+    """Return data without HTML()'s truncation comment, and the original
+    size, or None if data wasn't truncated."""
+    match = _r_truncated.search(data)
+    if match:
+        return data[:match.start()], int(match.group(1))
+    return data, None
+
+def HTML(htmlSource, encoding='utf8', baseuri=None, max_bytes=0):
+    """Sanitize HTML.
+
+    If a baseuri is given relative URIs are resolved against it in the same
+    pass, so this can be given to feedparser.parse() as its sanitizer.
+
+    HTML longer than max_bytes, if given, is truncated before it's
+    sanitized, and the result ends with a TRUNCATED comment.  Any such
+    comment in the HTML itself is removed, so it can't pass for one.
+    """
+    size = 0
+    if max_bytes:
+        if encoding and type(htmlSource) == type(u''):
+            htmlSource = htmlSource.encode(encoding)
+        if len(htmlSource) > max_bytes:
+            size = len(htmlSource)
+            htmlSource = _truncate(htmlSource, max_bytes)
+
+    if ENGINE != 'sgmllib':
+        p = _FastSanitizer(encoding, baseuri)
+    elif baseuri is None:
+        p = _HTMLSanitizer(encoding)
+    else:
+        p = _ContentSanitizer(encoding, baseuri)
+    try:
+        p.feed(htmlSource)
+        data = p.output()
+    except sgmllib.SGMLParseError:
+        # markup sgmllib gives up on, such as a broken declaration, is
+        # shown as text rather than stopping the run
+        if encoding and type(htmlSource) == type(u''):
+            htmlSource = htmlSource.encode(encoding)
+        data = htmlSource.replace('&', '&amp;').replace('<', '&lt;')
+        data = data.replace('>', '&gt;')
     if TIDY_MARKUP:
         # loop through list of preferred Tidy interfaces looking for one that's installed,
         # then set up a common _tidy function to wrap the interface-specific API.
@@ -266,9 +613,90 @@ def HTML(htmlSource, encoding='utf8'):
                     data = data.split('>', 1)[1]
             if data.count('</body'):
                 data = data.split('</body', 1)[0]
-    data = data.strip().replace('\r\n', '\n')
+    data = _strip_truncated(data).strip().replace('\r\n', '\n')
+    if size:
+        data += TRUNCATED % size
     return data
 
+def version():
+    """Return a digest of the sanitizer's version, engine and whitelists,
+    which changes whenever the same arguments to HTML() could give other
+    results."""
+    return hashlib.sha1(repr((__version__, ENGINE, TIDY_MARKUP,
+        _HTMLSanitizer.acceptable_elements,
+        _HTMLSanitizer.acceptable_attributes,
+        _HTMLSanitizer.ignorable_elements,
+        _ContentSanitizer.relative_uris))).hexdigest()
+
+class SanitizeCache:
+    """Sanitized HTML kept on disk between runs.
+
+    Feeds republish the same entries run after run, so rather than
+    sanitizing the same HTML again the results are kept in an SQLite
+    database, keyed by a digest of the input, the arguments and the
+    sanitizer's version and whitelists.  Only the most recently used
+    max_entries are kept.  Several processes may share the one file.
+
+    Use the HTML method in place of HTML().
+    """
+    # Number of new results to write before committing, so other
+    # processes aren't locked out of the file for long
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, filename, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._used = {}
+        self._pending = 0
+
+        self._db = sqlite3.connect(filename, timeout=30)
+        self._db.text_factory = str
+        self._db.execute("CREATE TABLE IF NOT EXISTS sanitized "
+                         "(key TEXT PRIMARY KEY, value BLOB, used REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS sanitized_used "
+                         "ON sanitized (used)")
+        self._db.commit()
+
+        self._version = version()
+
+    def key(self, htmlSource, encoding, baseuri, max_bytes=0):
+        """Return the cache key for the arguments to HTML()."""
+        if type(htmlSource) == type(u''):
+            htmlSource = htmlSource.encode('utf-8')
+        return hashlib.sha1("%s %s %r %d %s" % (self._version, encoding,
+                            baseuri, max_bytes, htmlSource)).hexdigest()
+
+    def HTML(self, htmlSource, encoding='utf8', baseuri=None, max_bytes=0):
+        """Sanitize HTML, or return the result from last time."""
+        key = self.key(htmlSource, encoding, baseuri, max_bytes)
+        row = self._db.execute("SELECT value FROM sanitized WHERE key = ?",
+                               (key,)).fetchone()
+        if row is not None:
+            self.hits += 1
+            self._used[key] = time.time()
+            return str(row[0])
+
+        self.misses += 1
+        data = HTML(htmlSource, encoding, baseuri, max_bytes)
+        self._db.execute("INSERT OR REPLACE INTO sanitized VALUES (?, ?, ?)",
+                         (key, buffer(data), time.time()))
+        self._pending += 1
+        if self._pending >= self.COMMIT_INTERVAL:
+            self._db.commit()
+            self._pending = 0
+        return data
+
+    def close(self):
+        """Record which results were used, evict the rest, and close."""
+        self._db.executemany("UPDATE sanitized SET used = ? WHERE key = ?",
+                             [ (used, key) for key, used in self._used.items() ])
+        self._db.execute("DELETE FROM sanitized WHERE key IN "
+                         "(SELECT key FROM sanitized ORDER BY used DESC "
+                         "LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self._db.commit()
+        self._db.close()
+
 unicode_bom_map = {
   '\x00\x00\xfe\xff': 'utf-32be',
   '\xff\xfe\x00\x00': 'utf-32le',
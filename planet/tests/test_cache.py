@@ -0,0 +1,763 @@
+#!/usr/bin/env python
+import os, shutil, tempfile, unittest
+from ConfigParser import ConfigParser
+import planet
+from planet import benchmark, bulk, cache
+
+FIELDS = {'title': (cache.CachedInfo.STRING, 'Title'),
+          'date': (cache.CachedInfo.DATE, '2006 1 2 3 4 5 0 2 0'),
+          'order': (cache.CachedInfo.STRING, '3')}
+
+class DBCacheTest(unittest.TestCase):
+
+    def test_layout(self):
+        db = {}
+        store = cache.DBCache(db)
+        store.write(None, {'url': (cache.CachedInfo.STRING, 'http://x/')})
+        store.write('item', FIELDS)
+        self.assertEqual(db['url'], 'http://x/')
+        self.assertEqual(db['item title'], 'Title')
+        self.assertEqual(db['item title type'], 'string')
+        self.assertEqual(store.read('item'), FIELDS)
+        self.assertEqual(store.ids(), ['item'])
+        store.delete('item')
+        self.assertEqual(store.ids(), [])
+        keys = db.keys()
+        keys.sort()
+        self.assertEqual(keys, [' keys', 'url', 'url type'])
+
+class CompactDBCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'channel')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_layout(self):
+        db = {}
+        store = cache.CompactDBCache(db)
+        store.write(None, {'url': (cache.CachedInfo.STRING, 'http://x/')})
+        store.write('item', FIELDS)
+        keys = db.keys()
+        keys.sort()
+        self.assertEqual(keys, [' channel', ' version', 'item'])
+        self.assertEqual(store.read('item'), FIELDS)
+        fields, others = store.read_keys('item', ['order'])
+        others.sort()
+        self.assertEqual(fields, {'order': FIELDS['order']})
+        self.assertEqual(others, ['date', 'title'])
+        store.write_keys('item', {'order': (cache.CachedInfo.STRING, '4')},
+                         ['title'])
+        self.assertEqual(store.read('item')['order'][1], '4')
+        self.failIf(store.read('item').has_key('title'))
+        self.assertEqual(store.ids(), ['item'])
+        store.delete('item')
+        self.assertEqual(store.ids(), [])
+
+    def test_upgrade(self):
+        old = cache.DBCache(cache.dbhash.open(self.filename, 'c'))
+        old.write(None, {'url': (cache.CachedInfo.STRING, 'http://x/')})
+        old.write('item', FIELDS)
+        old.close()
+
+        store = cache.open_dbhash(self.filename)
+        self.failIf(isinstance(store, cache.CompactDBCache))
+        self.assertEqual(store.read('item'), FIELDS)
+        store.close()
+
+        upgraded = cache.upgrade(self.directory)
+        self.assertEqual([ name for name, old, new in upgraded ], ['channel'])
+        self.assertEqual(cache.upgrade(self.directory), [])
+
+        store = cache.open_dbhash(self.filename)
+        self.assert_(isinstance(store, cache.CompactDBCache))
+        self.assertEqual(store.read(None)['url'][1], 'http://x/')
+        self.assertEqual(store.read('item'), FIELDS)
+        self.assertEqual(store.ids(), ['item'])
+        store.close()
+
+class LockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'channel')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def other_process_locks(self, exclusive):
+        pid = os.fork()
+        if pid == 0:
+            cache.FileLock._locks.clear()
+            db = cache.LockedDB(self.filename)
+            os._exit(db.lock(exclusive, blocking=0))
+        return os.WEXITSTATUS(os.waitpid(pid, 0)[1])
+
+    def test_processes(self):
+        if cache.fcntl is None: return
+        db = cache.LockedDB(self.filename)
+        db['key'] = 'value'
+        self.failIf(self.other_process_locks(0))
+        db.release()
+        self.failIf(self.other_process_locks(0))
+        db.sync()
+        db.release()
+        self.assert_(self.other_process_locks(1))
+
+        self.assertEqual(db['key'], 'value')
+        self.assert_(self.other_process_locks(0))
+        self.failIf(self.other_process_locks(1))
+
+    def test_changed(self):
+        db = cache.LockedDB(self.filename)
+        db['key'] = 'value'
+        db.sync()
+        db.release()
+        other = cache.LockedDB(self.filename)
+        self.assertEqual(other['key'], 'value')
+        other['key'] = 'other value'
+        other.close()
+        self.assertEqual(db['key'], 'other value')
+        self.assert_(db.changed())
+        self.failIf(db.changed())
+
+class HandlePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.size = cache.handles.size
+        cache.handles.size = 2
+        # files the other tests left open would be made room for too
+        for tick, ref in cache.handles._used.values():
+            if ref() is not None:
+                ref().sync()
+                ref().release()
+        cache.handles.reset()
+
+    def tearDown(self):
+        cache.handles.size = self.size
+        shutil.rmtree(self.directory)
+
+    def test_evict(self):
+        dbs = [ cache.LockedDB(os.path.join(self.directory, name))
+                for name in ('one', 'two', 'three') ]
+        for db in dbs:
+            db['key'] = db.filename
+        self.assertEqual(len([ db for db in dbs if db._db is not None ]), 2)
+        self.assertEqual(cache.handles.evicted, 1)
+
+        # the evicted file was synced, and is opened again when used
+        self.failIf(dbs[0]._pending)
+        for db in dbs:
+            self.assertEqual(db['key'], db.filename)
+        self.assertEqual(cache.handles.opened, 6)
+        self.assertEqual(cache.handles.evicted, 4)
+
+    def test_planet(self):
+        config = ConfigParser()
+        config.add_section('Planet')
+        config.set('Planet', 'cache_directory', self.directory)
+        config.set('Planet', 'new_feed_items', '0')
+        config.set('Planet', 'sanitize_cache_size', '0')
+        for feed in ('planet/tests/data/before.atom',
+                     'planet/tests/data/before.rss'):
+            config.add_section(feed)
+        expected = planet.Planet(config)
+        expected.run('test', 'http://example.com', [], 0)
+        config.set('Planet', 'cache_handles', '1')
+        my_planet = planet.Planet(config)
+        my_planet.run('test', 'http://example.com', [], 0)
+        self.assert_(planet.stats.get('cache_handles_evicted'))
+        self.assertEqual([ item.id for item in my_planet.items() ],
+                         [ item.id for item in expected.items() ])
+
+class LazyTest(unittest.TestCase):
+
+    def test_read_keys(self):
+        store = cache.DBCache({})
+        store.write('item', FIELDS)
+        info = cache.CachedInfo(store, 'item')
+        info.cache_read(['date', 'order'])
+        keys = info._value.keys()
+        keys.sort()
+        self.assertEqual(keys, ['date', 'order'])
+        self.assert_(info.has_key('title'))
+        self.assertEqual(info.date, (2006, 1, 2, 3, 4, 5, 0, 2, 0))
+
+        keys = info.keys()
+        keys.sort()
+        self.assertEqual(keys, ['date', 'order', 'title'])
+        self.assertEqual(info.title, 'Title')
+        self.failIf(info._unread)
+
+    def test_write(self):
+        store = cache.DBCache({})
+        store.write('item', FIELDS)
+        info = cache.CachedInfo(store, 'item')
+        info.cache_read(['date'])
+        info.order = '4'
+        info.cache_write(sync=0)
+        fields = FIELDS.copy()
+        fields['order'] = (cache.CachedInfo.STRING, '4')
+        self.assertEqual(store.read('item'), fields)
+
+class DateTest(unittest.TestCase):
+
+    def test_epoch(self):
+        store = cache.DBCache({})
+        info = cache.CachedInfo(store, 'item')
+        info.set_as_date('date', (2006, 1, 2, 3, 4, 5, 0, 2, 0))
+        self.assertEqual(info.get_as_epoch('date'), 1136171045)
+        info.cache_write(sync=0)
+        self.assertEqual(store.read('item'),
+                         {'date': (cache.CachedInfo.DATE, '1136171045')})
+
+        info = cache.CachedInfo(store, 'item')
+        info.cache_read()
+        self.assertEqual(info.date, (2006, 1, 2, 3, 4, 5, 0, 2, 0))
+
+    def test_old_format(self):
+        store = cache.DBCache({})
+        store.write('item', FIELDS)
+        info = cache.CachedInfo(store, 'item')
+        info.cache_read()
+        self.assertEqual(info.get_as_epoch('date'), 1136171045)
+        self.assertEqual(info.date, (2006, 1, 2, 3, 4, 5, 0, 2, 0))
+
+class SQLiteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cache(self):
+        if cache.sqlite3 is None: return
+        one = cache.SQLiteCache(self.filename, 'one')
+        two = cache.SQLiteCache(self.filename, 'two')
+        one.write(None, {'url': (cache.CachedInfo.STRING, 'http://x/')})
+        one.write('a', FIELDS)
+        fields = FIELDS.copy()
+        fields['order'] = (cache.CachedInfo.STRING, '4')
+        two.write('b', fields)
+        fields['hidden'] = (cache.CachedInfo.STRING, 'yes')
+        two.write('c', fields)
+
+        self.assertEqual(one.read('a'), FIELDS)
+        self.assertEqual(one.read('b'), {})
+        self.assertEqual(one.ids(), ['a'])
+        self.assertEqual([ row[:2] for row in one.timeline() ],
+                         [('two', 'b'), ('one', 'a')])
+        self.assertEqual(len(list(one.timeline(hidden=1))), 3)
+        two.delete('b')
+        self.assertEqual(two.ids(), ['c'])
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        planet.logging.basicConfig()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_planet(self, offline):
+        config = ConfigParser()
+        config.add_section('Planet')
+        config.set('Planet', 'cache_directory', self.directory)
+        config.set('Planet', 'new_feed_items', '0')
+        config.set('Planet', 'sanitize_cache_size', '0')
+        for feed in ('planet/tests/data/before.atom',
+                     'planet/tests/data/before.rss'):
+            config.add_section(feed)
+        my_planet = planet.Planet(config)
+        my_planet.run('test', 'http://example.com', [], offline)
+        return my_planet
+
+    def test_snapshot(self):
+        my_planet = self.run_planet(0)
+        expected = [ item.id for item in my_planet.items() ]
+        expected_one = [ item.id for item in my_planet.items(max_items=1) ]
+
+        my_planet = self.run_planet(1)
+        self.assertEqual([ item.id for item in my_planet.items(max_items=1) ],
+                         expected_one)
+        for channel in my_planet.channels():
+            self.failIf(channel.items_read())
+        self.assertEqual([ item.id for item in my_planet.items() ], expected)
+
+        # a channel changed since the snapshot was taken is read in full
+        channel = my_planet.channels()[0]
+        channel.cache_serial = '-1'
+        self.failIf(my_planet.snapshot.fresh(channel))
+        self.assertEqual([ item.id for item in my_planet.items() ], expected)
+        self.assert_(channel.items_read())
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        planet.logging.basicConfig()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_planet(self, render, feeds=('planet/tests/data/before.atom',
+                                        'planet/tests/data/before.rss'),
+                   offline=0):
+        config = ConfigParser()
+        config.add_section('Planet')
+        config.set('Planet', 'cache_directory', self.directory)
+        config.set('Planet', 'cache_export', 'yes')
+        config.set('Planet', 'new_feed_items', '0')
+        config.set('Planet', 'sanitize_cache_size', '0')
+        for feed in feeds:
+            config.add_section(feed)
+        my_planet = planet.Planet(config)
+        my_planet.run('test', 'http://example.com', [], offline, render)
+        return my_planet
+
+    def test_render(self):
+        my_planet = self.run_planet(0)
+        expected = [ (item.id, item.title, item.date)
+                     for item in my_planet.items() ]
+        names = [ channel.name for channel in my_planet.channels() ]
+
+        my_planet = self.run_planet(1)
+        for channel in my_planet.channels():
+            self.assert_(isinstance(channel._cache, cache.ExportCache))
+        self.assertEqual([ channel.name for channel in my_planet.channels() ],
+                         names)
+        self.assertEqual([ (item.id, item.title, item.date)
+                           for item in my_planet.items() ], expected)
+        channel = my_planet.channels()[0]
+        channel.cache_serial = '-1'
+        self.assertEqual([ (item.id, item.title, item.date)
+                           for item in my_planet.items() ], expected)
+        self.assertRaises(IOError, channel.cache_write)
+
+    def test_channel_fields(self):
+        feed = os.path.join(self.directory, 'feed.atom')
+        data = open('planet/tests/data/before.atom').read()
+        open(feed, 'w').write(data)
+        self.run_planet(0, [feed])
+
+        # a new title alone reaches the export
+        open(feed, 'w').write(data.replace('Example Feed', 'Renamed Feed', 1))
+        self.run_planet(0, [feed])
+        self.assertEqual([ channel.name for channel in
+                           self.run_planet(1, [feed]).channels() ],
+                         ['Renamed Feed'])
+
+    def test_generations(self):
+        self.run_planet(0)
+        export = cache.Export(self.directory)
+        self.assertEqual(export.generation, 1)
+        channels = export.channels
+        export.close()
+
+        # unchanged channels are copied over, and the old data removed
+        self.run_planet(0, offline=1)
+        export = cache.Export(self.directory)
+        self.assertEqual(export.generation, 2)
+        self.assertEqual(export.channels, channels)
+        self.assertEqual([ name for name in os.listdir(self.directory)
+                           if name.startswith('export.data') ],
+                         [cache.EXPORT_DATA % 2])
+        store = export.channel(channels.keys()[0])
+        self.assert_(store.ids())
+        self.assertRaises(IOError, store.delete, store.ids()[0])
+        export.close()
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        planet.logging.basicConfig()
+        self.directory = tempfile.mkdtemp()
+        self.journal = os.path.join(self.directory, planet.JOURNAL_FILENAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_planet(self, interval):
+        config = ConfigParser()
+        config.add_section('Planet')
+        config.set('Planet', 'cache_directory', self.directory)
+        config.set('Planet', 'cache_commit_interval', str(interval))
+        config.set('Planet', 'new_feed_items', '0')
+        config.set('Planet', 'sanitize_cache_size', '0')
+        for feed in ('planet/tests/data/before.atom',
+                     'planet/tests/data/before.rss'):
+            config.add_section(feed)
+        my_planet = planet.Planet(config)
+        my_planet.run('test', 'http://example.com', [], 0)
+        return my_planet
+
+    def journals(self):
+        return [ name for name in os.listdir(self.directory)
+                 if name.startswith(planet.JOURNAL_FILENAME) ]
+
+    def test_commit(self):
+        self.run_planet(0)
+        self.assertEqual(planet.stats.get('cache_syncs'), 2)
+        self.assertEqual(planet.stats.get('cache_commits'), 1)
+        self.assertEqual(self.journals(), [])
+
+        self.run_planet(1)
+        self.assertEqual(planet.stats.get('cache_syncs'), 2)
+        self.assertEqual(planet.stats.get('cache_commits'), 2)
+        self.assertEqual(self.journals(), [])
+
+    def test_interrupted(self):
+        expected = [ item.id for item in self.run_planet(0).items() ]
+        name = cache.filename('', 'planet/tests/data/before.atom')
+        open(os.path.join(self.directory, name), 'w').write('broken')
+        open(self.journal, 'w').write(name + '\n')
+
+        self.assertEqual([ item.id for item in self.run_planet(0).items() ],
+                         expected)
+        self.assert_(os.path.exists(os.path.join(self.directory,
+                                                 name + '.broken')))
+        self.assertEqual(self.journals(), [])
+
+    def test_live(self):
+        journal = planet.Journal(self.journal)
+        journal.interrupted['channel'] = 1
+        journal.write()
+        self.assertEqual(self.journals(), [os.path.basename(journal.filename)])
+
+        # a run going on isn't taken over, nor is its journal removed
+        self.assertEqual(planet.Journal(self.journal).interrupted, {})
+        self.assertEqual(self.journals(), [os.path.basename(journal.filename)])
+        journal.interrupted = {}
+        journal.close()
+        self.assertEqual(os.listdir(self.directory), [])
+
+class BenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_run(self):
+        channels = [ (name, fields, items[:10]) for name, fields, items
+                     in benchmark.make_channels()[:3] ]
+        results = benchmark.run(self.directory, channels)
+        self.assertEqual([ name for name, result in results ],
+                         benchmark.backends())
+        for name, result in results:
+            keys = result.keys()
+            keys.sort()
+            self.assertEqual(keys, ['load', 'render', 'size', 'update'])
+        self.assertEqual(os.listdir(self.directory), [])
+        self.failIf([ filename for filename in cache.BACKENDS['memory'].files
+                      if filename.startswith(self.directory) ])
+
+    def test_upgrading(self):
+        channels = [ (name, fields, items[:10]) for name, fields, items
+                     in benchmark.make_channels()[:3] ]
+        count, old, new = benchmark.upgrading(self.directory, channels)
+        self.assertEqual(count, 3)
+        self.assert_(0 < new < old)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_archiving(self):
+        channels = [ (name, fields, items[:10]) for name, fields, items
+                     in benchmark.make_channels()[:3] ]
+        # the items are an hour apart, a channel's worth of them is kept
+        before, after = benchmark.archiving(self.directory, 10 / 24.0,
+                                            channels)
+        self.assertEqual(before['items'], 30)
+        self.assertEqual(before['archive_size'], 0)
+        self.assertEqual(after['items'], 10)
+        self.assert_(after['size'] < before['size'])
+        self.assert_(after['archive_size'] > 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_listing(self):
+        channels = benchmark.make_channels(3, 10, 64)
+        results = benchmark.listing(self.directory, channels)
+        self.assertEqual([ result[:2] for result in results ],
+                         [('tuple', 30), ('epoch', 30)])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_old_dates(self):
+        item = benchmark.make_item('id', 86400, 0)
+        old = benchmark.old_dates(item)
+        self.assertEqual(old['date'][1], '1970 1 2 0 0 0 4 2 0')
+        self.assertEqual(cache.epoch(old['date'][1]), 86400)
+        self.assertEqual(old['title'], item['title'])
+
+    def test_sanitize(self):
+        corpus = benchmark.read_html(['planet/tests/data/before.atom',
+                                      'planet/tests/data/after.rss'])
+        self.assert_(corpus)
+        results = benchmark.sanitize_engines(corpus, rounds=1)
+        self.assertEqual([ result[0] for result in results ],
+                         list(benchmark.ENGINES))
+        self.assertEqual([ result[3] for result in results ], [0, 0])
+
+class BulkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name, fields, items in benchmark.make_channels()[:3]:
+            store = cache.open_dbhash(os.path.join(self.directory, name))
+            store.write(None, fields)
+            for id_, item in items[:10]:
+                store.write(id_, item)
+            store.close()
+        open(os.path.join(self.directory, 'junk'), 'w').write('junk')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stats(self):
+        paths = bulk.channel_files(self.directory)
+        self.assertEqual(len(paths), 3)
+        results = list(bulk.map_channels(bulk.stats, paths, 2))
+        self.assertEqual(results, map(bulk.stats, paths))
+        self.assertEqual(results[0]['items'], 10)
+        self.assert_(results[0]['oldest'] < results[0]['newest'])
+
+    def test_export(self):
+        paths = bulk.channel_files(self.directory)
+        lines = ''.join(bulk.map_channels(bulk.export, paths)).splitlines()
+        self.assertEqual(len(lines), 33)
+
+        directory = tempfile.mkdtemp()
+        try:
+            self.assertEqual(bulk.import_records(directory, lines), (3, 30))
+            for path in paths:
+                old = cache.open_dbhash(path, 'r')
+                new = cache.open_dbhash(os.path.join(directory,
+                                                     os.path.basename(path)))
+                # the serial is moved on, so snapshots are taken again
+                fields = new.read(None)
+                serial = fields.pop('cache_serial')
+                self.assertEqual(int(serial[1]), bulk.read_serial(old) + 1)
+                expected = old.read(None)
+                del(expected['cache_serial'])
+                self.assertEqual(fields, expected)
+                ids = old.ids()
+                ids.sort()
+                self.assertEqual([ new.read(id_) for id_ in ids ],
+                                 [ old.read(id_) for id_ in ids ])
+                old.close()
+                new.close()
+
+            # and past the one it had before, when imported over it
+            bulk.import_records(directory, lines)
+            new = cache.open_dbhash(os.path.join(directory,
+                                                 os.path.basename(paths[0])))
+            old = cache.open_dbhash(paths[0], 'r')
+            self.assertEqual(bulk.read_serial(new), bulk.read_serial(old) + 2)
+            old.close()
+            new.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_archive(self):
+        path = bulk.channel_files(self.directory)[0]
+        name, archived, old, new = bulk.archive(path, 0.25)
+        self.assertEqual(archived, 4)
+        results = bulk.stats(path)
+        self.assertEqual((results['items'], results['archived']), (6, 4))
+
+        lines = bulk.export(path).splitlines()
+        self.assertEqual(len(lines), 11)
+        directory = tempfile.mkdtemp()
+        try:
+            self.assertEqual(bulk.import_records(directory, lines), (1, 10))
+            new_path = os.path.join(directory, name)
+            self.assertEqual(bulk.open_archive(new_path).read(),
+                             bulk.open_archive(path).read())
+            self.assertEqual(bulk.stats(new_path)['items'], 6)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_vacuum(self):
+        path = bulk.channel_files(self.directory)[0]
+        name, old, new = bulk.vacuum(path)
+        self.assertEqual(name, os.path.basename(path))
+        self.assertEqual(bulk.stats(path)['items'], 10)
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_records(self):
+        filename = os.path.join(self.directory, 'archive', 'channel.gz')
+        archive = cache.Archive(filename)
+        self.assertEqual(archive.read(), {})
+        archive.append([('one', FIELDS), ('two', {})])
+        archive.append([('two', FIELDS)])
+        self.assertEqual(archive.read(), {'one': FIELDS, 'two': FIELDS})
+
+        # an interrupted append is left out
+        size = os.path.getsize(filename)
+        archive.append([('three', FIELDS)])
+        data = open(filename, 'rb').read()
+        open(filename, 'wb').write(data[:size + 20])
+        self.assertEqual(archive.read(), {'one': FIELDS, 'two': FIELDS})
+
+        # and doesn't lose the appends after it
+        archive.append([('four', FIELDS)])
+        archive.append([('five', FIELDS)])
+        self.assertEqual(sorted(archive.read().keys()),
+                         ['five', 'four', 'one', 'two'])
+
+    def test_failed_append(self):
+        filename = os.path.join(self.directory, 'archive', 'channel.gz')
+        archive = cache.Archive(filename)
+        archive.append([('one', FIELDS)])
+        size = os.path.getsize(filename)
+
+        def fsync(fd):
+            raise IOError, "disk full"
+        real_fsync, cache.os.fsync = cache.os.fsync, fsync
+        try:
+            self.assertRaises(IOError, archive.append, [('two', FIELDS)])
+        finally:
+            cache.os.fsync = real_fsync
+        self.assertEqual(os.path.getsize(filename), size)
+        archive.append([('three', FIELDS)])
+        self.assertEqual(sorted(archive.read().keys()), ['one', 'three'])
+
+    def test_no_zlib(self):
+        filename = os.path.join(self.directory, 'archive', 'channel.gz')
+        archive = cache.Archive(filename)
+        zlib, cache.zlib = cache.zlib, None
+        try:
+            # only an archive that's there needs zlib
+            self.assertEqual(archive.read(), {})
+            archive.append([])
+            self.assertRaises(IOError, archive.append, [('one', FIELDS)])
+            cache.zlib = zlib
+            archive.append([('one', FIELDS)])
+            cache.zlib = None
+            self.assertRaises(IOError, archive.read)
+        finally:
+            cache.zlib = zlib
+
+    def run_planet(self, archive_age=None, archive=0):
+        config = ConfigParser()
+        config.add_section('Planet')
+        config.set('Planet', 'cache_directory', self.directory)
+        config.set('Planet', 'new_feed_items', '0')
+        config.set('Planet', 'sanitize_cache_size', '0')
+        if archive_age is not None:
+            config.set('Planet', 'cache_archive_age', archive_age)
+        for feed in ('planet/tests/data/before.atom',
+                     'planet/tests/data/before.rss'):
+            config.add_section(feed)
+        my_planet = planet.Planet(config)
+        my_planet.run('test', 'http://example.com', [], archive=archive)
+        return my_planet
+
+    def test_channel(self):
+        expected = [ item.id for item in self.run_planet().items() ]
+
+        # a negative age archives every item, however new
+        self.assertEqual(self.run_planet('-1').items(), [])
+        self.assertEqual(planet.stats.get('items_archived'), len(expected))
+
+        # the feeds don't bring them back
+        self.assertEqual(self.run_planet().items(), [])
+        self.assertEqual([ item.id for item in
+                           self.run_planet(archive=1).items() ], expected)
+
+class BackendTest(unittest.TestCase):
+
+    def setUp(self):
+        planet.logging.basicConfig()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_planet(self, backend):
+        config = ConfigParser()
+        config.add_section('Planet')
+        config.set('Planet', 'cache_directory', self.directory)
+        config.set('Planet', 'cache_backend', backend)
+        config.set('Planet', 'new_feed_items', '0')
+        config.set('Planet', 'sanitize_cache_size', '0')
+        for feed in ('planet/tests/data/before.atom',
+                     'planet/tests/data/before.rss'):
+            config.add_section(feed)
+        my_planet = planet.Planet(config)
+        my_planet.run('test', 'http://example.com', [], 0)
+        return my_planet
+
+    def item_ids(self, my_planet, **kwargs):
+        return [ item.id for item in my_planet.items(**kwargs) ]
+
+    def test_other_backend(self):
+        class FakeGDBM:
+            error = IOError
+            def open(self, filename, flag, mode):
+                raise self.error, "not a gdbm file: " + filename
+        self.run_planet('dbhash')
+
+        # the caches can't be opened, but the run goes on without them
+        gdbm = cache.gdbm
+        cache.gdbm = FakeGDBM()
+        cache.BACKENDS['gdbm'] = cache.GDBMBackend()
+        try:
+            self.assertEqual(self.run_planet('gdbm').channels(), [])
+        finally:
+            cache.gdbm = gdbm
+            if gdbm is None:
+                del(cache.BACKENDS['gdbm'])
+            else:
+                cache.BACKENDS['gdbm'] = cache.GDBMBackend()
+
+    def test_memory(self):
+        expected = self.item_ids(self.run_planet('dbhash'))
+        shutil.rmtree(self.directory)
+        os.mkdir(self.directory)
+        my_planet = self.run_planet('memory')
+        self.assertEqual(self.item_ids(my_planet), expected)
+        self.failIf([ name for name in os.listdir(self.directory)
+                      if name.startswith('planet,') ])
+
+    def test_same_items(self):
+        if cache.sqlite3 is None: return
+        expected = self.item_ids(self.run_planet('dbhash'))
+        expected_two = self.item_ids(self.run_planet('dbhash'), max_items=2)
+        my_planet = self.run_planet('sqlite')
+        self.assertEqual(self.item_ids(my_planet), expected)
+        self.assertEqual(self.item_ids(my_planet, max_items=2), expected_two)
+
+    def test_migrate(self):
+        if cache.sqlite3 is None: return
+        expected = self.item_ids(self.run_planet('dbhash'))
+        os.remove(os.path.join(self.directory, planet.SNAPSHOT_FILENAME))
+        database = os.path.join(self.directory, planet.SQLITE_CACHE_FILENAME)
+        self.assertEqual(cache.migrate(self.directory, database), 2)
+
+        # the migrated cache is used offline just as the original was
+        config = ConfigParser()
+        config.add_section('Planet')
+        config.set('Planet', 'cache_directory', self.directory)
+        config.set('Planet', 'cache_backend', 'sqlite')
+        config.set('Planet', 'sanitize_cache_size', '0')
+        config.add_section('planet/tests/data/before.atom')
+        config.add_section('planet/tests/data/before.rss')
+        my_planet = planet.Planet(config)
+        my_planet.run('test', 'http://example.com', [], 1)
+        self.assertEqual(self.item_ids(my_planet), expected)
+
+if __name__ == '__main__':
+    unittest.main()
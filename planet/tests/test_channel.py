@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 
+import os
 import unittest
 import planet
 import tempfile
+import shutil
 import ConfigParser
 
 class FakePlanet:
@@ -14,6 +16,15 @@ class FakePlanet:
     def __init__(self):
         self.cache_directory = tempfile.gettempdir()
         self.config = ConfigParser.ConfigParser()
+        self.excerpt_words = planet.EXCERPT_WORDS
+        self.max_content_bytes = planet.MAX_CONTENT_BYTES
+        self.cache_backend = planet.CACHE_BACKEND
+        self.cache_max_age = planet.CACHE_MAX_AGE
+        self.cache_max_items = planet.CACHE_MAX_ITEMS
+        self.cache_archive_age = planet.CACHE_ARCHIVE_AGE
+        self.export = None
+        self.archive = 0
+        self.journal = None
 
 class FeedInformationTest(unittest.TestCase):
     """
@@ -34,5 +45,309 @@ class FeedInformationTest(unittest.TestCase):
         self.assertEqual(self.channel.feed_information(),
            "<%s> (formerly <%s>)" % (self.changed_url, self.url))
 
+class ParserModeTest(unittest.TestCase):
+    """
+    Test the Channel.update_parser_mode method
+    """
+
+    def setUp(self):
+        self.channel = planet.Channel(FakePlanet(), 'URL')
+        planet.stats.reset()
+
+    def test_failures(self):
+        info = planet.feedparser.FeedParserDict(strict_parse_time=0.5,
+                                                loose_parse_time=0.25)
+        for i in range(planet.LOOSE_THRESHOLD):
+            self.channel.update_parser_mode(info, 1)
+        self.assertEqual(self.channel.strict_failures,
+                         str(planet.LOOSE_THRESHOLD))
+        self.assertEqual(planet.stats.get("strict_parse_failures"),
+                         planet.LOOSE_THRESHOLD)
+
+        # skipping the strict parser counts the time it would have taken
+        info = planet.feedparser.FeedParserDict(loose_parse_time=0.25)
+        self.channel.update_parser_mode(info, 0)
+        self.assertEqual(planet.stats.get("strict_parses_skipped"), 1)
+        self.assertEqual(planet.stats.get("strict_parse_time_saved"), 0.5)
+
+    def test_error_page(self):
+        # a broken error page doesn't count against the feed
+        for status in (404, 500):
+            info = planet.feedparser.FeedParserDict(strict_parse_time=0.5,
+                                                    loose_parse_time=0.25,
+                                                    status=status)
+            self.channel.update_parser_mode(info, 1)
+        self.assertEqual(self.channel.strict_failures, "0")
+        info['status'] = 200
+        self.channel.update_parser_mode(info, 1)
+        self.assertEqual(self.channel.strict_failures, "1")
+
+    def test_fixed(self):
+        self.channel.strict_failures = str(planet.LOOSE_REPROBE)
+        info = planet.feedparser.FeedParserDict(strict_parse_time=0.5)
+        self.channel.update_parser_mode(info, 1)
+        self.assertEqual(self.channel.strict_failures, "0")
+
+class FingerprintTest(unittest.TestCase):
+    """
+    Test that unchanged entries aren't updated again
+    """
+
+    def setUp(self):
+        fake_planet = FakePlanet()
+        fake_planet.cache_directory = tempfile.mkdtemp()
+        fake_planet.new_feed_items = 0
+        self.channel = planet.Channel(fake_planet, 'URL')
+        planet.stats.reset()
+
+    def tearDown(self):
+        shutil.rmtree(self.channel._planet.cache_directory)
+
+    def entries(self, summary):
+        return planet.feedparser.parse("""<rss version="2.0"><channel>
+            <item><guid>1</guid><title>One</title>
+              <description>%s</description></item>
+            </channel></rss>""" % summary).entries
+
+    def test_fingerprint(self):
+        entry = self.entries("text")[0]
+        self.assertEqual(planet.fingerprint(entry),
+                         planet.fingerprint(dict(entry.items())))
+        self.assertNotEqual(planet.fingerprint(entry),
+                            planet.fingerprint(self.entries("other")[0]))
+
+    def test_unchanged(self):
+        self.channel.update_entries(self.entries("text"))
+        self.channel.update_entries(self.entries("text"))
+        self.assertEqual(planet.stats.get("entries_updated"), 1)
+        self.assertEqual(planet.stats.get("entries_unchanged"), 1)
+        self.channel.update_entries(self.entries("changed"))
+        self.assertEqual(planet.stats.get("entries_updated"), 2)
+        self.assertEqual(self.channel.get_item('1').summary, 'changed')
+
+    def test_settings(self):
+        # items are made again once the settings they're made with change
+        self.channel.update_entries(self.entries("text"))
+        self.channel._planet.excerpt_words = 1
+        self.channel.update_entries(self.entries("text"))
+        self.channel.max_content_bytes = '2'
+        self.channel.update_entries(self.entries("text"))
+        self.channel.update_entries(self.entries("text"))
+        self.assertEqual(planet.stats.get("entries_updated"), 3)
+        self.assertEqual(planet.stats.get("entries_unchanged"), 1)
+
+    def test_written(self):
+        self.channel.update_entries(self.entries("text"))
+        self.channel.cache_write()
+        self.assertEqual(planet.stats.get("cache_items_written"), 1)
+        self.channel.update_entries(self.entries("text"))
+        self.channel.cache_write()
+        self.assertEqual(planet.stats.get("cache_items_written"), 1)
+        keys = planet.stats.get("cache_keys_written")
+        self.channel.update_entries(self.entries("changed"))
+        self.channel.cache_write()
+        self.assertEqual(planet.stats.get("cache_items_written"), 2)
+        self.assert_(planet.stats.get("cache_keys_written") - keys < 10)
+
+        channel = planet.Channel(self.channel._planet, 'URL')
+        self.assertEqual(channel.get_item('1').summary, 'changed')
+        self.assertEqual(channel.get_item('1').title, 'One')
+
+class ExpiryTest(unittest.TestCase):
+    """
+    Test that items are expired from the cache
+    """
+
+    def setUp(self):
+        fake_planet = FakePlanet()
+        fake_planet.cache_directory = tempfile.mkdtemp()
+        fake_planet.new_feed_items = 0
+        fake_planet.cache_max_items = 2
+        self.channel = planet.Channel(fake_planet, 'URL')
+        planet.stats.reset()
+
+    def tearDown(self):
+        shutil.rmtree(self.channel._planet.cache_directory)
+
+    def update(self, guids, date='Mon, 02 Oct 2006 10:00:00 GMT'):
+        self.channel.update_entries(planet.feedparser.parse(
+            '<rss version="2.0"><channel>' +
+            ''.join([ '<item><guid>%s</guid><pubDate>%s</pubDate></item>'
+                      % (guid, date) for guid in guids ]) +
+            '</channel></rss>').entries)
+        self.channel.cache_write()
+
+    def item_ids(self):
+        ids = [ item.id for item in self.channel.items(hidden=1) ]
+        ids.sort()
+        return ids
+
+    def test_max_items(self):
+        self.update(['3', '2', '1'])
+        self.assertEqual(self.item_ids(), ['2', '3'])
+        self.assertEqual(planet.stats.get("items_expired"), 1)
+        self.assertEqual(self.channel.expired_ids, '1')
+
+        # not added back while the feed carries it, forgotten after
+        self.update(['3', '2', '1'])
+        self.assertEqual(self.item_ids(), ['2', '3'])
+        self.update(['3', '2'])
+        self.assertEqual(self.channel.expired_ids, '')
+
+        channel = planet.Channel(self.channel._planet, 'URL')
+        self.assertEqual([ item.id for item in channel.items() ], ['3', '2'])
+
+    def test_max_age(self):
+        self.channel.cache_max_items = '0'
+        self.channel.cache_max_age = '30'
+        self.update(['1'], 'Mon, 02 Oct 2000 10:00:00 GMT')
+        self.assertEqual(self.item_ids(), [])
+        self.update(['2'], planet.time.strftime('%a, %d %b %Y %H:%M:%S GMT'))
+        self.assertEqual(self.item_ids(), ['2'])
+
+    def test_archive_age(self):
+        self.channel.cache_max_items = '0'
+        self.channel.cache_archive_age = '30'
+        self.update(['1'], 'Mon, 02 Oct 2000 10:00:00 GMT')
+        self.assertEqual(self.item_ids(), [])
+        self.assertEqual(self.channel.expired_ids, '1')
+        archive = planet.cache.Archive(planet.cache.archive_filename(
+            self.channel._planet.cache_directory,
+            self.channel.cache_basename()))
+        self.assertEqual(archive.read().keys(), ['1'])
+
+    def test_compact(self):
+        self.update(['3', '2', '1'])
+        self.assertEqual(planet.stats.get("caches_compacted"), 0)
+        self.update(['5', '4'])
+        self.assertEqual(planet.stats.get("caches_compacted"), 1)
+        self.assertEqual(self.channel.deleted_items, '0')
+        self.update(['6', '5', '4'])
+        self.assertEqual(self.item_ids(), ['5', '6'])
+
+class PlainTextTest(unittest.TestCase):
+    """
+    Test the plain text fields stored when items are updated
+    """
+
+    def setUp(self):
+        fake_planet = FakePlanet()
+        fake_planet.cache_directory = tempfile.mkdtemp()
+        fake_planet.new_feed_items = 0
+        fake_planet.excerpt_words = 3
+        self.channel = planet.Channel(fake_planet, 'URL')
+
+    def tearDown(self):
+        shutil.rmtree(self.channel._planet.cache_directory)
+
+    def test_plain_text(self):
+        self.channel.update_entries(planet.feedparser.parse("""<feed
+            xmlns="http://www.w3.org/2005/Atom"><entry><id>1</id>
+              <title type="html">One &lt;b&gt;two&lt;/b&gt;</title>
+              <content type="html">&lt;p&gt;Three &lt;i&gt;four&lt;/i&gt;
+                five six&lt;/p&gt;</content></entry>
+            </feed>""", sanitizer=planet.sanitize.HTML).entries)
+        item = self.channel.get_item('1')
+        self.assertEqual(item.title_plain, 'One two')
+        self.assertEqual(item.excerpt, 'Three four five ...')
+        self.assertEqual(item.word_count, '4')
+        info = planet.template_info(item, planet.DATE_FORMAT)
+        self.assertEqual(info['title_plain'], 'One two')
+
+class TruncateTest(unittest.TestCase):
+    """
+    Test that truncated content links to the full item
+    """
+
+    def setUp(self):
+        fake_planet = FakePlanet()
+        fake_planet.cache_directory = tempfile.mkdtemp()
+        fake_planet.new_feed_items = 0
+        self.channel = planet.Channel(fake_planet, 'URL')
+        planet.stats.reset()
+
+    def tearDown(self):
+        shutil.rmtree(self.channel._planet.cache_directory)
+
+    def test_read_more(self):
+        sanitizer = lambda html, encoding, baseuri: \
+            planet.sanitize.HTML(html, encoding, baseuri, 20)
+        self.channel.update_entries(planet.feedparser.parse("""<rss
+            version="2.0"><channel><item><guid>1</guid>
+              <link>http://example.org/1?a&amp;b</link>
+              <description>&lt;p&gt;One &lt;b&gt;two three&lt;/b&gt;
+                four five six&lt;/p&gt;</description></item>
+            </channel></rss>""", sanitizer=sanitizer).entries)
+        item = self.channel.get_item('1')
+        self.assertEqual(item.summary, '<p>One <b>two three</b></p>' +
+                         planet.READ_MORE % 'http://example.org/1?a&amp;b')
+        self.assertEqual(item.summary_bytes, '57')
+        self.assertEqual(planet.stats.get("content_truncated"), 1)
+
+class ParseCacheTest(unittest.TestCase):
+    """
+    Test that parsed feeds are kept between runs
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'parse_cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_persistent(self):
+        parse_cache = planet.ParseCache(self.filename)
+        parse_cache['one x'] = {'entries': [1]}
+        parse_cache['two x'] = {'entries': [2]}
+        parse_cache['three x'] = {'entries': [3]}
+        parse_cache.close([])
+
+        parse_cache = planet.ParseCache(self.filename)
+        self.assert_(parse_cache.has_key('two x'))
+        self.assertEqual(parse_cache['two x'], {'entries': [2]})
+        parse_cache.close(['three'])
+
+        # only documents seen in the last run, or still a channel's, are kept
+        parse_cache = planet.ParseCache(self.filename)
+        self.failIf(parse_cache.has_key('one x'))
+        self.assert_(parse_cache.has_key('two x'))
+        self.assert_(parse_cache.has_key('three x'))
+        parse_cache.close()
+
+        # and nothing is dropped unless the digests are given
+        parse_cache = planet.ParseCache(self.filename)
+        self.assert_(parse_cache.has_key('three x'))
+        parse_cache.close()
+
+    def run_planet(self, offline):
+        config = ConfigParser.ConfigParser()
+        config.add_section('Planet')
+        config.set('Planet', 'cache_directory', self.directory)
+        config.set('Planet', 'parse_cache', 'persistent')
+        config.set('Planet', 'sanitize_cache_size', '0')
+        config.add_section('planet/tests/data/before.atom')
+        my_planet = planet.Planet(config)
+        my_planet.run('test', 'http://example.com', [], offline)
+        return my_planet
+
+    def keys(self):
+        parse_cache = planet.ParseCache(self.filename)
+        keys = parse_cache._db.keys()
+        parse_cache.close()
+        return keys
+
+    def test_offline(self):
+        self.run_planet(0)
+        keys = self.keys()
+        self.assertEqual(len(keys), 1)
+
+        # runs that fetch nothing, or find the feed unchanged, keep it
+        self.run_planet(1)
+        self.assertEqual(self.keys(), keys)
+        self.run_planet(0)
+        self.assertEqual(planet.stats.get('parse_cache_hits'), 1)
+        self.assertEqual(self.keys(), keys)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+import os, glob, mimetools, unittest
+from StringIO import StringIO
+from planet import feedparser, sanitize
+
+testfiles = 'planet/tests/data/*.%s'
+
+FEED = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0">
+  <channel>
+    <title>Example Feed</title>
+    <link>http://example.org/</link>
+    <cloud domain="rpc.example.org" port="80" path="/RPC2"/>
+    <item>
+      <title>First</title>
+      <link>http://example.org/1</link>
+      <category>one</category>
+      <category>two</category>
+      <enclosure url="http://example.org/1.mp3" length="1" type="audio/mpeg"/>
+      <description>Some &lt;b&gt;text&lt;/b&gt;.</description>
+    </item>
+  </channel>
+</rss>
+"""
+
+# the same feed, but not well-formed so it goes through the loose parser
+LOOSE_FEED = FEED.replace("</item>", "</item><br>")
+
+class ProfileTest(unittest.TestCase):
+
+    def test_unprofiled(self):
+        result = feedparser.parse(FEED)
+        self.assertEqual(result.bozo, 0)
+        self.assert_(result.feed.has_key('cloud'))
+        entry = result.entries[0]
+        self.assertEqual(len(entry.tags), 2)
+        self.assertEqual(len(entry.enclosures), 1)
+        self.assertEqual(entry.links[0].href, 'http://example.org/1')
+
+    def test_profiled(self):
+        for data in (FEED, LOOSE_FEED):
+            result = feedparser.parse(data,
+                profile=('tags', 'links', 'enclosures', 'cloud', 'date'))
+            self.failIf(result.feed.has_key('cloud'))
+            self.assertEqual(result.feed.title, 'Example Feed')
+            self.assertEqual(result.feed.link, 'http://example.org/')
+            entry = result.entries[0]
+            for key in ('tags', 'links', 'enclosures'):
+                self.failIf(entry.has_key(key), key)
+            self.assertEqual(entry.title, 'First')
+            self.assertEqual(entry.link, 'http://example.org/1')
+            self.assertEqual(entry.summary, 'Some <b>text</b>.')
+
+class TolerantParserTest(unittest.TestCase):
+
+    def parse(self, klass, data):
+        parser = klass('http://example.org/', None, 'utf-8')
+        parser.feed(data)
+        return parser.feeddata, parser.entries
+
+    def test_same_as_sgmllib(self):
+        docs = [FEED, LOOSE_FEED, LOOSE_FEED.replace('<title>', '<title/>'),
+                '<rss><channel><title>A &amp; B &copy; &#169;<x'
+                ' y="1" z=\'2\' q', '<feed><!-- unterminated']
+        for ext in ('atom', 'rss'):
+            for path in glob.glob(testfiles % ext):
+                docs.append(open(path).read())
+        for data in docs:
+            self.assertEqual(self.parse(feedparser._TolerantFeedParser, data),
+                             self.parse(feedparser._LooseFeedParser, data))
+
+    def test_loose_parser(self):
+        result = feedparser.parse(LOOSE_FEED)
+        self.assertEqual(result.bozo, 1)
+        self.assertEqual(result.entries[0].title, 'First')
+
+    def test_skip_strict(self):
+        result = feedparser.parse(FEED, strict=0)
+        self.failIf(result.has_key('strict_parse_time'))
+        self.assert_(result.has_key('loose_parse_time'))
+        self.assertEqual(result.entries[0].title, 'First')
+
+class ResultsTest(unittest.TestCase):
+
+    def test_shared(self):
+        results = {}
+        first = feedparser.parse(FEED, results=results)
+        self.assertEqual(len(results), 1)
+        second = feedparser.parse(FEED, results=results)
+        self.failIf(second.has_key('strict_parse_time'))
+        self.assertEqual(second.digest, first.digest)
+        self.assert_(second.entries is first.entries)
+        third = feedparser.parse(LOOSE_FEED, results=results)
+        self.assertNotEqual(third.digest, first.digest)
+        self.assertEqual(len(results), 2)
+
+    def response(self, url, data):
+        response = StringIO(data)
+        response.url = url
+        response.headers = mimetools.Message(
+            StringIO('Content-Type: application/rss+xml\r\n\r\n'))
+        return response
+
+    def test_base_uri(self):
+        # the same document fetched from two places has its relative
+        # links resolved against each
+        feed = FEED.replace('Some &lt;b&gt;text&lt;/b&gt;.',
+                            '&lt;a href="more"&gt;More&lt;/a&gt;')
+        results = {}
+        first = feedparser.parse(self.response('http://example.org/feed',
+                                               feed), results=results,
+                                 sanitizer=sanitize.HTML)
+        second = feedparser.parse(self.response('https://example.com/feed',
+                                                feed), results=results,
+                                  sanitizer=sanitize.HTML)
+        self.assertEqual(second.digest, first.digest)
+        self.assertEqual(len(results), 2)
+        self.assert_('http://example.org/more' in first.entries[0].description)
+        self.assert_('https://example.com/more'
+                     in second.entries[0].description)
+
+    def test_sanitizer_version(self):
+        results = {}
+        feedparser.parse(FEED, results=results, sanitizer_version='1')
+        second = feedparser.parse(FEED, results=results,
+                                  sanitizer_version='2')
+        self.assert_(second.has_key('strict_parse_time'))
+        self.assertEqual(len(results), 2)
+
+class ContentSanitizerTest(unittest.TestCase):
+
+    def test_truncated(self):
+        # only entries' content and summary are truncated
+        long = '&lt;b&gt;' + 'word ' * 10 + '&lt;/b&gt;'
+        feed = FEED.replace('Example Feed', long, 1) \
+                   .replace('<link>http://example.org/</link>',
+                            '<link>http://example.org/</link>'
+                            '<description>%s</description>' % long, 1) \
+                   .replace('First', long) \
+                   .replace('Some &lt;b&gt;text&lt;/b&gt;.', long)
+        truncate = lambda html, encoding, baseuri: \
+            sanitize.HTML(html, encoding, baseuri, 20)
+        for data in (feed, feed.replace("</item>", "</item><br>")):
+            result = feedparser.parse(data, sanitizer=sanitize.HTML,
+                                      content_sanitizer=truncate)
+            for value in (result.feed.title, result.feed.subtitle,
+                          result.entries[0].title):
+                self.assertEqual(sanitize.truncated(value)[1], None)
+            self.assertEqual(sanitize.truncated(result.entries[0].summary),
+                             (u'<b>word word word</b>', 57))
+
+HTML_FEED = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xml:base="http://example.org/a/">
+  <title type="html">A &lt;i&gt;title&lt;/i&gt;&lt;script&gt;x()&lt;/script&gt;</title>
+  <entry xml:base="b/">
+    <title type="html">&lt;b&gt;unclosed</title>
+    <content type="html">&lt;a href="c.html"&gt;c&lt;/a&gt;
+      &lt;img src="/d.png" onclick="e()"&gt;&lt;blockquote cite="f"&gt;&amp;copy; &amp;bogus;</content>
+  </entry>
+</feed>
+"""
+
+class SanitizerTest(unittest.TestCase):
+
+    def test_same_as_separate_passes(self):
+        docs = [HTML_FEED]
+        for ext in ('atom', 'rss'):
+            for path in glob.glob(testfiles % ext):
+                docs.append(open(path).read())
+        for data in docs:
+            before = feedparser.parse(data)
+            after = feedparser.parse(data, sanitizer=sanitize.HTML)
+            for key in ('title', 'subtitle'):
+                if before.feed.has_key(key):
+                    self.assertEqual(after.feed[key],
+                                     sanitize.HTML(before.feed[key]))
+            for old, new in zip(before.entries, after.entries):
+                for key in ('title', 'summary'):
+                    if old.has_key(key):
+                        self.assertEqual(new[key], sanitize.HTML(old[key]))
+                for old, new in zip(old.get('content', []),
+                                    new.get('content', [])):
+                    self.assertEqual(new.value, sanitize.HTML(old.value))
+
+    def test_relative_uris(self):
+        result = feedparser.parse(HTML_FEED, sanitizer=sanitize.HTML)
+        self.assertEqual(result.entries[0].content[0].value,
+                         '<a href="http://example.org/a/b/c.html">c</a>\n'
+                         '      <img src="http://example.org/d.png" />'
+                         '<blockquote cite="http://example.org/a/b/f">'
+                         '&copy; &amp;bogus</blockquote>')
+
+if __name__ == '__main__':
+    unittest.main()
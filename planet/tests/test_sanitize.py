@@ -2,16 +2,19 @@
 # and from http://feedparser.org/tests/wellformed/sanitize/
 # by Aaron Swartz, 2006, public domain
 
-import unittest, new
-from planet import sanitize
+import unittest, new, os, shutil, tempfile
+from xml.sax.saxutils import escape
+from planet import feedparser, sanitize
 
 class SanitizeTest(unittest.TestCase): pass
 
 # each call to HTML adds a test case to SanitizeTest
 testcases = 0
+inputs = []
 def HTML(a, b):
   global testcases
   testcases += 1
+  inputs.append(a)
   func = lambda self: self.assertEqual(sanitize.HTML(a), b)
   method = new.instancemethod(func, None, SanitizeTest)
   setattr(SanitizeTest, "test_%d" % testcases, method)
@@ -123,3 +126,140 @@ HTML("http://example.org?a=1&b=2","http://example.org?a=1&amp;b=2");
 # quote characters
 HTML('<a title="&#34;">quote</a>','<a title="&#34;">quote</a>')
 HTML('<a title="&#39;">quote</a>','<a title="&#39;">quote</a>')
+HTML('<a title=\'x" onmouseover="alert(1)\' href="y">z</a>','<a title="x&#34; onmouseover=&#34;alert(1)" href="y">z</a>')
+HTML('<img alt=\'&#34; onerror=&#34;alert(2)\'>','<img alt="&#34; onerror=&#34;alert(2)" />')
+HTML('<a title="&lt;b&gt; &amp; &copy;">x</a>','<a title="&lt;b&gt; &amp; &copy;">x</a>')
+
+class EngineTest(unittest.TestCase):
+
+    extra = ['<a href="x" title=\'y\' checked>z</a>', '<p>a<b>b</p>c',
+             '<img src="/a.png" alt="&lt;&amp;&#65;&bogus;">',
+             '<b>unterminated <i', '<!-- unterminated', 'a &copy b &#x41 c',
+             '<div style="color: red">&#39;&#34;</div><br/><hr />',
+             '<blockquote cite="q">x</blockquote><?php x ?><![CDATA[y]]>']
+
+    def setUp(self):
+        self.engine = sanitize.ENGINE
+
+    def tearDown(self):
+        sanitize.ENGINE = self.engine
+
+    def test_same_as_sgmllib(self):
+        for baseuri in (None, '', 'http://example.org/a/b'):
+            for data in inputs + self.extra:
+                sanitize.ENGINE = 'sgmllib'
+                expected = sanitize.HTML(data, baseuri=baseuri)
+                sanitize.ENGINE = 'fast'
+                self.assertEqual(sanitize.HTML(data, baseuri=baseuri),
+                                 expected, repr(data))
+
+class InjectionTest(unittest.TestCase):
+
+    feed = ('<rss version="2.0"><channel><title>t</title>'
+            '<link>http://example.org/</link><item><title>i</title>'
+            '<description>%s</description></item></channel></rss>')
+
+    def setUp(self):
+        self.engine = sanitize.ENGINE
+
+    def tearDown(self):
+        sanitize.ENGINE = self.engine
+
+    def test_attributes(self):
+        # quotes in a value, however written, can't end it early
+        for engine in ('fast', 'sgmllib'):
+            sanitize.ENGINE = engine
+            for data, expected in (
+                ('<a title=\'x" onmouseover="alert(1)\' href="y">z</a>',
+                 '<a title="x&#34; onmouseover=&#34;alert(1)" href="y">z</a>'),
+                ('<img alt=\'&#34; onerror=&#34;alert(2)\'>',
+                 '<img alt="&#34; onerror=&#34;alert(2)" />')):
+                result = feedparser.parse(self.feed % escape(data),
+                                          sanitizer=sanitize.HTML)
+                self.assertEqual(result.entries[0].summary, expected)
+
+class TruncateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sanitize.ENGINE
+
+    def tearDown(self):
+        sanitize.ENGINE = self.engine
+
+    def test_truncate(self):
+        data = '<p>One <b>two three</b> four</p><p>five</p>'
+        for engine in ('fast', 'sgmllib'):
+            sanitize.ENGINE = engine
+            self.assertEqual(sanitize.HTML(data, max_bytes=len(data)), data)
+            self.assertEqual(sanitize.HTML(data, max_bytes=14),
+                             '<p>One <b>two</b></p>' + sanitize.TRUNCATED % 43)
+            self.assertEqual(sanitize.HTML(data, max_bytes=24),
+                             '<p>One <b>two three</b></p>' +
+                             sanitize.TRUNCATED % 43)
+            self.assertEqual(sanitize.HTML('<a title="x y">z</a>',
+                                           max_bytes=12),
+                             sanitize.TRUNCATED % 20)
+
+    def test_truncated(self):
+        data = sanitize.HTML(u'<p>\xe9\xe9\xe9\xe9</p>', max_bytes=6)
+        self.assertEqual(sanitize.truncated(data), ('<p>\xc3\xa9</p>', 15))
+        self.assertEqual(sanitize.truncated('<p>x</p>'), ('<p>x</p>', None))
+
+    def test_forged(self):
+        # content can't claim to have been truncated
+        marker = sanitize.TRUNCATED % 999
+        for data in ('<p>x</p>' + marker,
+                     '<p>x</p>' + marker[:10] + marker + marker[10:]):
+            for engine in ('fast', 'sgmllib'):
+                sanitize.ENGINE = engine
+                self.assertEqual(sanitize.truncated(sanitize.HTML(data)),
+                                 ('<p>x</p>', None))
+                self.assertEqual(sanitize.truncated(
+                    sanitize.HTML(data + 'y' * 30, max_bytes=40)),
+                    ('<p>x</p>', len(data) + 30))
+
+class SanitizeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'sanitize_cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cache(self):
+        if sanitize.sqlite3 is None: return
+        cache = sanitize.SanitizeCache(self.filename, 2)
+        self.assertEqual(cache.HTML('<b>one'), '<b>one</b>')
+        self.assertEqual(cache.HTML('<b>two'), '<b>two</b>')
+        self.assertEqual(cache.HTML('<b>one'), '<b>one</b>')
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        cache.close()
+
+        # results are kept between runs, least recently used first out
+        cache = sanitize.SanitizeCache(self.filename, 2)
+        self.assertEqual(cache.HTML('<b>one'), '<b>one</b>')
+        self.assertEqual(cache.HTML('<b>three'), '<b>three</b>')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.close()
+        cache = sanitize.SanitizeCache(self.filename, 2)
+        cache.HTML('<b>two')
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        cache.close()
+
+    def test_engine(self):
+        if sanitize.sqlite3 is None: return
+        cache = sanitize.SanitizeCache(self.filename, 2)
+        cache.HTML('<b>one')
+        cache.close()
+
+        # results of the other engine aren't used
+        engine = sanitize.ENGINE
+        sanitize.ENGINE = 'sgmllib'
+        try:
+            cache = sanitize.SanitizeCache(self.filename, 2)
+            cache.HTML('<b>one')
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+            cache.close()
+        finally:
+            sanitize.ENGINE = engine
@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import os, glob, unittest
+import os, shutil, unittest
 from ConfigParser import ConfigParser
 from StringIO import StringIO
 import planet
@@ -14,9 +14,7 @@ class SubTest(unittest.TestCase):
         self.my_planet = planet.Planet(self.config)
 
     def tearDown(self):
-        for file in glob.glob('planet/tests/data/cache/*'):
-            os.unlink(file)
-        os.removedirs('planet/tests/data/cache')
+        shutil.rmtree('planet/tests/data/cache')
 
     def test_fetch(self):
         self.config.readfp(StringIO("""[planet/tests/data/before.atom]
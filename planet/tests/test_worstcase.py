@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Worst case inputs for the feed parser and the HTML sanitizer.
+
+Each one is built to make a regular expression, or the parser, go over the
+same data again and again.  They should all be handled in roughly linear
+time, so a run isn't stalled by one bad feed: if an input of SIZE bytes
+takes more than SLOWDOWN times as long as one a quarter of the size (plus
+SLACK seconds, for timer noise) something has most likely gone quadratic.
+"""
+
+import time
+import unittest
+from planet import feedparser, sanitize
+
+SIZE = 16 * 1024
+SLOWDOWN = 8
+SLACK = 0.05
+
+def repeat(prefix, unit, suffix=''):
+    return lambda size: prefix + unit * ((size - len(prefix)) / len(unit)) \
+                        + suffix
+
+CORPUS = {
+    'unterminated tag':       repeat('<a ', 'x'),
+    'unterminated attribute': repeat('<a title="', 'x '),
+    'unterminated tag name':  repeat('<', 'a', ' '),
+    'tag names':              repeat('', '<x'),
+    'shorttag spaces':        repeat('<a', ' ', '/'),
+    'shorttags':              repeat('', '<a/b'),
+    'attributes':             repeat('<a ', 'b=c ', '>'),
+    'quoted attributes':      repeat('<a ', 'b="c ', '>'),
+    'ampersands':             repeat('', '&'),
+    'entity names':           repeat('', '&x'),
+    'character references':   repeat('', '&#'),
+    'less thans':             repeat('', '<'),
+    'end tags':               repeat('', '</'),
+    'comments':               repeat('', '<!--'),
+    'declarations':           repeat('', '<!'),
+    'entity declarations':    repeat('', '<!ENTITY'),
+    'doctypes':               repeat('', '<!DOCTYPE'),
+    'processing instructions': repeat('', '<?'),
+    'cdata sections':         repeat('', '<![CDATA['),
+    'nested elements':        repeat('', '<b><i>', 'x'),
+}
+
+class WorstCaseTest(unittest.TestCase):
+
+    def assertLinear(self, func, wrap=lambda data: data):
+        for name, data in CORPUS.items():
+            times = []
+            for size in (SIZE / 4, SIZE):
+                start = time.time()
+                func(wrap(data(size)))
+                times.append(time.time() - start)
+            self.failIf(times[1] > SLOWDOWN * times[0] + SLACK,
+                        "%s took %.3fs, %.3fs at a quarter of the size" %
+                        (name, times[1], times[0]))
+
+    def test_sanitize(self):
+        self.assertLinear(sanitize.HTML)
+        self.assertLinear(lambda data:
+            sanitize.HTML(data, baseuri='http://example.org/'))
+
+    def test_feed(self):
+        self.assertLinear(feedparser.parse,
+                          lambda data: '<rss><channel><title>' + data)
+
+    def test_content(self):
+        self.assertLinear(lambda data:
+            feedparser.parse(data, sanitizer=sanitize.HTML),
+            lambda data: '<rss><channel><item><description>' +
+                         data.replace('&', '&amp;').replace('<', '&lt;'))
+
+if __name__ == '__main__':
+    unittest.main()